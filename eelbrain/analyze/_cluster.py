@@ -0,0 +1,339 @@
+'''
+Spatio-temporal cluster statistics for mass-univariate tests on ndvars.
+
+Statistic maps are handled as flat arrays containing the data of a single
+ndvar case (i.e., ``data[0].ravel()``). Points are connected to their
+immediate neighbors along the time axis, and to neighboring sensors as defined
+by :meth:`sensor_net.connectivity`.
+
+Permutation distributions are computed in batches: all permuted statistic maps
+of one batch are computed with a single matrix product, and only the
+extraction of the maximum statistic is done map by map. Batches can be
+distributed over several worker processes (see :mod:`eelbrain.utils.parallel`).
+
+
+Created on Oct 17, 2012
+
+@author: christian
+'''
+from __future__ import division
+
+import numpy as np
+import scipy.sparse
+import scipy.stats
+from scipy.sparse.csgraph import connected_components
+
+from eelbrain.utils import parallel
+
+
+# maximum size of the permuted statistic maps held in memory at once (bytes)
+_batch_bytes = 2**26
+# maximum number of permutations per batch (batches are the units of work
+# distributed to worker processes; the batches do not depend on the number of
+# processes, so that results are the same in a single process)
+_batch_max = 100
+
+
+
+def _dim_edges(dim):
+    "(n_edges, 2) array of neighboring points along one dimension"
+    if dim.name == 'time':
+        i = np.arange(len(dim) - 1)
+        return np.vstack((i, i + 1)).T
+    elif dim.name == 'sensor':
+        return dim.connectivity()
+    else:
+        raise NotImplementedError("No connectivity for %r dimension" % dim.name)
+
+
+def connectivity(dims):
+    """
+    Returns the edges connecting neighboring points in a map with dimensions
+    ``dims`` as ``(n_edges, 2)`` array of indexes into the flattened map.
+
+    """
+    shape = tuple(len(dim) for dim in dims)
+    n_points = np.prod(shape)
+    graph = None
+    for i, dim in enumerate(dims):
+        n = shape[i]
+        edges = _dim_edges(dim)
+        ones = np.ones(len(edges))
+        adj = scipy.sparse.coo_matrix((ones, (edges[:,0], edges[:,1])),
+                                      shape=(n, n))
+        n_before = int(np.prod(shape[:i]))
+        n_after = int(np.prod(shape[i+1:]))
+        adj = scipy.sparse.kron(scipy.sparse.identity(n_before), adj)
+        adj = scipy.sparse.kron(adj, scipy.sparse.identity(n_after))
+        if graph is None:
+            graph = adj
+        else:
+            graph = graph + adj
+
+    graph = scipy.sparse.coo_matrix(graph)
+    assert graph.shape == (n_points, n_points)
+    return np.vstack((graph.row, graph.col)).T
+
+
+
+class cluster_mass(object):
+    """
+    Cluster mass statistic for a fixed cluster-forming threshold. Clusters are
+    formed separately for values above ``threshold`` and below
+    ``-threshold``; the mass of a cluster is the sum of the statistic over all
+    its points.
+
+    """
+    def __init__(self, threshold, edges, n_points):
+        self.threshold = threshold
+        self.edges = edges
+        self.n_points = n_points
+
+    def label(self, stat_map):
+        """
+        Returns ``(labels, masses)``: ``labels`` is an int array of the same
+        length as ``stat_map`` containing the cluster index for each point
+        (-1 for points that are not part of any cluster), and ``masses``
+        contains the (signed) mass for each cluster.
+
+        """
+        pos = stat_map > self.threshold
+        neg = stat_map < -self.threshold
+
+        # connect neighbors with the same sign only
+        e0 = self.edges[:,0]
+        e1 = self.edges[:,1]
+        keep = (pos[e0] & pos[e1]) | (neg[e0] & neg[e1])
+        ones = np.ones(np.sum(keep), dtype=np.int8)
+        graph = scipy.sparse.coo_matrix((ones, (e0[keep], e1[keep])),
+                                        shape=(self.n_points, self.n_points))
+        _, labels = connected_components(graph, directed=False)
+
+        # renumber the clusters, excluding points below threshold
+        active = pos | neg
+        labels_out = np.empty(self.n_points, dtype=np.intp)
+        labels_out.fill(-1)
+        if np.any(active):
+            ids, labels_out[active] = np.unique(labels[active],
+                                                return_inverse=True)
+            masses = np.bincount(labels_out[active],
+                                 weights=stat_map[active])
+        else:
+            masses = np.empty(0)
+        return labels_out, masses
+
+    def __call__(self, stat_map):
+        "maximum absolute cluster mass (0 if there is no cluster)"
+        _, masses = self.label(stat_map)
+        if len(masses):
+            return np.max(np.abs(masses))
+        else:
+            return 0
+
+
+
+class tfce(object):
+    """
+    Threshold-free cluster enhancement (Smith & Nichols, 2009). The TFCE
+    value at each point is the sum over thresholds ``h`` (in steps of ``dh``)
+    of ``extent(h) ** E * h ** H * dh``, where ``extent(h)`` is the size of
+    the cluster containing the point at threshold ``h``. Positive and
+    negative values are enhanced separately.
+
+    All thresholds are processed together: the threshold layers are stacked
+    into one graph, so that a single connected components call labels the
+    clusters at all thresholds (layers are split into blocks only to limit
+    memory use).
+
+    Reference
+    ---------
+    Smith, S. M., & Nichols, T. E. (2009). Threshold-free cluster enhancement:
+        addressing problems of smoothing, threshold dependence and
+        localisation in cluster inference. NeuroImage, 44(1), 83--98.
+
+    """
+    def __init__(self, edges, n_points, E=.5, H=2, dh=.1):
+        self.edges = edges
+        self.n_points = n_points
+        self.E = E
+        self.H = H
+        self.dh = dh
+
+    def transform(self, stat_map):
+        "returns the TFCE map for ``stat_map`` (signed)"
+        out = self._enhance(stat_map)
+        out -= self._enhance(-stat_map)
+        return out
+
+    def _enhance(self, x):
+        "TFCE of the positive part of x"
+        out = np.zeros(self.n_points)
+        x_max = np.max(x)
+        if x_max < self.dh:
+            return out
+        thresholds = np.arange(self.dh, x_max + self.dh / 2, self.dh)
+        thresholds = thresholds[thresholds <= x_max]
+
+        # threshold layers per block
+        n_edges = max(1, len(self.edges))
+        block_size = max(1, int(_batch_bytes // (32 * (n_edges + self.n_points))))
+        for start in xrange(0, len(thresholds), block_size):
+            h = thresholds[start:start + block_size]
+            out += self._enhance_block(x, h)
+        return out
+
+    def _enhance_block(self, x, h):
+        n_h = len(h)
+        n = self.n_points
+        active = x[None,:] >= h[:,None]
+
+        # connect active neighbors within each layer
+        e0 = self.edges[:,0]
+        e1 = self.edges[:,1]
+        layer, edge = np.nonzero(active[:,e0] & active[:,e1])
+        offset = layer * n
+        ones = np.ones(len(edge), dtype=np.int8)
+        graph = scipy.sparse.coo_matrix((ones, (offset + e0[edge],
+                                                offset + e1[edge])),
+                                        shape=(n_h * n, n_h * n))
+        _, labels = connected_components(graph, directed=False)
+
+        # cluster extent for each active point
+        active = active.ravel()
+        labels = labels[active]
+        extent = np.bincount(labels)[labels]
+        h_active = np.repeat(h, n)[active]
+        values = np.zeros(n_h * n)
+        values[active] = extent ** self.E * h_active ** self.H * self.dh
+        return values.reshape((n_h, n)).sum(0)
+
+    def __call__(self, stat_map):
+        "maximum absolute TFCE value"
+        return np.max(np.abs(self.transform(stat_map)))
+
+
+
+def _t_1samp(data, signs):
+    """
+    One-sample t-values for all sign permutations.
+
+    data : array (n_cases, n_points)
+        data (float64); the mean is tested against 0
+    signs : array (n_perm, n_cases)
+        1 or -1 for each permutation and case
+
+    """
+    n = data.shape[0]
+    mean = np.dot(signs, data) / n
+    # the sum of squares is invariant under sign flipping
+    ss = np.sum(data ** 2, axis=0)
+    var = (ss - n * mean ** 2) / (n - 1)
+    return mean / np.sqrt(var / n)
+
+
+def _t_ind(data, group_1, n1):
+    """
+    Independent samples t-values for all group permutations.
+
+    data : array (n_cases, n_points)
+    group_1 : array of bool (n_perm, n_cases)
+        membership in the first group for each permutation
+    n1 : int
+        number of cases in the first group
+
+    """
+    n = data.shape[0]
+    n2 = n - n1
+    ind = group_1.astype(data.dtype)
+    sum_1 = np.dot(ind, data)
+    ss_1 = np.dot(ind, data ** 2)
+    sum_2 = np.sum(data, axis=0) - sum_1
+    ss_2 = np.sum(data ** 2, axis=0) - ss_1
+    mean_1 = sum_1 / n1
+    mean_2 = sum_2 / n2
+    var = (ss_1 - n1 * mean_1 ** 2 + ss_2 - n2 * mean_2 ** 2) / (n - 2)
+    return (mean_1 - mean_2) / np.sqrt(var * (1 / n1 + 1 / n2))
+
+
+def permuted_t_maps(data, n1, rng, n):
+    """
+    Returns an (n, n_points) array of t-maps for n random permutations.
+
+    data : array (n_cases, n_points)
+        data (float64)
+    n1 : None | int
+        None for a one-sample test against 0 (related samples tests should
+        provide the difference); the size of the first group for an
+        independent samples test.
+    rng : RandomState
+        random number generator
+    n : int
+        number of permutations
+
+    """
+    n_cases = data.shape[0]
+    if n1 is None:
+        signs = rng.randint(2, size=(n, n_cases)) * 2 - 1
+        return _t_1samp(data, signs)
+    else:
+        order = np.argsort(rng.rand(n, n_cases), axis=1)
+        group_1 = order < n1
+        return _t_ind(data, group_1, n1)
+
+
+def permutation_batches(n_samples, n_points):
+    "list with the number of permutations in each batch"
+    batch_size = max(1, int(_batch_bytes // (8 * n_points)))
+    batch_size = min(batch_size, _batch_max)
+    n_batches, rest = divmod(n_samples, batch_size)
+    batches = [batch_size] * n_batches
+    if rest:
+        batches.append(rest)
+    return batches
+
+
+def _permutation_batch(data, context, rng, n):
+    "map statistic for n permutations (for :func:`parallel.map_batches`)"
+    n1, map_stat = context
+    t_maps = permuted_t_maps(data, n1, rng, n)
+    return np.array([map_stat(t_map) for t_map in t_maps], dtype=np.float64)
+
+
+def permutation_distribution(data, n1, map_stat, samples, seed=0,
+                             n_workers=None):
+    """
+    Returns the distribution of ``map_stat(t_map)`` for ``samples`` random
+    permutations of ``data``.
+
+    data : array (n_cases, n_points)
+        data
+    n1 : None | int
+        see :func:`permuted_t_maps`
+    map_stat : callable
+        function extracting a scalar statistic from a t-map (e.g., a
+        :class:`cluster_mass` instance); needs to be picklable when
+        ``n_workers > 1``.
+    samples : int
+        number of permutations
+    seed : int
+        seed for the random number generator; each batch of permutations
+        uses its own RandomState initialized with ``(seed, batch_index)``,
+        so the result does not depend on ``n_workers``.
+    n_workers : None | int
+        number of worker processes (default:
+        ``parallel.defaults['n_workers']``, i.e. 1 unless parallel 
+        execution is enabled)
+
+    """
+    data = np.asarray(data, dtype=np.float64)
+    batches = permutation_batches(samples, data.shape[1])
+    return parallel.map_batches(_permutation_batch, data, batches,
+                                context=(n1, map_stat), n_workers=n_workers,
+                                seed=seed)
+
+
+def t_threshold(p, df, tail=0):
+    "t-value corresponding to the p-value ``p``"
+    if tail == 0:
+        p = p / 2
+    return scipy.stats.t.isf(p, df)
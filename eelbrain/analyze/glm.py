@@ -10,18 +10,25 @@ from copy import deepcopy
 
 import numpy as np
 import scipy as sp
+import scipy.linalg
 
 import eelbrain.fmtxt as textab
 
 import test
-from eelbrain.vessels.data import model, var, ismodel, asmodel, isvar, asvar
+from eelbrain.vessels.data import model, var, ismodel, asmodel, isvar, asvar, isndvar
+from eelbrain.vessels.data import ndvar as _ndvar
+import eelbrain.vessels.colorspaces as _cs
 
 
 
 defaults = dict(show_ems=False, #True or False; show E(MS) in Anova tables
                 p_fmt='%.4f',
+                map_max_mem=2**27, # memory budget (bytes) for lm_fitter.map
                 )
 
+# contours for p-maps
+_p_contours = {.05: (.8, .2, .0),  .01: (1., .6, .0),  .001: (1., 1., .0)}
+
 
 
 def _leastsq(Y, X):
@@ -189,9 +196,9 @@ class lm:
         # fit
         if lsq == 1:
             # estimate least squares approximation
-            beta = _leastsq(Y.x, X.full)
+            beta = _leastsq(Y.x, X._full)
             # estimate
-            values = self.values = beta * X.full
+            values = self.values = beta * X._full
             Y_est = values.sum(1)
             self._residuals = residuals = Y.x - Y_est
             SS_res = np.sum(residuals**2)
@@ -199,7 +206,7 @@ class lm:
                 logging.warning("Y.mu=%s != Y_est.mean()=%s"%(Y.mu, Y_est.mean()))
         else:
             # use numpy
-            beta, SS_res, rank, s = np.linalg.lstsq(X.full, Y.x)
+            beta, SS_res, rank, s = np.linalg.lstsq(X._full, Y.x)
             if len(SS_res) == 1:
                 SS_res = SS_res[0]
             else:
@@ -235,7 +242,7 @@ class lm:
     @property
     def residuals(self):
         if not hasattr(self, '_residuals'):
-            values = self.beta * self.X.full
+            values = self.beta * self.X._full
             Y_est = values.sum(1)
             self._residuals = self.Y.x - Y_est
         return self._residuals
@@ -256,6 +263,97 @@ class lm:
 #        pass
 
 
+class _submodel_lm(object):
+    """
+    Fit statistics of a submodel, with the same attributes as :class:`lm` 
+    (created by :class:`_lm_cache`)
+    
+    """
+    def __init__(self, SS_res, SS_total, N, df_model):
+        self.SS_total = SS_total
+        self.df_total = N - 1
+        self.MS_total = SS_total / self.df_total
+        self.SS_res = SS_res
+        self.df_res = N - 1 - df_model
+        if self.df_res > 0:
+            self.MS_res = SS_res / self.df_res
+        else:
+            self.MS_res = 0
+        self.SS_model = SS_total - SS_res
+        self.df_model = df_model
+        self.MS_model = self.SS_model / df_model
+    
+    def F_test(self):
+        F = self.MS_model / self.MS_res
+        p = sp.stats.distributions.f.sf(F, self.df_model, self.df_res)
+        return F, p
+
+
+class _lm_cache(object):
+    """
+    Fits submodels of the model X (consisting of subsets of X's effects) to 
+    Y, and caches the fits by the set of effects.
+    
+    With the numpy least squares fitter (``lsq=0``), a single QR 
+    decomposition of X.full is computed (``X.full = Q R``). The residual sum 
+    of squares of a submodel with the columns S is then computed from a QR 
+    decomposition of the small matrix ``R[:, S] = Q2 R2`` as 
+    ``||Y||**2 - ||Q2.T Q.T Y||**2``.
+    
+    """
+    def __init__(self, Y, X, lsq=0):
+        self.Y = Y
+        self.X = X
+        self.lsq = lsq
+        self._cache = {}
+        self._columns = {}
+        for e, (_, _, index, _) in zip(X.effects, X.iter_effects()):
+            self._columns[id(e)] = range(index.start, index.stop)
+        
+        if lsq == 0:
+            Q, R = sp.linalg.qr(X._full, mode='economic')
+            self._R = R
+            self._QtY = np.dot(Q.T, Y.x)
+            self._SS_Y = np.dot(Y.x, Y.x)
+            self._SS_total = np.sum((Y.x - Y.mu) ** 2)
+            d = np.abs(np.diag(R))
+            self._tol = d.max() * max(R.shape) * np.finfo(float).eps
+            self._full_rank = np.all(d > self._tol)
+    
+    def get(self, effects):
+        "returns an lm-like fit of the model consisting of ``effects``"
+        key = frozenset(id(e) for e in effects)
+        if key not in self._cache:
+            self._cache[key] = self._fit(effects)
+        return self._cache[key]
+    
+    def _fit(self, effects):
+        if self.lsq != 0:
+            return lm(self.Y, model(*effects), lsq=self.lsq)
+        
+        # columns of the submodel (including the intercept)
+        columns = [0]
+        for e in effects:
+            columns.extend(self._columns[id(e)])
+        if self._full_rank:
+            # R is upper triangular: rows below the last column are 0
+            n_rows = max(columns) + 1
+            R_S = self._R[:n_rows, columns]
+            QtY = self._QtY[:n_rows]
+            R2 = sp.linalg.qr(R_S, mode='r')[0][:len(columns)]
+            # Q2.T = R2^-T R_S.T
+            z = sp.linalg.solve_triangular(R2, np.dot(R_S.T, QtY), trans='T')
+        else:
+            R_S = self._R[:, columns]
+            Q2, R2, _ = sp.linalg.qr(R_S, mode='economic', pivoting=True)
+            rank = np.sum(np.abs(np.diag(R2)) > self._tol)
+            z = np.dot(Q2[:, :rank].T, self._QtY)
+        SS_res = max(0, self._SS_Y - np.dot(z, z))
+        df_model = sum(e.df for e in effects)
+        return _submodel_lm(SS_res, self._SS_total, self.Y.N, df_model)
+
+
+
 class _old_lm_(lm):
     def anova(self, title=None, empty=True, ems=None):
         """
@@ -440,91 +538,121 @@ class lm_fitter(object):
         X = asmodel(X)
         self.X = X
         # X inverse
-        X_ = X.full
-        self.Xinv = np.matrix(X_).I.A # alternative still used for map
+        X_ = X._full
+        self.Xinv = np.linalg.pinv(X_) # params x cases
         self.Xsinv = np.dot(np.matrix(np.dot(X_.T, X_)).I.A,
                             X_.T)
+        # projection matrices: for each effect, the SS explained by the 
+        # effect is params_e * (X_e.T * X_e) * params_e
+        self._effect_projections = []
+        for i, name, index, df in X.iter_effects():
+            X_e = X_[:,index]
+            self._effect_projections.append((name, index, df, np.dot(X_e.T, X_e)))
         # E MS
         self.E_ms = _hopkins_ems(X)
         self.df_res = X.df_error
-    def map(self, Y, v=False, sender=None, new=False):
+    def map(self, Y, v=False, sender=None, max_mem=None):
         """
         Returns results for multiple sets of dependents.
         
-        Input: np.array; Assumes that the last dimension of Y provides cases. 
-        Other than that, shape is free to vary and output shape will match input
-        shape.
+        Input: ndvar or np.array. For arrays, assumes that the last dimension
+        of Y provides cases. Other than that, shape is free to vary and output 
+        shape will match input shape. For an ndvar, the first dimension 
+        provides cases (as usual), and F and P are returned as ndvars with a 
+        single case.
+        
+        max_mem : int
+            Memory budget in bytes for intermediate results. Y is processed 
+            in chunks that do not exceed this budget (default is 
+            ``defaults['map_max_mem']``).
         
         Returns list with (name, F-field, P-field) tuples for all effects that 
         can be estimated with the current method.
         
         """
-        original_shape = Y.shape
-        assert original_shape[-1] == self.N, "last dimension must contain cases"
-        Y = Y.reshape((-1, self.N))
+        if isndvar(Y):
+            ndvar = Y
+            Y = Y.data
+            assert len(Y) == self.N, "ndvar needs to have one case per model case"
+            out_shape = Y.shape[1:]
+            Y = Y.reshape((self.N, -1))
+        else:
+            ndvar = None
+            out_shape = Y.shape[:-1]
+            assert Y.shape[-1] == self.N, "last dimension must contain cases"
+            Y = Y.reshape((-1, self.N)).T
+        
+        # determine chunk size
+        if max_mem is None:
+            max_mem = defaults['map_max_mem']
+        n_points = Y.shape[1]
+        n_params = self.Xinv.shape[0]
+        n_effects = len(self._effect_projections)
+        point_mem = 8 * (2 * self.N + 2 * n_params + n_effects + 1)
+        chunk_size = max(1, int(max_mem // point_mem))
         if v:
-            print Y.shape, self.Xinv.shape
-        # Split Y that are too long
-        df = self.Xinv.shape[0]
-        if np.log2(Y.shape[0] * df**2) > 26:
-            max_len = int(2**26 // df**2)
-            n_parts = Y.shape[0] // max_len + 1
-            logging.debug(" S.lm_fitter: Splitting Y in {0} parts".format(n_parts))
-            Y_list = [Y[i*max_len:(i+1)*max_len,:] for i in range(n_parts)]
-            out_maps = [self.map(Yi) for Yi in Y_list]
-            out_map = []
-            for i in range(len(out_maps[0])):
-                e = out_maps[0][i][0]
-                if v:
-                    print str([map[i][1].shape for map in out_maps])
-                F = np.hstack([map[i][1] for map in out_maps]).reshape(original_shape[:-1])
-                P = np.hstack([map[i][2] for map in out_maps]).reshape(original_shape[:-1])
-                out_map.append((e, F, P))
-            return out_map
+            print Y.shape, self.Xinv.shape, "chunk size:", chunk_size
+        
         # do the actual estimation
-        else:
-            if new:
-                raise NotImplementedError
+        X_ = self.X._full
+        SS = np.empty((n_effects, n_points))
+        if self.df_res > 0:
+            SS_res = np.empty(n_points)
+        for start in xrange(0, n_points, chunk_size):
+            stop = min(start + chunk_size, n_points)
+            Y_c = np.asarray(Y[:,start:stop], dtype=np.float64)
+            params = np.dot(self.Xinv, Y_c) # param x point
+            for i, (name, index, df, XtX) in enumerate(self._effect_projections):
+                params_e = params[index]
+                SS[i,start:stop] = np.sum(params_e * np.dot(XtX, params_e), 0)
+            if self.df_res > 0:
+                residuals = Y_c - np.dot(X_, params)
+                SS_res[start:stop] = np.sum(residuals ** 2, 0)
+        
+        # collect SS, df, MS
+        e_list = [] #<- (name, df, MS)
+        for i, (name, index, df, XtX) in enumerate(self._effect_projections):
+            e_list.append([name, df, SS[i] / df])
+        if self.df_res > 0:
+            MS_res = SS_res / self.df_res
+        
+        # F Tests
+        out_map = [] #<- (name, F, P)
+        for i, e in enumerate(e_list):
+            name, df_n, MS_n = e
+            E_ms = self.E_ms[i]
+            if E_ms != None:
+                df_d = e_list[E_ms][1]
+                MS_d = e_list[E_ms][2]
+            elif self.df_res > 0:
+                df_d = self.df_res
+                MS_d = MS_res
             else:
-                params = (Y[:,None,:] * self.Xinv).sum(2)
-                values = params[:,None,:] * self.X.full # c x param x effect-cd
-                # MS res
-                if self.df_res > 0:
-                    Yp = values.sum(2)
-                    SS_res = (Y - Yp)**2
-                    MS_res = SS_res / self.df_res
-                # collect SS, df, MS
-                i = 0
-                e_list = [] #<- (ss, df, ms)
-                for i, name, index, df in self.X.iter_effects():
-                    Yp = values[:,:,index].sum(2)
-                    SS = (Yp**2).sum(1)
-                    MS = SS / df
-                    e_list.append([name, df, MS])
-                # F Tests
-                out_map = [] #<- (name, F, P)
-                for i, e in enumerate(e_list):
-                    df_n = e[1]
-                    MS_n = e[2]
-                    E_ms = self.E_ms[i]
-                    if E_ms != None:
-                        df_d = e_list[E_ms][1]
-                        MS_d = e_list[E_ms][2]
-                    elif self.df_res > 0:
-                        df_d = self.df_res
-                        MS_d = MS_res
-                    else:
-                        df_d = 0
-                    #
-                    if df_d > 0:                        
-                        F = MS_n / MS_d
-                        P = 1 - sp.stats.distributions.f.cdf(F, df_n, df_d)
-                        out_map.append((e[0], F.reshape(original_shape[:-1]), 
-                                        P.reshape(original_shape[:-1])))
-                # append RESIDUALS to output
-                #if self.df_res > 0:
-                #    out_map.append
-                return out_map
+                df_d = 0
+            #
+            if df_d > 0:
+                F = MS_n / MS_d
+                P = sp.stats.distributions.f.sf(F, df_n, df_d)
+                if ndvar is None:
+                    F = F.reshape(out_shape)
+                    P = P.reshape(out_shape)
+                else:
+                    F, P = self._as_ndvars(ndvar, name, F, P, out_shape)
+                out_map.append((name, F, P))
+        return out_map
+    def _as_ndvars(self, ndvar, name, F, P, shape):
+        "package F and P maps as ndvars"
+        shape = (1,) + shape
+        info = "lm_fitter(%s): %s" % (self.X.name, name)
+        properties = ndvar.properties.copy()
+        properties['colorspace'] = _cs.get_default()
+        F = _ndvar(ndvar.dims, F.reshape(shape), properties=properties, 
+                   name='F(%s)' % name, info=info)
+        properties = ndvar.properties.copy()
+        properties['colorspace'] = _cs.Colorspace(contours=_p_contours)
+        P = _ndvar(ndvar.dims, P.reshape(shape), properties=properties, 
+                   name='p(%s)' % name, info=info)
+        return F, P
     def __repr__(self):
         txt = ''.join(['lm_fitter(', self.X.__repr__(), ')'])
         return txt
@@ -781,7 +909,6 @@ class anova(object):
         TODO
         ----
           - sort model
-          - reuse lms which are used repeatedly
           - provide threshold for including interaction effects when testing lower 
             level effects
         
@@ -829,6 +956,9 @@ class anova(object):
             self._log.append("\n (np lsq)")
         
     
+        # fits of submodels
+        lms = _lm_cache(Y, X, lsq=lsq)
+        
         # create testing table:  
         # list of (effect, lm, lm_comp, lm_EMS)
         test_table = []
@@ -839,7 +969,7 @@ class anova(object):
         
         if len(X.effects) == 1:
             self._log.append("single factor model")
-            lm0 = lm(Y, X, lsq=lsq)
+            lm0 = lms.get(X.effects)
             SS = lm0.SS_model
             df = lm0.df_model
             MS = lm0.MS_model
@@ -849,7 +979,7 @@ class anova(object):
                                   lm0.MS_res, None, None))
         else:
             if not rfx:
-                full_lm = lm(Y, X, lsq=lsq)
+                full_lm = lms.get(X.effects)
                 SS_e = full_lm.SS_res
                 MS_e = full_lm.MS_res
                 df_e = full_lm.df_res
@@ -876,13 +1006,13 @@ class anova(object):
                 if e_test.df > model0.df_error:
                     skip = "overspecified"
                 else:
-                    lm0 = lm(Y, model0, lsq=lsq)
+                    lm0 = lms.get(effects)
                     
                     # find model 1
                     effects.append(e_test)
-                    model1 = model(*effects)
-                    if model1.df_error > 0:
-                        lm1 = lm(Y, model1, lsq=lsq)
+                    model1_df = sum(e.df for e in effects)
+                    if model1_df < X.df_total:
+                        lm1 = lms.get(effects)
                     else:
                         lm1 = None
                     
@@ -896,7 +1026,7 @@ class anova(object):
                                 if all([(f in e or e.nestedin(f)) for f in e_test.factors]):
                                     EMS_effects.append(e)
                         if len(EMS_effects) > 0:
-                            lm_EMS = lm(Y, model(*EMS_effects), lsq=lsq)
+                            lm_EMS = lms.get(EMS_effects)
                             MS_e = lm_EMS.MS_model
                             df_e = lm_EMS.df_model
                         else:
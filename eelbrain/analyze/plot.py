@@ -17,7 +17,7 @@ from eelbrain import fmtxt as textab
 import test
 
 from eelbrain.vessels.data import isfactor, asfactor, isvar, asvar, ismodel, asmodel
-from eelbrain.vessels.data import _split_Y, multifactor
+from eelbrain.vessels.data import split_Y, multifactor
 from eelbrain.vessels.structure import celltable
 
 
@@ -317,7 +317,7 @@ def boxplot(Y, X=None, match=None, sub=None, datalabels=None,
         else:
             colors = defaults['c']['colors']
     # get data
-    data, _datalabels, names, within = _split_Y(Y, X, match=match, sub=sub)
+    data, _datalabels, names, within = split_Y(Y, X, match=match, sub=sub)
     # ylabel
     if ylabel is True:
         if hasattr(Y, 'name'):
@@ -1461,7 +1461,7 @@ def histogram(Y, X=None, match=None, sub=None,
     
     if ct.all_within:
         # TODO: use celltable
-        data, _datalabels, names, within = _split_Y(Y, X, match=match, sub=sub)
+        data, _datalabels, names, within = split_Y(Y, X, match=match, sub=sub)
     
         P.figure(figsize=(7, 7))
         P.subplots_adjust(hspace=.5)
@@ -201,7 +201,7 @@ def data(Y, X=None, match=None, cov=[], sub=None, fmt=None, labels=True,
     ynames = [] # names of Yi for independent measures table headers
     within_list = []
     for Yi in Y.effects:
-        _data, datalabels, names, _within = _data._split_Y(Yi, X, match=match, 
+        _data, datalabels, names, _within = _data.split_Y(Yi, X, match=match, 
                                                      sub=sub, datalabels=match)
         data += _data
         names_yname += ['({c})'.format(c=n) for n in names]
@@ -4,7 +4,7 @@ statistical tests for data objects
 """
 from __future__ import division
 
-import random, itertools
+import itertools
 
 import numpy as np
 import scipy as sp
@@ -13,11 +13,11 @@ from matplotlib import pyplot as P
 import eelbrain.fmtxt as textab
 
 from eelbrain.vessels.data import var, isvar, asvar, isfactor, asfactor, ismodel
-from eelbrain.vessels.data import _split_Y, multifactor
+from eelbrain.vessels.data import split_Y, multifactor
 from eelbrain.vessels.structure import celltable
 
 
-__hide__ = ['division', 'random', 'itertools', 'scipy',
+__hide__ = ['division', 'itertools', 'scipy',
             'textab', 'texstr',
             'var', 'isvar', 'asvar', 'isfactor', 'asfactor', 'ismodel', 'celltable',
             'multifactor', 
@@ -217,7 +217,7 @@ def star(p_list, out=str, levels=True, trend=False, corr='Hochberg',
 
 def oneway(Y, X, match=None, sub=None, par=True, title=None):
     "data: for should iter over groups/treatments"
-    data, datalabels, names, within = _split_Y(Y, X, match=match, sub=sub)
+    data, datalabels, names, within = split_Y(Y, X, match=match, sub=sub)
     test = _oneway(data, parametric=par, within=within)
     template = "{test}: {statistic}={value}{stars}, p={p}"
     out = template.format(**test)
@@ -380,7 +380,7 @@ def pairwise(Y, X, match=None, sub=None,            # data in
     """
 #    ct = celltable(Y, X, match=match, sub=sub)
     # test
-    data, datalabels, names, within = _split_Y(Y, X, match=match, sub=sub)
+    data, datalabels, names, within = split_Y(Y, X, match=match, sub=sub)
     test = _pairwise(data, within=within, parametric=par, corr=corr, #levels=levels, 
                      trend=trend)
     # extract test results
@@ -667,13 +667,13 @@ class bootstrap_pairwise(object):
                 match = match[sub]
             assert match.N==Y.N, "dataset length mismatch"
 
-        # prepare data container
-        resampled = np.empty((samples + 1, Y.N)) # sample X subject within category
-        resampled[0] = Y.x
-        # fill resampled
-        for i, Y_resampled in enumerate(_resample(Y, unit=match, samples=samples,
-                                                  replacement=replacement)):
-            resampled[i+1] = Y_resampled.x
+        # prepare data container (sample X subject within category); the
+        # first row contains the original data
+        index = np.empty((samples + 1, Y.N), dtype=np.intp)
+        index[0] = np.arange(Y.N)
+        index[1:] = resample_index(Y.N, unit=match, samples=samples, 
+                                   replacement=replacement)
+        resampled = Y.x[index]
         self.resampled = resampled
             
         X_cell_ids = sorted(X.cells.keys())
@@ -702,18 +702,18 @@ class bootstrap_pairwise(object):
                 ordered = resampled[:, T].mean(axis=2)
             self.ordered = ordered
             
-            # t-tests
-            n_comparisons = sum(range(n_groups))
-            t = np.empty((samples + 1, n_comparisons))
-            comp_names = []
+            # t-tests for all comparisons at once
             one_group = np.arange(group_size)
             groups = [one_group + i*group_size for i in range(n_groups)]
-            for i, (g1, g2) in enumerate(itertools.combinations(range(n_groups), 2)):
-                group_1 = groups[g1]
-                group_2 = groups[g2]
-                diffs = ordered[:, group_1] - ordered[:, group_2]
-                t[:,i] = np.mean(diffs, axis=1) * np.sqrt(group_size) / np.std(diffs, axis=1, ddof=1)
-                comp_names.append(' - '.join((group_names[g1], group_names[g2])))
+            pairs = list(itertools.combinations(range(n_groups), 2))
+            comp_names = [' - '.join((group_names[g1], group_names[g2])) 
+                          for g1, g2 in pairs]
+            g1, g2 = np.array(pairs, dtype=int).reshape((-1, 2)).T
+            by_group = ordered.reshape((samples + 1, n_groups, group_size))
+            # diffs: (samples + 1, comparison, match)
+            diffs = by_group[:, g1] - by_group[:, g2]
+            t = (np.mean(diffs, axis=2) * np.sqrt(group_size) / 
+                 np.std(diffs, axis=2, ddof=1))
             
             self.diffs = diffs
             self.t_resampled = np.max(np.abs(t[1:]), axis=1)
@@ -804,6 +804,55 @@ class bootstrap_pairwise(object):
 
 
 
+def resample_index(N, unit=None, replacement=True, samples=1000, rng=None):
+    """
+    Returns an index array of shape (samples, N) in which each row is an
+    index for resampling data with N cases.
+    
+    unit : None | factor
+        Unit of measurement (e.g. subject). If unit is specified, resampling 
+        proceeds by first resampling the categories of unit (with or without 
+        replacement) and then shuffling the values within units (no 
+        replacement). All categories of unit need to contain the same number
+        of cases.
+    replacement : bool
+        whether random samples should be drawn with replacement or without
+    samples : int
+        number of samples
+    rng : None | RandomState
+        random number generator (default: ``numpy.random``)
+    
+    """
+    if rng is None:
+        rng = np.random
+    
+    if unit:
+        assert unit.N == N, "dataset length mismatch"
+        _, codes = np.unique(unit.x, return_inverse=True)
+        counts = np.bincount(codes)
+        n_units = len(counts)
+        size = counts[0]
+        if np.any(counts != size):
+            err = ("Resampling by %r requires the same number of cases in "
+                   "each cell" % unit.name)
+            raise ValueError(err)
+        # unit_index: (unit, case) -> index into the data
+        unit_index = np.argsort(codes, kind='mergesort').reshape((n_units, size))
+        
+        if replacement:
+            source = rng.randint(n_units, size=(samples, n_units))
+        else:
+            source = np.argsort(rng.rand(samples, n_units), axis=1)
+        within = np.argsort(rng.rand(samples, n_units, size), axis=2)
+        out = np.empty((samples, N), dtype=np.intp)
+        out[:, unit_index.ravel()] = unit_index[source[:,:,None], within].reshape((samples, N))
+    elif replacement:
+        out = rng.randint(N, size=(samples, N))
+    else:
+        out = np.argsort(rng.rand(samples, N), axis=1)
+    return out
+
+
 def _resample(Y, unit=None, replacement=True, samples=1000):
     """
     Generator function to resample a dependent variable (Y) multiple times
@@ -816,49 +865,20 @@ def _resample(Y, unit=None, replacement=True, samples=1000):
                  without
     samples: number of samples to yield
     
+    The resampling indexes are generated in blocks with 
+    :func:`resample_index`.
+    
     """
     if isvar(Y):
         Yout = Y.copy('_resampled')
-        Y
     else:
         Y = var(Y)
         Yout = var(Y.copy(), name="Y resampled")
     
-    if unit:
-        ct = celltable(Y, unit)
-        unit_data = ct.get_data(out=list)
-        unit_indexes = ct.data_indexes.values()
-        x_out = Yout.x
-        
-        if replacement:
-            n = len(ct.indexes)
-            for sample in xrange(samples):
-                source_ids = np.random.randint(n, size=n)
-                for index, source_index in zip(unit_indexes, source_ids):
-                    data = unit_data[source_index]
-                    np.random.shuffle(data)
-                    x_out[index] = data
-                yield Yout
-            
-        else:
-            for sample in xrange(samples):
-                random.shuffle(unit_data)
-                for index, data in zip(unit_indexes, unit_data):
-                    np.random.shuffle(data)
-                    x_out[index] = data
-                yield Yout
-            
-    else:
-        if replacement:
-            N = Y.N
-            for i in xrange(samples):
-                index = np.random.randint(N)
-                Yout.x = Y.x[index]
-                yield Yout
-        else:
-            for i in xrange(samples):
-                np.random.shuffle(Yout.x)
-                yield Yout
-
-        
-        
\ No newline at end of file
+    block_size = max(1, min(samples, 2**20 // max(1, Y.N)))
+    for start in xrange(0, samples, block_size):
+        n = min(block_size, samples - start)
+        index = resample_index(Y.N, unit, replacement, n)
+        for i in xrange(n):
+            Yout.x = Y.x[index[i]]
+            yield Yout
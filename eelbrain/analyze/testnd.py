@@ -22,6 +22,8 @@ import scipy.stats
 
 from eelbrain import vessels as _vsl
 
+import _cluster
+
 
 
 class TestResults(_vsl.data.dataset):
@@ -31,11 +33,43 @@ class TestResults(_vsl.data.dataset):
 
 
 class ttest(_vsl.data.dataset):
-    def __init__(self, dataset, Y='MEG', X='condition', c1='c1', c2=0, match=None, contours=None):
+    def __init__(self, dataset, Y='MEG', X='condition', c1='c1', c2=0, match=None, contours=None,
+                 samples=0, pmin=.05, tmin=None, seed=0, tfce=False, n_workers=None):
         """
         c1 and c2 : ndvars (or dataset with default_DV)
             segments between which to perform the test
         
+        samples : int
+            Number of permutations for a spatio-temporal cluster permutation
+            test (0 to skip the cluster test). The results are stored in the 
+            ``'p_cluster'`` ndvar (the cluster p-value for each point, 1 
+            outside of clusters) and the ``clusters`` attribute (a dataset 
+            with one case per cluster).
+        
+        pmin : scalar
+            Cluster forming threshold as uncorrected p-value.
+        
+        tmin : scalar
+            Cluster forming threshold as t-value (overrides ``pmin``).
+        
+        seed : int
+            Seed for the random number generator (permutations are 
+            reproducible for a given seed).
+        
+        tfce : bool | dict
+            Use threshold-free cluster enhancement instead of the cluster 
+            mass statistic (a dict can provide arguments for :func:`tfce`). 
+            Adds the ``'TFCE'`` ndvar with the enhanced T map, and the 
+            ``'p_tfce'`` ndvar with the corrected p-value for each point.
+        
+        n_workers : None | int
+            Number of processes for computing the permutations (default is 
+            ``eelbrain.utils.parallel.defaults['n_workers']``). Parallel 
+            execution is opt-in: the default is 1 (permutations are computed
+            in the current process); set ``n_workers`` or the default to 
+            ``None`` to use one process per CPU. The result does not depend 
+            on the number of processes.
+        
         """
         if isinstance(Y, basestring):
             Y = dataset[Y]
@@ -61,13 +95,25 @@ class ttest(_vsl.data.dataset):
                 data2 = c2DV.data[index]            
                 T, P = scipy.stats.ttest_rel(c1DV.data, data2, axis=0)
                 test_name = 'Related Samples $t$-Test'
+                df = len(data2) - 1
+                if samples:
+                    perm_data = c1DV.data - data2
+                    n1 = None
             else:
                 T, P = scipy.stats.ttest_ind(c1DV.data, c2DV.data, axis=0)
                 test_name = 'Independent Samples $t$-Test'
+                df = len(c1DV) + len(c2DV) - 2
+                if samples:
+                    perm_data = np.concatenate((c1DV.data, c2DV.data))
+                    n1 = len(c1DV)
         elif np.isscalar(c2):
             data = [c1_mean]
             T, P = scipy.stats.ttest_1samp(c1DV.data, popmean=c2, axis=0)
             test_name = '1-Sample $t$-Test'
+            df = len(c1DV) - 1
+            if samples:
+                perm_data = c1DV.data - c2
+                n1 = None
             if c2:
                 diff = c1_mean - c2
             else:
@@ -93,10 +139,66 @@ class ttest(_vsl.data.dataset):
         T = _vsl.data.ndvar(dims, T, properties=properties, name='T', info=test_name)
         
         items = data + [diff, T, P]
+        
+        # permutation tests
+        if samples and tfce:
+            if tfce is True:
+                tfce = {}
+            n_points = T.data[0].size
+            edges = _cluster.connectivity(dims)
+            map_stat = _cluster.tfce(edges, n_points, **tfce)
+            perm_data = perm_data.reshape((len(perm_data), n_points))
+            dist = _cluster.permutation_distribution(perm_data, n1, map_stat, 
+                                                     samples, seed=seed,
+                                                     n_workers=n_workers)
+            
+            tfce_map = map_stat.transform(T.data[0].ravel())
+            p_map = np.mean(dist[:,None] >= np.abs(tfce_map), axis=0)
+            info = '%s, TFCE permutation test (%i samples)' % (test_name, samples)
+            properties['colorspace'] = _vsl.colorspaces.get_default()
+            TFCE = _vsl.data.ndvar(dims, tfce_map.reshape(T.data.shape), 
+                                   properties=properties, name='TFCE', info=info)
+            properties['colorspace'] = _vsl.colorspaces.Colorspace(contours=contours)
+            P_tfce = _vsl.data.ndvar(dims, p_map.reshape(T.data.shape), 
+                                     properties=properties, name='p_tfce', info=info)
+            items.extend((TFCE, P_tfce))
+            self.tfce_dist = dist
+            P_overlay = P_tfce
+        elif samples:
+            if tmin is None:
+                tmin = _cluster.t_threshold(pmin, df)
+            n_points = T.data[0].size
+            edges = _cluster.connectivity(dims)
+            map_stat = _cluster.cluster_mass(tmin, edges, n_points)
+            perm_data = perm_data.reshape((len(perm_data), n_points))
+            dist = _cluster.permutation_distribution(perm_data, n1, map_stat, 
+                                                     samples, seed=seed,
+                                                     n_workers=n_workers)
+            
+            labels, masses = map_stat.label(T.data[0].ravel())
+            cluster_p = np.mean(dist[:,None] >= np.abs(masses), axis=0)
+            
+            # p-value map
+            p_map = np.ones(n_points)
+            in_cluster = labels >= 0
+            p_map[in_cluster] = cluster_p[labels[in_cluster]]
+            p_map = p_map.reshape(T.data.shape)
+            properties['colorspace'] = _vsl.colorspaces.Colorspace(contours=contours)
+            info = '%s, cluster permutation test (%i samples)' % (test_name, samples)
+            P_cluster = _vsl.data.ndvar(dims, p_map, properties=properties, 
+                                        name='p_cluster', info=info)
+            items.append(P_cluster)
+            
+            self.clusters = _cluster_dataset(dims, labels, masses, cluster_p)
+            self.cluster_dist = dist
+            P_overlay = P_cluster
+        else:
+            P_overlay = P
+        
         _vsl.data.dataset.__init__(self, name=test_name, *items)
         
         self.data = data
-        self.diff = [[diff, P]]
+        self.diff = [[diff, P_overlay]]
         if np.isscalar(c2) and c2==0:
             self.all = self.diff
         else:
@@ -105,6 +207,70 @@ class ttest(_vsl.data.dataset):
 
 
 
+def tfce(Y, E=.5, H=2, dh=.1, name='TFCE({name})'):
+    """
+    Returns an ndvar with the threshold-free cluster enhancement (TFCE) of 
+    each case in ``Y`` (e.g., the ``'T'`` map from :class:`ttest`, or an F 
+    map from :meth:`glm.lm_fitter.map`). Neighborhoods are based on the 
+    ``Y``'s time and sensor dimensions.
+    
+    E, H : scalar
+        Extent and height exponents.
+    dh : scalar
+        Step size for the thresholds.
+    
+    """
+    n_points = Y.data[0].size
+    edges = _cluster.connectivity(Y.dims)
+    enhance = _cluster.tfce(edges, n_points, E=E, H=H, dh=dh)
+    data = np.empty(Y.data.shape)
+    for case, case_data in zip(data, Y.data):
+        case[:] = enhance.transform(case_data.ravel()).reshape(case.shape)
+    
+    name = name.format(name=Y.name)
+    info = Y.info + ".tfce(E=%s, H=%s, dh=%s)" % (E, H, dh)
+    properties = Y.properties.copy()
+    properties['colorspace'] = _vsl.colorspaces.get_default()
+    return _vsl.data.ndvar(Y.dims, data, properties=properties, name=name, 
+                           info=info)
+
+
+
+def _cluster_dataset(dims, labels, masses, p):
+    """
+    Returns a dataset with one case per cluster, describing the clusters' 
+    mass, p-value and extent.
+    
+    """
+    shape = tuple(len(dim) for dim in dims)
+    items = [_vsl.data.var(masses, name='mass'), 
+             _vsl.data.var(p, name='p')]
+    
+    in_cluster = labels >= 0
+    cluster_ids = labels[in_cluster]
+    point_index = np.unravel_index(np.flatnonzero(in_cluster), shape)
+    n = len(masses)
+    for dim, index in zip(dims, point_index):
+        if dim.name == 'time':
+            t = dim.x[index]
+            tstart = np.empty(n)
+            tstart.fill(np.inf)
+            np.minimum.at(tstart, cluster_ids, t)
+            tstop = np.empty(n)
+            tstop.fill(-np.inf)
+            np.maximum.at(tstop, cluster_ids, t)
+            items.append(_vsl.data.var(tstart, name='tstart'))
+            items.append(_vsl.data.var(tstop, name='tstop'))
+        elif dim.name == 'sensor':
+            # count distinct sensors per cluster
+            pairs = np.unique(cluster_ids * len(dim) + index)
+            n_sensors = np.bincount(pairs // len(dim), minlength=n)
+            items.append(_vsl.data.var(n_sensors, name='n_sensors'))
+    
+    return _vsl.data.dataset(name='clusters', *items)
+
+
+
 class old_ttest(TestResults):
     def __init__(self, c1, c2=0, match=None, contours=None):
         """
@@ -161,17 +327,178 @@ class old_ttest(TestResults):
 
 
 
+def _rankdata(a):
+    """
+    Ranks the data in ``a`` along the first axis (all columns at once). 
+    Tied values receive their average rank (like :func:`scipy.stats.rankdata`). 
+    
+    Returns
+    -------
+    ranks : array, shape = a.shape
+        ranks (1-based).
+    ties : array, shape = a.shape[1:]
+        sum of ``t**3 - t`` over all groups of ``t`` tied values, for the 
+        tie correction of rank statistics.
+    
+    """
+    a = np.asarray(a)
+    shape = a.shape
+    n = shape[0]
+    a = a.reshape((n, -1))
+    m = a.shape[1]
+    
+    order = np.argsort(a, axis=0, kind='mergesort')
+    columns = np.arange(m)
+    # sorted values with one column per row
+    a_sorted = a[order, columns].T
+    
+    # groups of tied values
+    start = np.ones((m, n), dtype=bool)
+    start[:,1:] = a_sorted[:,1:] != a_sorted[:,:-1]
+    start = start.ravel()
+    group = np.cumsum(start) - 1
+    first = np.tile(np.arange(n), m)[start]
+    counts = np.bincount(group)
+    avg_rank = first + (counts + 1) / 2.
+    
+    ranks = np.empty((n, m))
+    ranks[order, columns] = avg_rank[group].reshape((m, n)).T
+    
+    group_column = np.repeat(columns, n)[start]
+    ties = np.bincount(group_column, weights=counts ** 3 - counts, minlength=m)
+    return ranks.reshape(shape), ties.reshape(shape[1:])
+
+
+def _wilcoxon(diff):
+    """
+    Wilcoxon signed-rank test along the first axis of ``diff``, using the 
+    normal approximation (zero differences are discarded). Returns z 
+    (positive if the positive differences dominate) and the two-tailed p.
+    
+    """
+    is_zero = (diff == 0)
+    n_zero = is_zero.sum(0)
+    # zeros are ranked below all other values
+    ranks, ties = _rankdata(np.where(is_zero, -1, np.abs(diff)))
+    ranks -= n_zero
+    ties -= n_zero ** 3 - n_zero
+    
+    n = diff.shape[0] - n_zero
+    r_plus = np.sum(ranks * (diff > 0), axis=0)
+    mean = n * (n + 1) / 4.
+    var = n * (n + 1) * (2 * n + 1) / 24. - ties / 48.
+    z = (r_plus - mean) / np.sqrt(var)
+    p = 2 * scipy.stats.norm.sf(np.abs(z))
+    return z, p
+
+
+def _mannwhitney(data1, data2):
+    """
+    Mann-Whitney U test along the first axis, using the normal approximation 
+    with tie correction. Returns z (positive if ``data1`` tends to be larger) 
+    and the two-tailed p.
+    
+    """
+    n1 = len(data1)
+    n2 = len(data2)
+    n = n1 + n2
+    ranks, ties = _rankdata(np.concatenate((data1, data2)))
+    u1 = ranks[:n1].sum(0) - n1 * (n1 + 1) / 2.
+    mean = n1 * n2 / 2.
+    var = n1 * n2 / 12. * ((n + 1) - ties / (n * (n - 1.)))
+    z = (u1 - mean) / np.sqrt(var)
+    p = 2 * scipy.stats.norm.sf(np.abs(z))
+    return z, p
+
+
+def _friedman(data):
+    """
+    Friedman test for related samples; ``data`` is a list of k arrays with 
+    the same shape, cases on the first axis. Returns chi**2 and p.
+    
+    """
+    k = len(data)
+    n = len(data[0])
+    ranks, ties = _rankdata(np.array(data))
+    R = ranks.sum(1)
+    chi2 = 12. / (n * k * (k + 1)) * np.sum(R ** 2, 0) - 3 * n * (k + 1)
+    chi2 /= 1 - ties.sum(0) / (n * k * (k ** 2 - 1.))
+    p = scipy.stats.chi2.sf(chi2, k - 1)
+    return chi2, p
+
+
+def _kruskal(data):
+    """
+    Kruskal-Wallis H test for independent samples; ``data`` is a list of 
+    arrays with cases on the first axis. Returns H and p.
+    
+    """
+    k = len(data)
+    n_j = [len(d) for d in data]
+    n = sum(n_j)
+    ranks, ties = _rankdata(np.concatenate(data))
+    H = 0
+    i = 0
+    for n_i in n_j:
+        H = H + ranks[i:i+n_i].sum(0) ** 2 / n_i
+        i += n_i
+    H = 12. / (n * (n + 1)) * H - 3 * (n + 1)
+    H /= 1 - ties / (n ** 3 - n)
+    p = scipy.stats.chi2.sf(H, k - 1)
+    return H, p
+
+
+def _match_index(match):
+    "index sorting the cases of each ndvar by the values of its match variable"
+    values = []
+    for m in match:
+        if _vsl.data.isfactor(m):
+            v = np.array([m.cells[c] for c in m.x])
+        else:
+            v = np.asarray(m.x)
+        values.append(v)
+    
+    index = []
+    v0 = None
+    for v in values:
+        i = np.argsort(v, kind='mergesort')
+        v = v[i]
+        if v0 is None:
+            v0 = v
+            if len(np.unique(v0)) < len(v0):
+                raise ValueError("match contains duplicate values")
+        elif not np.array_equal(v, v0):
+            raise ValueError("match values differ between ndvars")
+        index.append(i)
+    return index
+
+
 def test(ndvars, parametric=True, match=None, func=None, attr='data',
          name="{test}"):
     """
+    Mass-univariate test comparing several ndvars at each point (e.g., time 
+    x sensor). Returns ``(stat, P)``: two ndvars with one case each, 
+    containing the test statistic and ``(1 - p)`` (signed by the direction 
+    of the effect for one and two samples).
+    
+    ndvars : list of ndvars
+        one ndvar (test against 0) or several ndvars to compare.
+    parametric : bool
+        Parametric tests (t-tests) or rank-based tests: Wilcoxon signed-rank 
+        (one sample or two related samples), Mann-Whitney U (two independent 
+        samples), Friedman (more than two related samples) and 
+        Kruskal-Wallis (more than two independent samples). Rank tests use 
+        the normal (or chi**2) approximation with tie correction.
+    match : None | True | list of factors
+        Samples are related. With True, the cases in each ndvar correspond 
+        in order; with a list of factors (one for each ndvar), cases are 
+        aligned by their values (e.g., subject).
+    
     use func (func) or attr (str) to customize data
     (func=abs for )
     
     """
-    if match is None:
-        related = False
-    else:
-        raise NotImplementedError
+    related = bool(match)
     
     v0 = ndvars[0]
     
@@ -185,11 +512,17 @@ def test(ndvars, parametric=True, match=None, func=None, attr='data',
     if k == 0:
         raise ValueError("no segments provided")
     
+    if related and (match is not True):
+        if len(match) != k:
+            raise ValueError("Need one match variable per ndvar")
+        index = _match_index(match)
+        data = [d[i] for d, i in zip(data, index)]
+    
     # perform test
     if parametric: # simple tests
         if k==1:
             statistic = 't'
-            T, P = scipy.stats.ttest_1samp(*data, popmean=0, axis=0)
+            T, P = scipy.stats.ttest_1samp(data[0], popmean=0, axis=0)
             test_name = '1-Sample $t$-Test'
         elif k==2:
             statistic = 't'
@@ -204,43 +537,27 @@ def test(ndvars, parametric=True, match=None, func=None, attr='data',
             raise NotImplementedError("Use segframe for 1-way ANOVA")
 
     else: # non-parametric:
-        raise NotImplementedError("axis from -1 to 0")
-        if k <= 2:
+        if k == 1:
+            statistic = 'z'
+            T, P = _wilcoxon(data[0])
+            test_name = 'Wilcoxon'
+        elif k == 2:
+            statistic = 'z'
             if related:
-                test_func = scipy.stats.wilcoxon
-                statistic = 't'
+                T, P = _wilcoxon(data[0] - data[1])
                 test_name = 'Wilcoxon'
             else:
-                raise NotImplementedError()
+                T, P = _mannwhitney(*data)
+                test_name = 'Mann-Whitney'
         else:
             if related:
-                test_func = scipy.stats.friedmanchisquare
+                T, P = _friedman(data)
                 statistic = 'Chi**2'
                 test_name = 'Friedman'
             else:
-                raise NotImplementedError()
-        
-        shape = data[0].shape[:-1]
-        # function to apply stat test to array
-        def testField(*args):
-            """
-            will be executed for a grid, args will contain coordinates of shape
-            assumes that subjects are on last axis
-            
-            """
-            rargs = [np.ravel(a) for a in args]
-            T = []
-            P = []
-            for indexes in zip(*rargs):
-                index = tuple( [slice(int(i),int(i+1)) for i in indexes] + [slice(0, None)] )
-                testArgs = tuple( [ d[index].ravel() for d in data] )
-                t, p = test_func(*testArgs)
-                T.append(t)
-                P.append(p)
-            P = np.array(P).reshape(args[0].shape)
-            T = np.array(T).reshape(args[0].shape)
-            return T, P
-        T, P = np.fromfunction(testField, shape)
+                T, P = _kruskal(data)
+                statistic = 'H'
+                test_name = 'Kruskal-Wallis'
     
     # Direction of the effect
     if len(data) == 2:
@@ -261,7 +578,7 @@ def test(ndvars, parametric=True, match=None, func=None, attr='data',
     
     # create test_segment
     name_fmt = name.format(**properties)
-    stat = _vsl.data.epoch(v0.dims, T, properties=properties, name=name_fmt)
+    stat = _vsl.data.ndvar(v0.dims, T[None], properties=properties, name=name_fmt)
     name_fmt = 'P'
-    P = _vsl.data.epoch(v0.dims, P, properties=properties, name=name_fmt)
+    P = _vsl.data.ndvar(v0.dims, P[None], properties=properties, name=name_fmt)
     return stat, P
@@ -0,0 +1,7 @@
+'''
+Behavior tests for the numerical kernels, comparing them with simple 
+reference implementations. Run with::
+
+    $ python -m unittest discover eelbrain/tests
+
+'''
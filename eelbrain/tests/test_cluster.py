@@ -0,0 +1,265 @@
+'''
+Tests for the cluster permutation test (:mod:`eelbrain.analyze._cluster`),
+comparing the sparse-graph kernels with a brute-force flood fill.
+
+'''
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+import scipy.stats
+
+from eelbrain.vessels import data as _data
+from eelbrain.vessels import sensors
+from eelbrain.analyze import _cluster
+from eelbrain.analyze import testnd
+
+
+def _neighbors(edges, n_points):
+    "list with the set of neighbors of each point"
+    out = [set() for _ in xrange(n_points)]
+    for i, j in edges:
+        out[i].add(j)
+        out[j].add(i)
+    return out
+
+
+def _flood_fill(active, neighbors):
+    "list of clusters (sorted arrays of point indexes) of the active points"
+    clusters = []
+    done = np.zeros(len(active), dtype=bool)
+    for start in np.flatnonzero(active):
+        if done[start]:
+            continue
+        cluster = []
+        stack = [start]
+        done[start] = True
+        while stack:
+            i = stack.pop()
+            cluster.append(i)
+            for j in neighbors[i]:
+                if active[j] and not done[j]:
+                    done[j] = True
+                    stack.append(j)
+        clusters.append(np.sort(cluster))
+    return clusters
+
+
+def _dims(n_times=12, n_sensors=15, seed=0):
+    rng = np.random.RandomState(seed)
+    locs = rng.randn(n_sensors, 3)
+    locs[:,2] = np.abs(locs[:,2])
+    net = sensors.sensor_net([tuple(loc) + ('s%i' % i,) for i, loc in 
+                              enumerate(locs)])
+    time = _data.var(np.arange(n_times) / 100., 'time')
+    return (time, net)
+
+
+def _smooth_map(shape, seed=0):
+    "random statistic map with extended positive and negative regions"
+    rng = np.random.RandomState(seed)
+    x = rng.randn(shape[0] + 2, *shape[1:])
+    return x[:-2] + x[1:-1] + x[2:]
+
+
+
+class TestConnectivity(unittest.TestCase):
+    def test_time_sensor(self):
+        dims = _dims()
+        n_times = len(dims[0])
+        n_sensors = len(dims[1])
+        edges = _cluster.connectivity(dims)
+        
+        ref = set()
+        for t in xrange(n_times - 1):
+            for s in xrange(n_sensors):
+                ref.add((t * n_sensors + s, (t + 1) * n_sensors + s))
+        for t in xrange(n_times):
+            for s1, s2 in dims[1].connectivity():
+                ref.add((t * n_sensors + s1, t * n_sensors + s2))
+        
+        self.assertEqual(set(map(tuple, edges.tolist())), ref)
+
+
+
+class TestClusterMass(unittest.TestCase):
+    def setUp(self):
+        self.dims = _dims(14)
+        self.edges = _cluster.connectivity(self.dims)
+        self.stat_map = _smooth_map((14, 15)).ravel()
+        self.n_points = len(self.stat_map)
+    
+    def test_label(self):
+        threshold = 1.5
+        cm = _cluster.cluster_mass(threshold, self.edges, self.n_points)
+        labels, masses = cm.label(self.stat_map)
+        
+        # reference: positive and negative clusters separately
+        neighbors = _neighbors(self.edges, self.n_points)
+        ref = _flood_fill(self.stat_map > threshold, neighbors)
+        ref += _flood_fill(self.stat_map < -threshold, neighbors)
+        self.assertTrue(len(ref) > 2)
+        self.assertEqual(len(masses), len(ref))
+        
+        clusters = dict((tuple(np.flatnonzero(labels == i)), masses[i]) 
+                        for i in xrange(len(masses)))
+        for cluster in ref:
+            mass = clusters[tuple(cluster)]
+            assert_allclose(mass, self.stat_map[cluster].sum())
+        
+        outside = np.abs(self.stat_map) <= threshold
+        self.assertTrue(np.all(labels[outside] == -1))
+        assert_allclose(cm(self.stat_map), np.max(np.abs(masses)))
+    
+    def test_no_cluster(self):
+        cm = _cluster.cluster_mass(100, self.edges, self.n_points)
+        labels, masses = cm.label(self.stat_map)
+        self.assertTrue(np.all(labels == -1))
+        self.assertEqual(len(masses), 0)
+        self.assertEqual(cm(self.stat_map), 0)
+
+
+
+class TestTFCE(unittest.TestCase):
+    def setUp(self):
+        self.dims = _dims(14)
+        self.edges = _cluster.connectivity(self.dims)
+        self.stat_map = 2 * _smooth_map((14, 15)).ravel()
+        self.n_points = len(self.stat_map)
+    
+    def _reference(self, x, E, H, dh):
+        "TFCE of the positive part of x, one threshold at a time"
+        neighbors = _neighbors(self.edges, self.n_points)
+        out = np.zeros(self.n_points)
+        h = dh
+        while h <= x.max():
+            for cluster in _flood_fill(x >= h, neighbors):
+                out[cluster] += len(cluster) ** E * h ** H * dh
+            h += dh
+        return out
+    
+    def test_transform(self):
+        for E, H, dh in ((.5, 2, .1), (1, 1, .25)):
+            enhance = _cluster.tfce(self.edges, self.n_points, E, H, dh)
+            x = self.stat_map
+            ref = self._reference(x, E, H, dh) - self._reference(-x, E, H, dh)
+            assert_allclose(enhance.transform(x), ref)
+            assert_allclose(enhance(x), np.max(np.abs(ref)))
+    
+    def test_blocks(self):
+        "splitting the thresholds into blocks does not change the result"
+        enhance = _cluster.tfce(self.edges, self.n_points)
+        ref = enhance.transform(self.stat_map)
+        batch_bytes = _cluster._batch_bytes
+        try:
+            _cluster._batch_bytes = 32 * 3 * (len(self.edges) + self.n_points)
+            assert_allclose(enhance.transform(self.stat_map), ref)
+        finally:
+            _cluster._batch_bytes = batch_bytes
+    
+    def test_ndvar(self):
+        data = self.stat_map.reshape((1, 14, 15))
+        Y = _data.ndvar(self.dims, data, name='T')
+        T = testnd.tfce(Y)
+        enhance = _cluster.tfce(self.edges, self.n_points)
+        assert_allclose(T.data[0].ravel(), enhance.transform(self.stat_map))
+
+
+
+class TestTValues(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.data = rng.randn(20, 50) + .3
+        self.rng = rng
+    
+    def test_1samp(self):
+        signs = self.rng.randint(2, size=(5, 20)) * 2 - 1
+        t = _cluster._t_1samp(self.data, signs)
+        for t_perm, s in zip(t, signs):
+            ref = scipy.stats.ttest_1samp(self.data * s[:,None], 0)[0]
+            assert_allclose(t_perm, ref)
+    
+    def test_ind(self):
+        group_1 = np.array([self.rng.permutation(20) < 8 for _ in xrange(5)])
+        t = _cluster._t_ind(self.data, group_1, 8)
+        for t_perm, g in zip(t, group_1):
+            ref = scipy.stats.ttest_ind(self.data[g], self.data[~g])[0]
+            assert_allclose(t_perm, ref)
+
+
+
+class TestTTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.dims = dims = _dims(10, 15)
+        x = rng.randn(30, 10, 15)
+        x[:15, 3:7, :6] += 1.5
+        Y = _data.ndvar(dims, x, name='MEG')
+        cond = _data.factor(['a'] * 15 + ['b'] * 15, name='condition')
+        self.ds = _data.dataset(Y, cond)
+    
+    def test_clusters(self):
+        "cluster masses and p-values of ttest correspond to its T map"
+        res = testnd.ttest(self.ds, 'MEG', 'condition', 'a', 'b', 
+                           samples=50, tmin=2)
+        T = res['T'].data[0].ravel()
+        edges = _cluster.connectivity(self.dims)
+        neighbors = _neighbors(edges, len(T))
+        ref = _flood_fill(T > 2, neighbors) + _flood_fill(T < -2, neighbors)
+        ref_masses = sorted(T[c].sum() for c in ref)
+        assert_allclose(sorted(res.clusters['mass'].x), ref_masses)
+        
+        # p-values from the permutation distribution
+        p_map = res['p_cluster'].data[0].ravel()
+        for cluster in ref:
+            mass = T[cluster].sum()
+            p = np.mean(res.cluster_dist >= abs(mass))
+            assert_allclose(p_map[cluster], p)
+        self.assertTrue(np.all(p_map[np.abs(T) <= 2] == 1))
+    
+    def test_seed(self):
+        "permutations are reproducible"
+        kwargs = dict(samples=20, tmin=2, seed=3)
+        res1 = testnd.ttest(self.ds, 'MEG', 'condition', 'a', 'b', **kwargs)
+        res2 = testnd.ttest(self.ds, 'MEG', 'condition', 'a', 'b', **kwargs)
+        self.assertTrue(np.array_equal(res1.cluster_dist, res2.cluster_dist))
+    
+    def test_tfce(self):
+        "TFCE p-values correspond to the TFCE map and distribution"
+        res = testnd.ttest(self.ds, 'MEG', 'condition', 'a', 'b', samples=20,
+                           tfce=True)
+        tfce_map = res['TFCE'].data.ravel()
+        p_ref = np.mean(res.tfce_dist[:,None] >= np.abs(tfce_map), axis=0)
+        assert_allclose(res['p_tfce'].data.ravel(), p_ref)
+        assert_allclose(res['TFCE'].data, testnd.tfce(res['T']).data)
+    
+    def test_n_workers(self):
+        "results do not depend on the number of processes"
+        for tfce in (False, True):
+            kwargs = dict(samples=250, tmin=2, seed=5, tfce=tfce)
+            results = [testnd.ttest(self.ds, 'MEG', 'condition', 'a', 'b', 
+                                    n_workers=n_workers, **kwargs)
+                       for n_workers in (1, 2, 3)]
+            if tfce:
+                dist, p = 'tfce_dist', 'p_tfce'
+            else:
+                dist, p = 'cluster_dist', 'p_cluster'
+            ref = results[0]
+            for res in results[1:]:
+                self.assertTrue(np.array_equal(getattr(res, dist), 
+                                               getattr(ref, dist)))
+                self.assertTrue(np.array_equal(res[p].data, ref[p].data))
+    
+    def test_batches(self):
+        for n_samples, n_points in ((1000, 10), (250, 150), (7, 10), 
+                                    (5, 2 ** 26)):
+            batches = _cluster.permutation_batches(n_samples, n_points)
+            self.assertEqual(sum(batches), n_samples)
+            max_size = max(1, min(_cluster._batch_max, 
+                                  _cluster._batch_bytes // (8 * n_points)))
+            self.assertEqual(max(batches), min(max_size, n_samples))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,1111 @@
+'''
+Tests for the data containers in :mod:`eelbrain.vessels.data`, comparing
+cached and vectorized implementations with straightforward references.
+
+'''
+import cPickle as pickle
+import operator
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+import scipy.signal
+
+from eelbrain.vessels import data as _data
+from eelbrain.vessels import sensors
+from eelbrain.analyze import glm
+
+
+
+def _count_builds(m):
+    "count the design matrix builds of model m in m.n_builds"
+    m.n_builds = 0
+    make_full = m._make_full
+    def counting_make_full():
+        m.n_builds += 1
+        return make_full()
+    m._make_full = counting_make_full
+    return m
+
+
+class TestModelCache(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.A = _data.factor('abc', rep=4, chain=2, name='A')
+        self.B = _data.factor('xy', rep=2, chain=6, name='B')
+        self.v = _data.var(rng.randn(24), name='v')
+        self.Y = _data.var(rng.randn(24), name='Y')
+
+    def _model(self):
+        "model with a counter of the design matrix builds"
+        return _count_builds(self.A + self.B + self.A % self.B + self.v)
+
+    def _reference(self, m):
+        "design matrix built from the current codes of the effects"
+        codes = [np.ones((m.N, 1))] + [e.as_effects for e in m.effects]
+        return np.hstack(codes)
+
+    def test_hits(self):
+        for m in (self._model(), _count_builds(_data.model(self.v)),
+                  _count_builds(_data.model(self.A))):
+            ref = self._reference(m)
+            for _ in xrange(5):
+                assert_allclose(m.full, ref)
+                assert_allclose(m.as_effects, ref[:,1:])
+            self.assertTrue(m._full is m._full)
+            self.assertEqual(m.n_builds, 1)
+            # internal users get the cached read-only array
+            self.assertFalse(m._full.flags.writeable)
+            # the public properties return writable copies
+            full = m.full
+            full[:] = 0
+            assert_allclose(m.full, ref)
+
+    def test_invalidation(self):
+        m = self._model()
+        full = m._full
+        # in-place change of a var
+        self.v.x[0] += 1
+        assert_allclose(m.full, self._reference(m))
+        self.assertEqual(m.n_builds, 2)
+        # in-place change of a factor through __setitem__ and through x
+        self.A[0] = 'b'
+        assert_allclose(m.full, self._reference(m))
+        self.assertEqual(m.n_builds, 3)
+        self.B.x[5] = 1 - self.B.x[5]
+        assert_allclose(m.full, self._reference(m))
+        self.assertEqual(m.n_builds, 4)
+        self.assertFalse(np.all(full == m._full))
+        # a change in the effects list
+        m.effects = m.effects[:2]
+        m.df = sum(e.df for e in m.effects)
+        self.assertEqual(m._full.shape, (24, m.df + 1))
+        self.assertEqual(m.n_builds, 5)
+
+    def test_sparse(self):
+        m = self._model()
+        assert_allclose(m.full_sparse.toarray(), m.full)
+        self.B[1] = 'x'
+        assert_allclose(m.full_sparse.toarray(), self._reference(m))
+
+    def test_lm(self):
+        "fits use the current values of the model"
+        m = self._model()
+        glm.lm(self.Y, m)
+        self.v.x[:4] = 0
+        fit = glm.lm(self.Y, m)
+        ref = glm.lm(self.Y, self.A + self.B + self.A % self.B + self.v)
+        assert_allclose(fit.SS_res, ref.SS_res)
+        assert_allclose(fit.beta, ref.beta)
+
+
+
+class TestCellMasks(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.f = _data.factor(rng.randint(0, 3, 30), name='f',
+                              labels={0: 'a', 1: 'b', 2: 'c'})
+        self.y = _data.var(rng.randn(30), name='y')
+
+    def _check(self, f):
+        "masks correspond to the current codes"
+        masks = f._cell_masks()
+        self.assertEqual(sorted(masks), np.unique(f.x).tolist())
+        for code, mask in masks.iteritems():
+            self.assertTrue(np.array_equal(mask, f.x == code))
+            self.assertFalse(mask.flags.writeable)
+        return masks
+
+    def test_cache(self):
+        masks = self._check(self.f)
+        # cache hit
+        masks_2 = self.f._cell_masks()
+        for code in masks:
+            self.assertTrue(masks_2[code] is masks[code])
+        # comparisons return new, writable arrays
+        index = self.f == 'a'
+        self.assertFalse(index is masks[0])
+        index[:] = False
+        self._check(self.f)
+
+    def test_invalidation(self):
+        masks = self._check(self.f)
+        mask_a = masks[0].copy()
+        # in-place change of f.x
+        i = np.flatnonzero(self.f.x == 0)[0]
+        self.f.x[i] = 1
+        masks = self._check(self.f)
+        self.assertFalse(masks[0][i])
+        self.assertTrue(masks[1][i])
+        self.assertEqual(masks[0].sum(), mask_a.sum() - 1)
+        # change through __setitem__, including a new cell
+        self.f[:3] = 'c'
+        self._check(self.f)
+        self.f[3] = 'd'
+        masks = self._check(self.f)
+        self.assertEqual(np.flatnonzero(masks[3]).tolist(), [3])
+        # replacing f.x
+        self.f.x = self.f.x[::-1].copy()
+        self._check(self.f)
+
+    def test_get_subsets_by(self):
+        for columnar in (False, True):
+            f = _data.factor(self.f.x.copy(), name='f', 
+                             labels=self.f.cells.copy())
+            ds = _data.dataset(self.y, f, columnar=columnar)
+            for _ in xrange(2):
+                subsets = ds.get_subsets_by('f', exclude=['c'])
+                self.assertEqual(sorted(subsets), ['a', 'b'])
+                for label, sub in subsets.iteritems():
+                    index = f.x == f._interpret_y(label)
+                    assert_allclose(sub['y'].x, self.y.x[index])
+                    self.assertEqual(sub.name, '%s[%s]' % (ds.name, label))
+                # after an in-place change
+                f.x[:5] = 1
+            # a cell without cases
+            f.cells[5] = 'e'
+            subsets = ds.get_subsets_by('f')
+            self.assertEqual(subsets['e'].N, 0)
+
+
+
+def _factor_reference(x, sort=False, labels={}):
+    """
+    codes and cells assigned one category at a time: categories in sorted 
+    order, or in order of first occurrence with ``sort=True``
+    
+    """
+    x = list(x)
+    categories = sorted(set(x))
+    if sort:
+        categories.sort(key=x.index)
+    codes = [categories.index(v) for v in x]
+    cells = dict((i, labels.get(cat, str(cat))) 
+                 for i, cat in enumerate(categories))
+    return codes, cells
+
+
+def _codes_reference(x):
+    "effect and dummy codes built one category at a time"
+    categories = sorted(set(x))
+    effects = np.empty((len(x), len(categories) - 1), dtype=int)
+    dummy = np.empty((len(x), len(categories) - 1), dtype=int)
+    for i, cat in enumerate(categories[:-1]):
+        dummy[:,i] = (x == cat)
+        effects[:,i] = (x == cat).astype(int) - (x == categories[-1])
+    return effects, dummy
+
+
+class TestFactorCodes(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.x = rng.choice(['d', 'b', 'c', 'a'], 40)
+        self.y = rng.randint(5, 8, 40)
+        self.z = rng.choice(['u', 'v'], 40)
+
+    def test_factor(self):
+        labels = {'a': 'A', 'c': 'C'}
+        for sort in (False, True):
+            f = _data.factor(self.x, labels=labels, sort=sort)
+            codes, cells = _factor_reference(self.x, sort, labels)
+            self.assertEqual(f.x.tolist(), codes)
+            self.assertEqual(f.cells, cells)
+            self.assertEqual(f.df, 3)
+            self.assertEqual(f.indexes, sorted(cells))
+        # numerical values, rep and chain
+        f = _data.factor(self.y, rep=2, chain=3)
+        codes, cells = _factor_reference(np.tile(self.y.repeat(2), 3))
+        self.assertEqual(f.x.tolist(), codes)
+        self.assertEqual(f.cells, cells)
+        # retained codes
+        f = _data.factor(self.y, labels={5: 'a', 6: 'b', 7: 'c'},
+                         retain_label_codes=True)
+        self.assertEqual(f.x.tolist(), self.y.tolist())
+        self.assertEqual(f.cells, {5: 'a', 6: 'b', 7: 'c'})
+
+    def test_effect_codes(self):
+        f = _data.factor(self.x)
+        effects, dummy = _codes_reference(f.x)
+        self.assertTrue(np.array_equal(f.as_effects, effects))
+        self.assertTrue(np.array_equal(f.as_dummy, dummy))
+        self.assertTrue(f.as_effects is f.as_effects)
+        # after a change through __setitem__
+        f[f.x == 3] = 'a'
+        self.assertEqual(f.df, 2)
+        effects, dummy = _codes_reference(f.x)
+        self.assertTrue(np.array_equal(f.as_effects, effects))
+        self.assertTrue(np.array_equal(f.as_dummy, dummy))
+        
+        # interaction effects: products of all pairs of columns
+        f1 = _data.factor(self.x)
+        f2 = _data.factor(self.z)
+        i = f1 % f2
+        ref = np.hstack([f1.as_effects[:,[k]] * f2.as_effects 
+                         for k in xrange(f1.df)])
+        self.assertTrue(np.array_equal(i.as_effects, ref))
+        self.assertEqual(i.as_effects.shape, (40, i.df))
+        i3 = f1 % f2 % _data.factor(self.y)
+        ref = np.hstack([ref[:,[k]] * i3.base[2].as_effects 
+                         for k in xrange(ref.shape[1])])
+        self.assertTrue(np.array_equal(i3.as_effects, ref))
+
+    def test_interaction_labels(self):
+        f1 = _data.factor(self.x, labels={'a': 'A'})
+        f2 = _data.factor(self.z)
+        i = f1 % f2
+        self.assertEqual(i.as_codes(), zip(f1.x, f2.x))
+        ref = [i.cells[code] for code in i.as_codes()]
+        self.assertEqual(i.as_labels(), ref)
+        self.assertEqual(ref[0], ' '.join((f1.as_labels()[0], 
+                                           f2.as_labels()[0])))
+
+    def test_multifactor(self):
+        factors = [_data.factor(self.x), _data.factor(self.z), 
+                   _data.factor(self.y)]
+        mf = _data.multifactor(factors)
+        # cells in lexicographic order of the factor codes
+        cases = zip(*[f.x.tolist() for f in factors])
+        cells = sorted(set(cases))
+        self.assertEqual(mf.x.tolist(), [cells.index(c) for c in cases])
+        ref = dict((i, ', '.join(f.cells[c] for f, c in zip(factors, cell)))
+                   for i, cell in enumerate(cells))
+        self.assertEqual(mf.cells, ref)
+        self.assertEqual(mf.df, len(cells) - 1)
+        effects, _ = _codes_reference(mf.x)
+        self.assertTrue(np.array_equal(mf.as_effects, effects))
+        
+        # a single factor and a var
+        mf = _data.multifactor([factors[0]])
+        self.assertEqual(mf.x.tolist(), factors[0].x.tolist())
+        self.assertEqual(mf.cells, factors[0].cells)
+        mf = _data.multifactor([factors[1], _data.var(self.y)])
+        cases = zip(factors[1].x.tolist(), self.y.tolist())
+        cells = sorted(set(cases))
+        self.assertEqual(mf.x.tolist(), [cells.index(c) for c in cases])
+        self.assertEqual(mf.cells[0], 'u, 5')
+
+    def test_get_index_to_match(self):
+        rng = np.random.RandomState(4)
+        f1 = _data.factor(np.arange(20), name='f')
+        f2 = f1[rng.permutation(20)]
+        index = f1.get_index_to_match(f2)
+        ref = [np.flatnonzero(f1.x == v)[0] for v in f2.x]
+        self.assertEqual(index.tolist(), ref)
+        self.assertTrue(np.all(f1[index] == f2))
+        # repeated and missing values
+        f3 = _data.factor(self.x)
+        self.assertRaises(ValueError, f3.get_index_to_match, f3)
+        f4 = f1[rng.permutation(20)]
+        f4.x[0] = f4.x[1]
+        self.assertRaises(ValueError, f4.get_index_to_match, f1)
+        index = f1.get_index_to_match(f4)
+        self.assertTrue(np.all(f1[index] == f4))
+
+
+
+class TestCodeWidth(unittest.TestCase):
+    def _check_labels(self, f):
+        "vectorized label lookups compared with lookups one case at a time"
+        ref = [f.cells[v] for v in f.x]
+        self.assertEqual(f.as_labels().tolist(), ref)
+        self.assertEqual(list(f), ref)
+        self.assertEqual(f.indexes, sorted(f.cells))
+
+    def test_dtype(self):
+        for n, dtype in ((3, np.uint8), (256, np.uint8), (257, np.uint16),
+                         (70000, np.uint32)):
+            f = _data.factor(np.arange(n))
+            self.assertEqual(f.x.dtype, dtype)
+        # retained codes
+        for codes, dtype in (([0, 255], np.uint8), ([-1, 5], np.int8), 
+                             ([-1, 200], np.int16), ([0, 300], np.uint16)):
+            labels = dict((c, str(c)) for c in codes)
+            f = _data.factor(codes, labels=labels, retain_label_codes=True)
+            self.assertEqual(f.x.dtype, dtype)
+            self.assertEqual(f.x.tolist(), codes)
+        # multifactor
+        f1 = _data.factor(np.arange(300) % 20)
+        f2 = _data.factor(np.arange(300) // 20)
+        self.assertEqual(_data.multifactor([f1, f2]).x.dtype, np.uint16)
+        self.assertEqual(_data.multifactor([f1]).x.dtype, np.uint8)
+
+    def test_new_cells(self):
+        # new cell that does not fit into uint8
+        f = _data.factor(np.arange(256))
+        labels = f.as_labels().tolist()
+        f[3] = 'new'
+        self.assertEqual(f.x.dtype, np.uint16)
+        self.assertEqual(f.x[3], 256)
+        labels[3] = 'new'
+        self.assertEqual(f.as_labels().tolist(), labels)
+        self._check_labels(f)
+        self.assertTrue(np.array_equal(f == 'new', np.arange(256) == 3))
+        
+        # new cells get the smallest free code
+        f = _data.factor([0, 1, 3, 3], labels={0: 'a', 1: 'b', 3: 'd'}, 
+                         retain_label_codes=True)
+        f[:2] = ['c', 'e']
+        self.assertEqual(f.x.tolist(), [2, 4, 3, 3])
+        self.assertEqual(f.x.dtype, np.uint8)
+        self.assertEqual(f.cells, {0: 'a', 1: 'b', 2: 'c', 3: 'd', 4: 'e'})
+        self._check_labels(f)
+        # negative codes
+        f = _data.factor([-1, 1], labels={-1: 'a', 1: 'b'}, 
+                         retain_label_codes=True)
+        self.assertEqual(f._get_ID_for_new_cell('c'), 0)
+        self.assertEqual(f.x.dtype, np.int8)
+        f[0] = 'c'
+        self.assertEqual(f.x.tolist(), [0, 1])
+        self._check_labels(f)
+
+    def test_labels(self):
+        rng = np.random.RandomState(10)
+        f = _data.factor(rng.randint(0, 5, 50), labels={0: 'a', 2: 'c'},
+                         retain_label_codes=False)
+        self._check_labels(f)
+        # cells that are changed directly
+        f.cells[1] = 'B'
+        self._check_labels(f)
+        self.assertEqual(f._interpret_y('B'), 1)
+        self.assertEqual(f._interpret_y(['a', 'c', 1]), [0, 2, 1])
+        self.assertRaises(ValueError, f._interpret_y, 7)
+        # isany
+        ref = [v in ('a', 'B') for v in f.as_labels()]
+        self.assertEqual(f.isany('a', 'B').tolist(), ref)
+
+
+
+def _sensor_net(n, names=None, shift=0.):
+    if names is None:
+        names = ['MEG %03i' % i for i in xrange(n)]
+    locs = np.column_stack((np.cos(np.arange(n)), np.sin(np.arange(n)), 
+                            np.linspace(0, 1, n) + shift))
+    return sensors.sensor_net([tuple(loc) + (name,) for loc, name 
+                               in zip(locs, names)])
+
+
+def _ndvar(x, dims=None, name='Y', properties=None):
+    if dims is None:
+        dims = (_data.var(np.arange(x.shape[1]) * .01 - .05, 'time'), 
+                _sensor_net(x.shape[2]))
+    return _data.ndvar(dims, x, properties=properties, name=name)
+
+
+class TestNdvarArithmetic(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.x = rng.randn(6, 10, 4)
+        self.x2 = rng.randn(6, 10, 4)
+        self.time = _data.var(np.arange(10) * .01 - .05, 'time')
+        self.sensor = _sensor_net(4)
+        self.dims = (self.time, self.sensor)
+
+    def _pair(self, dtype1, dtype2):
+        Y1 = _ndvar(self.x.astype(dtype1), self.dims, 'Y1')
+        Y2 = _ndvar(self.x2.astype(dtype2), self.dims, 'Y2')
+        return Y1, Y2
+
+    def test_operators(self):
+        Y1, Y2 = self._pair(np.float64, np.float64)
+        x1, x2 = self.x, self.x2
+        v = _data.var(np.arange(1., 7.), name='v')
+        x_v = v.x[:,None,None]
+        single = Y2[:1]
+        for res, ref in ((Y1 + Y2, x1 + x2), (Y1 - Y2, x1 - x2), 
+                         (Y1 * Y2, x1 * x2), (Y1 / Y2, x1 / x2),
+                         (Y1 + 2, x1 + 2), (2 - Y1, 2 - x1), 
+                         (3 * Y1, 3 * x1), (1 / Y1, 1 / x1), (-Y1, -x1),
+                         (Y1 - single, x1 - x2[:1]), (single - Y1, x2[:1] - x1),
+                         (Y1 * v, x1 * x_v), (Y1 / v, x1 / x_v)):
+            assert_allclose(res.data, ref)
+            self.assertTrue(_data._dims_equal(res.dims, self.dims))
+        self.assertEqual((Y1 - Y2).name, 'Y1-Y2')
+        
+        # in place
+        data = Y1.data
+        Y1 -= single
+        Y1 *= v
+        Y1 /= 2
+        Y1 += Y2
+        self.assertTrue(Y1.data is data)
+        assert_allclose(Y1.data, (x1 - x2[:1]) * x_v / 2 + x2)
+        
+        # out
+        out = _ndvar(np.empty_like(x1), self.dims, 'out')
+        res = Y2.subtract(single, out=out)
+        self.assertTrue(res is out)
+        assert_allclose(out.data, x2 - x2[:1])
+
+    def test_dtypes(self):
+        f32, f64 = np.float32, np.float64
+        for dtype1, dtype2, dtype in ((f32, f32, f32), (f32, f64, f64), 
+                                      (f64, f32, f64), (f64, f64, f64),
+                                      (np.int16, f32, f64), 
+                                      (np.int16, np.int16, f64)):
+            Y1, Y2 = self._pair(dtype1, dtype2)
+            ref1 = Y1.data.astype(f64)
+            ref2 = Y2.data.astype(f64)
+            # the result dtype does not depend on the order of the operands
+            for res, ref in ((Y1 + Y2, ref1 + ref2), (Y2 + Y1, ref1 + ref2),
+                             (Y1 - Y2, ref1 - ref2), (Y2 - Y1, ref2 - ref1),
+                             (Y1 * Y2, ref1 * ref2), (Y2 / Y1[:1], 
+                                                      ref2 / ref1[:1])):
+                self.assertEqual(res.data.dtype, dtype)
+                assert_allclose(res.data, ref, rtol=1e-5, atol=1e-6)
+        
+        # vars and scalars keep the ndvar's dtype
+        Y1, _ = self._pair(f32, f32)
+        v = _data.var(np.arange(6.), name='v')
+        for res in (Y1 + 1., 2. * Y1, Y1 - v, Y1 / (v + 1), -Y1):
+            self.assertEqual(res.data.dtype, f32)
+        
+        # dtype property
+        Y1 = _ndvar(self.x.astype(f32), self.dims, properties={'dtype': f64})
+        _, Y2 = self._pair(f32, f32)
+        self.assertEqual((Y1 + Y2).data.dtype, f64)
+        self.assertEqual((Y2 + Y1).data.dtype, f64)
+        self.assertEqual((Y1 * 2).data.dtype, f64)
+        
+        # in place operations keep the dtype of the target
+        Y1, Y2 = self._pair(f32, f64)
+        Y1 += Y2
+        self.assertEqual(Y1.data.dtype, f32)
+        assert_allclose(Y1.data, self.x + self.x2, rtol=1e-5, atol=1e-6)
+
+    def test_dims(self):
+        Y = _ndvar(self.x, self.dims)
+        # equal dims that are different objects
+        time = _data.var(self.time.x.copy(), 'time')
+        Y_eq = _ndvar(self.x2, (time, _sensor_net(4)))
+        assert_allclose((Y - Y_eq).data, self.x - self.x2)
+        
+        # mismatched dims
+        time_shifted = _data.var(self.time.x + .01, 'time')
+        names = ['MEG %03i' % i for i in (0, 1, 3, 2)]
+        for dims in ((time_shifted, self.sensor),
+                     (self.time, _sensor_net(4, names)),
+                     (self.time, _sensor_net(4, shift=.5))):
+            Y_mismatch = _ndvar(self.x2, dims)
+            for op in (operator.add, operator.sub, operator.mul, operator.div):
+                self.assertRaises(_data.DimensionMismatchError, op, Y, 
+                                  Y_mismatch)
+            self.assertRaises(_data.DimensionMismatchError, Y.add, Y_mismatch,
+                              out=Y)
+        
+        # different numbers of cases
+        self.assertRaises(ValueError, operator.add, Y, Y[:3])
+        self.assertRaises(ValueError, operator.add, Y, _data.var(np.ones(5)))
+
+
+
+class TestNdvarSummary(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        # a large offset tests the numerical stability of the variance
+        self.x = rng.randn(30, 10, 4) + 1e4
+        self.dims = (_data.var(np.arange(10) * .01, 'time'), _sensor_net(4))
+        self.properties = {'ylim': 2., 'summary_ylim': 1., 'samplingrate': 100}
+        self.Y = _ndvar(self.x, self.dims, properties=self.properties)
+        # chunks of different sizes, including an empty chunk and a single 
+        # case without case axis
+        self.chunks = [self.x[:7], self.x[7:8], self.x[8:8], self.x[8], 
+                       self.x[9:30]]
+
+    def _summary(self, x=None):
+        if x is None:
+            x = self.chunks
+        summary = _data.ndvar_summary(self.dims, self.properties, 'Y')
+        for chunk in x:
+            summary.add(chunk)
+        return summary
+
+    def test_stats(self):
+        x = self.x
+        for chunks in (self.chunks, [_ndvar(x[:12], self.dims), 
+                                     _ndvar(x[12:], self.dims)]):
+            summary = self._summary(chunks)
+            self.assertEqual(summary.n, 30)
+            assert_allclose(summary.mean(), x.mean(0))
+            assert_allclose(summary.var(), x.var(0))
+            assert_allclose(summary.var(ddof=1), x.var(0, ddof=1))
+            assert_allclose(summary.std(), x.std(0))
+            assert_allclose(summary.std(ddof=1), x.std(0, ddof=1))
+            self.assertTrue(np.array_equal(summary.min(), x.min(0)))
+            self.assertTrue(np.array_equal(summary.max(), x.max(0)))
+
+    def test_get_summary(self):
+        summary = self._summary()
+        for func, np_func in (('mean', np.mean), ('std', np.std), 
+                              ('min', np.min), ('max', np.max)):
+            Ys = summary.get_summary(func)
+            ref = self.Y.get_summary(np_func)
+            assert_allclose(Ys.data, ref.data)
+            self.assertEqual(Ys.data.shape, (1, 10, 4))
+            self.assertEqual(Ys.properties, ref.properties)
+            self.assertEqual(Ys.properties['ylim'], 1.)
+            self.assertEqual(Ys.name, '%s(Y)' % func)
+        # default: mean, or the summary_func property
+        assert_allclose(summary.get_summary().data, self.Y.get_summary().data)
+        for np_func in (np.max, np.min, np.std, np.median):
+            summary.properties['summary_func'] = np_func
+            self.Y.properties['summary_func'] = np_func
+            ref = self.Y.get_summary().data
+            if np_func is np.median:
+                ref = self.x.mean(0)[None]
+            assert_allclose(summary.get_summary().data, ref)
+        
+        # dtype of the data
+        x = self.x.astype(np.float32)
+        summary = self._summary([x[:10], x[10:]])
+        Ys = summary.get_summary()
+        self.assertEqual(Ys.data.dtype, np.float32)
+        assert_allclose(Ys.data[0], x.mean(0, dtype=np.float64), rtol=1e-6)
+        
+        # from_ndvars
+        Ys = _data.ndvar_summary.from_ndvars(_ndvar(self.x[i:i + 5], 
+                                                    self.dims) 
+                                             for i in xrange(0, 30, 5))
+        self.assertEqual(Ys.n, 30)
+        assert_allclose(Ys.var(), self.x.var(0))
+
+    def test_errors(self):
+        summary = _data.ndvar_summary(self.dims)
+        self.assertRaises(ValueError, summary.get_summary)
+        self.assertRaises(ValueError, summary.min)
+        self.assertRaises(ValueError, summary.add, self.x[:, :5])
+        summary.add(self.x[:1])
+        self.assertRaises(ValueError, summary.var, ddof=1)
+        self.assertRaises(ValueError, summary.get_summary, 'median')
+        self.assertRaises(ValueError, _data.ndvar_summary.from_ndvars, [])
+
+
+
+class TestNdvarFiles(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(2)
+        self.dims = (_data.var(np.arange(10) * .01, 'time'), _sensor_net(4))
+        self.Y = _ndvar(rng.randn(30, 10, 4).astype(np.float32), self.dims,
+                        'Y', properties={'samplingrate': 100})
+        self.Y.info = 'info'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _check(self, Y, ref):
+        assert_allclose(np.asarray(Y.data), ref.data)
+        self.assertEqual(Y.data.dtype, ref.data.dtype)
+        self.assertTrue(_data._dims_equal(Y.dims, ref.dims))
+        self.assertEqual(Y.properties, ref.properties)
+        self.assertEqual(Y.name, ref.name)
+        self.assertEqual(Y.info, ref.info)
+
+    def test_save(self):
+        old = _data._memmap_block
+        try:
+            # data written in several blocks
+            for memmap_block in (7, 256):
+                _data._memmap_block = memmap_block
+                fn = os.path.join(self.tempdir, 'Y%i' % memmap_block)
+                self.Y.save(fn)
+                self.assertTrue(os.path.exists(fn + '.ndvar'))
+                self.assertTrue(os.path.exists(fn + '.dat'))
+                Y = _data.load_ndvar(fn)
+                self._check(Y, self.Y)
+        finally:
+            _data._memmap_block = old
+        
+        # read-only memory map
+        self.assertTrue(isinstance(Y.data, np.memmap))
+        self.assertFalse(Y.data.flags.writeable)
+        assert_allclose(Y[[3, 1]].data, self.Y.data[[3, 1]])
+        # copy-on-write does not change the file
+        Y = _data.load_ndvar(fn, 'c')
+        Y.data[:] = 0
+        self._check(_data.load_ndvar(fn), self.Y)
+        # read/write
+        Y = _data.load_ndvar(fn, 'r+')
+        Y.data[0] = 1
+        Y.data.flush()
+        assert_allclose(_data.load_ndvar(fn).data[0], 1)
+
+    def test_memmap_ndvar(self):
+        fn = os.path.join(self.tempdir, 'Y.ndvar')
+        Y = _data.memmap_ndvar(fn, self.dims, 30, np.float32, 
+                               self.Y.properties, 'Y', 'info')
+        self.assertEqual(Y.data.shape, (30, 10, 4))
+        assert_allclose(Y.data, 0)
+        Y.data[:] = self.Y.data
+        Y.data.flush()
+        self._check(_data.load_ndvar(fn), self.Y)
+
+    def test_pickle(self):
+        fn = os.path.join(self.tempdir, 'Y')
+        self.Y.save(fn)
+        Y = _data.load_ndvar(fn)
+        
+        # file-backed ndvars pickle a reference to the file
+        string = pickle.dumps(Y, pickle.HIGHEST_PROTOCOL)
+        self.assertTrue(len(string) < self.Y.data.nbytes)
+        Y_unpickled = pickle.loads(string)
+        self.assertTrue(isinstance(Y_unpickled.data, np.memmap))
+        self._check(Y_unpickled, self.Y)
+        ds = _data.dataset(Y, _data.var(np.arange(30), 'v'))
+        string = pickle.dumps(ds, pickle.HIGHEST_PROTOCOL)
+        self.assertTrue(len(string) < self.Y.data.nbytes)
+        self._check(pickle.loads(string)['Y'], self.Y)
+        
+        # in-memory ndvars, subsets and copy-on-write ndvars pickle the data
+        for Y in (self.Y, Y[:10], _data.load_ndvar(fn, 'c')):
+            string = pickle.dumps(Y, pickle.HIGHEST_PROTOCOL)
+            self.assertTrue(len(string) > Y.data.nbytes)
+            self._check(pickle.loads(string), Y)
+
+
+
+class TestAggregate(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        n = 60
+        subject = np.tile(np.arange(5), 12)
+        condition = np.tile(np.repeat([0, 1, 2], 5), 4)
+        # cases in random order, one cell without cases
+        order = rng.permutation(n)
+        order = order[~((subject[order] == 3) & (condition[order] == 1))]
+        self.subject = subject[order]
+        self.condition = condition[order]
+        self.y = rng.randn(len(order))
+        self.x = rng.randn(len(order), 10, 4)
+        self.ds = _data.dataset(
+            _data.factor(self.subject, name='subject', random=True,
+                         labels=dict((i, 'S%i' % i) for i in xrange(5))),
+            _data.factor(self.condition, name='condition',
+                         labels={0: 'a', 1: 'b', 2: 'c'}),
+            # constant within subjects
+            _data.factor(self.subject % 2, name='group',
+                         labels={0: 'g1', 1: 'g2'}),
+            # not constant within cells
+            _data.factor(rng.randint(0, 2, len(order)), name='block'),
+            _data.var(self.y, name='y'),
+            _ndvar(self.x, name='Y'),
+            name='ds')
+
+    def _reference(self, cell_arrays, func):
+        "each cell reduced separately, cells in order of their codes"
+        cells = sorted(set(zip(*cell_arrays)))
+        y = []
+        x = []
+        first = []
+        for cell in cells:
+            index = np.ones(len(self.y), dtype=bool)
+            for array, code in zip(cell_arrays, cell):
+                index &= (array == code)
+            y.append(func(self.y[index], axis=0))
+            x.append(func(self.x[index], axis=0))
+            first.append(np.flatnonzero(index)[0])
+        return np.array(y), np.array(x), np.array(first)
+
+    def test_interaction(self):
+        X = self.ds['subject'] % self.ds['condition']
+        for func in (np.mean, np.sum, np.median, np.max):
+            agg = self.ds.aggregate(X, func=func)
+            y, x, first = self._reference([self.subject, self.condition], 
+                                          func)
+            self.assertEqual(agg.N, 14)
+            assert_allclose(agg['y'].x, y)
+            assert_allclose(agg['Y'].data, x)
+            self.assertTrue(_data._dims_equal(agg['Y'].dims, 
+                                              self.ds['Y'].dims))
+            for name in ('subject', 'condition', 'group'):
+                f = self.ds[name]
+                self.assertEqual(list(agg[name].as_labels()), 
+                                 list(f.as_labels()[first]))
+            self.assertTrue(agg['subject'].random)
+            self.assertFalse('block' in agg)
+
+    def test_factor(self):
+        agg = self.ds.aggregate('subject', name='{name}-agg')
+        y, x, first = self._reference([self.subject], np.mean)
+        assert_allclose(agg['y'].x, y)
+        assert_allclose(agg['Y'].data, x)
+        self.assertEqual(list(agg['group'].as_labels()), 
+                         ['g1', 'g2', 'g1', 'g2', 'g1'])
+        self.assertEqual(sorted(agg.keys()), ['Y', 'group', 'subject', 'y'])
+        self.assertEqual(agg.name, 'ds-agg')
+
+
+
+def _split_Y(y, mf, match=None, datalabels=None):
+    """
+    reference: one cell at a time; with match, sorted by match and averaged
+    over several cases with the same match value
+    
+    """
+    data = []
+    data_labels = []
+    names = []
+    for code in sorted(mf.cells):
+        index = mf.x == code
+        if not np.any(index):
+            continue
+        names.append(mf.cells[code])
+        cell_data = y[index]
+        if datalabels is not None:
+            cell_labels = datalabels[index]
+        if match is not None:
+            ids = match.x[index]
+            cell_data = [cell_data[ids == i].mean() for i in np.unique(ids)]
+            if datalabels is not None:
+                cell_labels = [cell_labels[ids == i][0] 
+                               for i in np.unique(ids)]
+        data.append(np.array(cell_data))
+        if datalabels is not None:
+            data_labels.append(list(cell_labels))
+    return data, data_labels, names
+
+
+class TestSplitY(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(6)
+        n = 72
+        order = rng.permutation(n)
+        self.A = _data.factor(np.tile([0, 1, 2], 24), name='A', 
+                              labels={0: 'a0', 1: 'a1', 2: 'a2'})[order]
+        self.B = _data.factor(np.repeat([0, 1], 36), name='B')[order]
+        # two cases per A x B x subject cell
+        self.S = _data.factor(np.tile(np.repeat(np.arange(6), 3), 4), 
+                              name='subject', random=True)[order]
+        self.Y = _data.var(rng.randn(n), name='Y')
+
+    def _check(self, X, match=None, sub=None, datalabels=None):
+        data, data_labels, names, within = _data.split_Y(
+                        self.Y, X, match=match, sub=sub, datalabels=datalabels)
+        Y = self.Y
+        if sub is not None:
+            Y = Y[sub]
+            X = X[sub]
+            match = match and match[sub]
+            datalabels = datalabels and datalabels[sub]
+        mf = _data.multifactor(_data.asmodel(X).factors)
+        labels = datalabels or match
+        if labels is not None:
+            labels = np.asarray(labels.as_labels())
+        ref, ref_labels, ref_names = _split_Y(Y.x, mf, match, labels)
+        self.assertEqual(names, ref_names)
+        self.assertEqual(len(data), len(ref))
+        for d, r in zip(data, ref):
+            assert_allclose(d, r)
+        self.assertEqual([list(l) for l in data_labels], ref_labels)
+        return within
+
+    def test_split(self):
+        unequal = np.ones(72, dtype=bool)
+        unequal[np.flatnonzero(self.S.x == 2)[:3]] = False
+        for X in (self.A, self.A % self.B):
+            self._check(X)
+            self.assertTrue(self._check(X, self.S))
+            self._check(X, self.S, unequal)
+            self._check(X, sub=unequal)
+        # match with a single case per cell
+        _, first = _data._combine_codes([self.A.x, self.B.x, self.S.x])
+        single = np.zeros(72, dtype=bool)
+        single[first] = True
+        self.assertTrue(self._check(self.A % self.B, self.S, single))
+        # independent measures: different subjects in each cell of B
+        S_B = _data.factor(self.S.x + 6 * self.B.x, name='subject')
+        self.assertFalse(self._check(self.B, S_B))
+        
+        # datalabels, constant within match values
+        group = _data.factor(self.S.x % 2, name='group', 
+                             labels={0: 'g0', 1: 'g1'})
+        self._check(self.A, self.S, datalabels=group)
+        self._check(self.A, datalabels=group)
+        # datalabels that differ within match values
+        self.assertRaises(ValueError, _data.split_Y, self.Y, self.A, self.S, 
+                          datalabels=self.B)
+
+
+class TestCellGroups(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        self.a = rng.randint(0, 3, 40)
+        self.b = rng.randint(5, 7, 40)
+        self.x = rng.randn(40, 3)
+
+    def test_groups(self):
+        f_a = _data.factor(self.a, retain_label_codes=True,
+                           labels={0: 'x', 1: 'y', 2: 'z'})
+        f_b = _data.factor(self.b)
+        for X, arrays in ((f_a, [self.a]), (f_a % f_b, [self.a, f_b.x]), 
+                          ([self.a, self.b], [self.a, self.b])):
+            groups = _data._cell_groups(X)
+            cells = sorted(set(zip(*arrays)))
+            self.assertEqual(groups.n, len(cells))
+            index = [np.all([array == c for array, c in zip(arrays, cell)], 0)
+                     for cell in cells]
+            first = [np.flatnonzero(i)[0] for i in index]
+            self.assertEqual(groups.first.tolist(), first)
+            self.assertEqual(groups.counts.tolist(), [i.sum() for i in index])
+            sorted_x = groups.sort(self.x)
+            for i, start, n in zip(index, groups.starts, groups.counts):
+                assert_allclose(sorted_x[start:start + n], self.x[i])
+            for func in (np.mean, np.sum, np.std):
+                ref = [func(self.x[i], axis=0) for i in index]
+                assert_allclose(groups.reduce(self.x, func), ref)
+            # is_constant
+            self.assertTrue(groups.is_constant(self.a))
+            self.assertFalse(groups.is_constant(np.arange(40)))
+            # copy
+            self.assertEqual(_data._cell_groups(groups).first.tolist(), first)
+        
+        # sorted codes
+        groups = _data._cell_groups([np.repeat(np.arange(4), 10)])
+        self.assertTrue(groups.order is None)
+        assert_allclose(groups.reduce(self.x), self.x.reshape((4, 10, 3)).mean(1))
+        self.assertRaises(TypeError, _data._cell_groups, 
+                          _data.var(np.ones(40)))
+
+
+
+class TestSubdata(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(8)
+        # time axis as created by the fiff loaders
+        self.t = np.arange(-10, 31) / 100.
+        self.dims = (_data.var(self.t, 'time'), _sensor_net(6))
+        self.x = rng.randn(5, 41, 6)
+        self.Y = _ndvar(self.x, self.dims, properties={'samplingrate': 100})
+
+    def _shares_data(self, Y):
+        return np.may_share_memory(Y.data, self.Y.data)
+
+    def test_time_window(self):
+        t = self.t
+        # window edges on samples, between samples and outside the data
+        for tmin, tmax in ((0, .1), (-.1, .3), (.005, .095), (-1, 1), 
+                           (None, 0), (.1, None), (None, None), (.2, .2), 
+                           (.3, .31)):
+            Ys = self.Y.subdata(time=(tmin, tmax))
+            index = np.ones(len(t), dtype=bool)
+            if tmin is not None:
+                index &= t >= tmin
+            if tmax is not None:
+                index &= t < tmax
+            assert_allclose(Ys.data, self.x[:, index])
+            assert_allclose(Ys.time.x, t[index])
+            self.assertTrue(self._shares_data(Ys) or not index.any())
+        # tmax is excluded
+        self.assertEqual(self.Y.subdata(time=(0, .1)).time.x[-1], .09)
+        self.assertEqual(self.Y.subdata(time=(0, .1)).time.x[0], 0)
+
+    def test_time_point(self):
+        t = self.t
+        for time, i in ((0, 10), (.1, 20), (.004, 10), (.006, 11), 
+                        (-1, 0), (1, 40)):
+            Ys = self.Y.subdata(time=time)
+            self.assertEqual(Ys.properties['t'], t[i])
+            self.assertEqual(Ys.data.shape, (5, 6))
+            assert_allclose(Ys.data, self.x[:, i])
+            self.assertFalse('time' in Ys._dim_dict)
+            self.assertTrue(self._shares_data(Ys))
+
+    def test_sensor(self):
+        names = self.Y.sensor.names
+        # contiguous selections are views
+        for sensor in ([1, 2, 3], ['MEG 001', 'MEG 002', 'MEG 003'], 
+                       slice(1, 4), (np.arange(6) > 0) & (np.arange(6) < 4)):
+            Ys = self.Y.subdata(sensor=sensor)
+            assert_allclose(Ys.data, self.x[:,:,1:4])
+            self.assertEqual(Ys.sensor.names, names[1:4])
+            assert_allclose(Ys.sensor.locs3d, self.Y.sensor.locs3d[1:4])
+            self.assertTrue(self._shares_data(Ys))
+        # other selections are copies
+        Ys = self.Y.subdata(sensor=[4, 0, 'MEG 002'])
+        assert_allclose(Ys.data, self.x[:,:,[4, 0, 2]])
+        self.assertEqual(Ys.sensor.names, [names[i] for i in (4, 0, 2)])
+        self.assertFalse(self._shares_data(Ys))
+        # a single sensor removes the sensor dimension
+        for sensor in (2, 'MEG 002'):
+            Ys = self.Y.subdata(sensor=sensor)
+            assert_allclose(Ys.data, self.x[:,:,2])
+            self.assertEqual(Ys.dims, (self.Y.time,))
+        
+        # sensor and time
+        Ys = self.Y.subdata(time=(0, .1), sensor=[5, 1])
+        assert_allclose(Ys.data, self.x[:, 10:20][:,:,[5, 1]])
+        Ys = self.Y.subdata(time=.1, sensor='MEG 003')
+        assert_allclose(Ys.data, self.x[:, 20, 3])
+        
+        # views change with the original data
+        Ys = self.Y.subdata(time=(0, .1), sensor=slice(0, 3))
+        self.Y.data[:, 10, 0] = 7
+        assert_allclose(Ys.data[:, 0, 0], 7)
+        
+        self.assertRaises(ValueError, self.Y.subdata, 
+                          sensor=np.ones(5, dtype=bool))
+        self.assertRaises(KeyError, _data.ndvar((self.dims[0],), 
+                          self.x[:,:,0]).subdata, sensor=1)
+
+
+
+class TestDtypePolicy(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(9)
+        self.x = rng.randn(40, 10, 4) + 100
+        self.A = _data.factor(np.tile(np.arange(4), 10), name='A')
+
+    def test_compute_dtype(self):
+        f16, f32, f64 = np.float16, np.float32, np.float64
+        for dtype, properties, out in ((f32, {}, f32), (f64, {}, f64), 
+                                       (f16, {}, f16), (np.int16, {}, f64),
+                                       (bool, {}, f64), 
+                                       (f32, {'dtype': f64}, f64),
+                                       (np.int8, {'dtype': f32}, f32),
+                                       (f32, {'dtype': None}, f32)):
+            self.assertEqual(_data._compute_dtype(properties, np.dtype(dtype)),
+                             out)
+        Y = _ndvar(self.x.astype(f32), properties={'dtype': f64})
+        self.assertEqual(Y._compute_dtype(), f64)
+
+    def test_summary(self):
+        x32 = self.x.astype(np.float32)
+        x64 = x32.astype(np.float64)
+        Y = _ndvar(x32)
+        # accumulated in float64, returned as float32
+        for func in (np.mean, np.sum, np.var, np.std):
+            Ys = Y.get_summary(func)
+            self.assertEqual(Ys.data.dtype, np.float32)
+            self.assertTrue(np.array_equal(Ys.data[0], 
+                                           func(x64, 0).astype(np.float32)))
+        Ys = Y.get_summary(np.median)
+        self.assertEqual(Ys.data.dtype, np.float32)
+        assert_allclose(Ys.data[0], np.median(x32, 0))
+        
+        # compress
+        for func in (np.mean, np.sum):
+            Yc = Y.compress(self.A, func)
+            self.assertEqual(Yc.data.dtype, np.float32)
+            ref = [func(x64[self.A.x == i], 0) for i in xrange(4)]
+            self.assertTrue(np.array_equal(Yc.data, 
+                                           np.float32(ref)))
+        self.assertEqual(Y.compress(self.A, np.max).data.dtype, np.float32)
+        
+        # integer data and the dtype property
+        Y = _ndvar(np.int16(self.x))
+        self.assertEqual(Y.get_summary().data.dtype, np.float64)
+        self.assertEqual(Y.compress(self.A).data.dtype, np.float64)
+        assert_allclose(Y.mean().data[0], np.int16(self.x).mean(0))
+        Y = _ndvar(x32, properties={'dtype': np.float64})
+        self.assertEqual(Y.get_summary().data.dtype, np.float64)
+        assert_allclose(Y.get_summary().data[0], x64.mean(0))
+
+    def test_defaults(self):
+        self.assertEqual(_data.defaults['dtype'], np.float32)
+        tempdir = tempfile.mkdtemp()
+        old = _data.defaults['dtype']
+        try:
+            dims = (_data.var(np.arange(10) * .01, 'time'),)
+            Y = _data.memmap_ndvar(os.path.join(tempdir, 'a'), dims, 3)
+            self.assertEqual(Y.data.dtype, np.float32)
+            _data.defaults['dtype'] = np.float64
+            Y = _data.memmap_ndvar(os.path.join(tempdir, 'b'), dims, 3)
+            self.assertEqual(Y.data.dtype, np.float64)
+            del Y
+        finally:
+            _data.defaults['dtype'] = old
+            shutil.rmtree(tempdir)
+
+
+
+def _filter_reference(x, h, axis):
+    "convolution of each series in x with h ('valid' samples only)"
+    return np.apply_along_axis(np.convolve, axis, x, h, 'valid')
+
+
+class TestDecimate(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(11)
+        # 201 samples at 100 Hz, from -.2 to 1.8 s
+        self.t = np.arange(-20, 181) / 100.
+        self.x = rng.randn(4, 201, 3)
+        self.Y = _ndvar(self.x, (_data.var(self.t, 'time'), _sensor_net(3)),
+                        properties={'samplingrate': 100})
+
+    def test_fir_decimate(self):
+        rng = np.random.RandomState(12)
+        x = rng.randn(3, 150, 2)
+        for decim in (2, 3, 5):
+            h = _data._decim_filter(decim)
+            self.assertEqual(len(h), 20 * decim + 1)
+            assert_allclose(h, h[::-1])
+            assert_allclose(h.sum(), 1)
+            filtered = _filter_reference(x, h, 1)
+            for start in (0, 1, decim - 1):
+                n = (filtered.shape[1] - 1 - start) // decim + 1
+                out = _data._fir_decimate(x, h, decim, start, n, 1)
+                assert_allclose(out, filtered[:, start::decim])
+            # float64 accumulation
+            out = _data._fir_decimate(x.astype(np.float32), h, decim, 0, 2, 1)
+            self.assertEqual(out.dtype, np.float64)
+        # other axes
+        h = _data._decim_filter(2)
+        x = x.transpose((1, 0, 2))
+        out = _data._fir_decimate(x, h, 2, 1, 50, 0)
+        assert_allclose(out, _filter_reference(x, h, 0)[1::2][:50])
+
+    def test_scipy(self):
+        "same filter as scipy.signal.decimate (away from the epoch edges)"
+        for decim in (2, 4):
+            Yd = self.Y.decimate(decim)
+            half = 10 * decim
+            # time point 0 is on the new sampling grid; the series for 
+            # scipy starts at sample 0 of the new grid
+            offset = 20 % decim
+            ref = scipy.signal.decimate(self.x[:, offset:], decim, ftype='fir',
+                                        axis=1)
+            interior = slice(half // decim + 1, -(half // decim + 1))
+            assert_allclose(Yd.data[:, interior], ref[:, interior], atol=1e-12)
+
+    def test_decimate(self):
+        for decim in (1, 2, 3):
+            for Yd in (self.Y.decimate(decim), 
+                       self.Y.decimate(sfreq=100. / decim)):
+                # the time points are the multiples of the new interval
+                t = self.t[np.round(self.t * 100).astype(int) % decim == 0]
+                assert_allclose(Yd.time.x, t)
+                self.assertEqual(Yd.properties['samplingrate'], 100. / decim)
+                # reference: mirror the data at the edges and filter
+                h = _data._decim_filter(decim)
+                half = len(h) // 2
+                x = np.pad(self.x, [(0, 0), (half, half), (0, 0)], 'reflect')
+                filtered = _filter_reference(x, h, 1)
+                index = np.flatnonzero(np.in1d(self.t, t))
+                assert_allclose(Yd.data, filtered[:, index])
+                self.assertTrue(_data._dims_equal(Yd.dims[1:], self.Y.dims[1:]))
+        assert_allclose(self.Y.decimate(1).data, self.x)
+        
+        # time axis without 'samplingrate' property and dtype
+        Y = _ndvar(self.x.astype(np.float32), self.Y.dims)
+        Yd = Y.decimate(2)
+        self.assertEqual(Yd.data.dtype, np.float32)
+        self.assertAlmostEqual(Yd.properties['samplingrate'], 50)
+        assert_allclose(Yd.data, self.Y.decimate(2).data, rtol=1e-5, 
+                        atol=1e-5)
+
+    def test_errors(self):
+        self.assertRaises(ValueError, self.Y.decimate, 0)
+        self.assertRaises(ValueError, self.Y.decimate, 1.5)
+        self.assertRaises(ValueError, self.Y.decimate, sfreq=30)
+        self.assertRaises(ValueError, self.Y.decimate, 2, sfreq=50)
+        Y = _data.ndvar((_sensor_net(3),), self.x[:, 0])
+        self.assertRaises(KeyError, Y.decimate, 2)
+        self.assertEqual(_data._decim_factor(1000., new_sfreq=250), 4)
+        self.assertEqual(_data._decim_factor(1000.), 1)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+'''
+Tests for :mod:`eelbrain.analyze.glm`, comparing the vectorized fitters with
+the single-variable ANOVA.
+
+'''
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from eelbrain.vessels import data as _data
+from eelbrain.analyze import glm
+
+
+def _anova_results(Y, X):
+    "{effect name: (F, p)} from glm.anova"
+    a = glm.anova(Y, X)
+    return dict((row[0], (row[4], row[5])) for row in a._results_table 
+                if row[4] is not None)
+
+
+def _design(n_subjects=8):
+    A = _data.factor('abc', rep=2 * n_subjects, name='A')
+    B = _data.factor('xy', rep=n_subjects, chain=3, name='B')
+    S = _data.factor(range(n_subjects) * 6, name='S', random=True)
+    return A, B, S
+
+
+
+class TestLmFitterMap(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.A, self.B, self.S = _design()
+    
+    def _compare(self, X, Y, max_mem=None):
+        "compare lm_fitter.map on Y (points x cases) with anova on each point"
+        fitter = glm.lm_fitter(X)
+        out = fitter.map(Y, max_mem=max_mem)
+        self.assertTrue(len(out) > 0)
+        for i in xrange(Y.shape[0]):
+            ref = _anova_results(Y[i], X)
+            self.assertEqual(sorted(ref), sorted(name for name, _, _ in out))
+            for name, F, P in out:
+                assert_allclose(F[i], ref[name][0])
+                assert_allclose(P[i], ref[name][1])
+    
+    def test_fixed(self):
+        Y = self.rng.randn(6, 48)
+        X = self.A * self.B
+        self._compare(X, Y)
+        # chunked processing
+        self._compare(X, Y, max_mem=1000)
+    
+    def test_mixed(self):
+        Y = self.rng.randn(6, 48)
+        X = self.A * self.B * self.S
+        self._compare(X, Y)
+        self._compare(X, Y, max_mem=1000)
+    
+    def test_shape(self):
+        "arrays keep their shape, ndvars are returned as ndvars"
+        X = self.A * self.B
+        fitter = glm.lm_fitter(X)
+        Y = self.rng.randn(3, 4, 48)
+        out = fitter.map(Y)
+        self.assertEqual(out[0][1].shape, (3, 4))
+        ref = fitter.map(Y.reshape((12, 48)))
+        for (_, F, P), (_, F_ref, P_ref) in zip(out, ref):
+            assert_allclose(F.ravel(), F_ref)
+        
+        time = _data.var(np.arange(5) / 100., 'time')
+        Y = _data.ndvar((time,), self.rng.randn(48, 5), name='Y')
+        out = fitter.map(Y)
+        ref = fitter.map(Y.data.T)
+        for (_, F, P), (_, F_ref, P_ref) in zip(out, ref):
+            self.assertEqual(F.data.shape, (1, 5))
+            assert_allclose(F.data[0], F_ref)
+            assert_allclose(P.data[0], P_ref)
+
+
+
+class TestLmCache(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        A, B, S = _design()
+        self.Y = _data.var(rng.randn(48) + .5 * (A == 'a'), name='Y')
+        self.X = A * B * S
+    
+    def _compare(self, cache, effects):
+        fit = cache.get(effects)
+        ref = glm.lm(self.Y, _data.model(*effects))
+        assert_allclose(fit.SS_res, ref.SS_res, atol=1e-10)
+        assert_allclose(fit.SS_total, ref.SS_total)
+        self.assertEqual(fit.df_model, ref.df_model)
+        self.assertEqual(fit.df_res, ref.df_res)
+        assert_allclose(fit.F_test(), ref.F_test())
+    
+    def test_submodels(self):
+        "submodel fits from the cached QR decomposition match lm"
+        effects = self.X.effects
+        submodels = (effects[:1], effects[:3], effects[1:5], effects[::2],
+                     effects[:-2])
+        cache = glm._lm_cache(self.Y, self.X)
+        self.assertTrue(cache._full_rank)
+        for sub in submodels:
+            self._compare(cache, sub)
+            self.assertTrue(cache.get(sub) is cache.get(list(sub)))
+        
+        # the pivoting code path for rank deficient models
+        cache = glm._lm_cache(self.Y, self.X)
+        cache._full_rank = False
+        for sub in submodels:
+            self._compare(cache, sub)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
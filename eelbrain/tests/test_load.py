@@ -0,0 +1,731 @@
+'''
+Tests for reading epochs and events in :mod:`eelbrain.vessels.load`, using a
+stub in place of an :class:`mne.fiff.Raw` object (the tests do not need mne).
+Loaders that open files through mne are tested with :class:`_FakeMne`, which
+serves stub raw files and events by path.
+
+'''
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from eelbrain.utils import parallel
+from eelbrain.vessels import data as _data
+from eelbrain.vessels import load
+
+
+
+class _Raw(object):
+    """
+    minimal stand-in for mne.fiff.Raw that records the segments read (number
+    of samples in ``reads``, channels in ``read_picks``)
+    
+    """
+    def __init__(self, x, sfreq=100., first_samp=0, ch_names=None):
+        self.x = x
+        self.first_samp = first_samp
+        if ch_names is None:
+            ch_names = ['MEG %03i' % i for i in xrange(len(x))]
+        chs = []
+        for i, name in enumerate(ch_names):
+            loc = np.zeros(12)
+            loc[:3] = (np.cos(i), np.sin(i), .1 * i)
+            chs.append({'ch_name': name, 'loc': loc})
+        self.info = {'sfreq': sfreq, 'chs': chs}
+        self.reads = []
+        self.read_picks = []
+
+    def __len__(self):
+        return self.x.shape[1]
+
+    def __getitem__(self, index):
+        picks, sl = index
+        data = self.x[picks, sl]
+        self.reads.append(data.shape[1])
+        self.read_picks.append(list(picks))
+        return data, None
+
+
+class _FakeMne(object):
+    """
+    stand-in for the parts of mne used by the loaders: ``mne.fiff.Raw`` and 
+    ``mne.read_events`` return the stub raw files and events stored for a
+    path, ``mne.fiff.pick_types`` picks the 'MEG' channels and 
+    ``mne.fiff.compensator.make_compensator`` returns ``comp``
+    
+    """
+    def __init__(self, raws={}, events={}, comp=None):
+        self.raws = raws
+        self.events = events
+        self.comp = comp
+        self.fiff = self
+        self.compensator = self
+
+    def Raw(self, path):
+        return self.raws[path]
+
+    def read_events(self, path):
+        return self.events[path]
+
+    def pick_types(self, info, **kwargs):
+        return np.array([i for i, ch in enumerate(info['chs'])
+                         if ch['ch_name'].startswith('MEG')])
+
+    def make_compensator(self, info, from_, to):
+        assert (from_, to) == (2, 0)
+        return self.comp
+
+
+class _MneTestCase(unittest.TestCase):
+    "installs the _FakeMne ``self.mne`` as mne in the load module"
+    def setUp(self):
+        self.mne = _FakeMne()
+        self._mne = getattr(load, 'mne', None)
+        load.mne = self.mne
+
+    def tearDown(self):
+        if self._mne is None:
+            del load.mne
+        else:
+            load.mne = self._mne
+
+
+def _raw(seed, n_channels=5, n_samples=2000, first_samp=0):
+    rng = np.random.RandomState(seed)
+    return _Raw(rng.randn(n_channels, n_samples), first_samp=first_samp)
+
+
+def _events(seed, n_samples=2000, n_events=30):
+    "events with IDs 1, 2 and 3"
+    rng = np.random.RandomState(seed)
+    i_start = np.sort(rng.randint(50, n_samples - 100, n_events))
+    ids = rng.randint(1, 4, n_events)
+    return np.column_stack((i_start, np.zeros(n_events, int), ids))
+
+
+def _read_into(out, task):
+    "read one stub raw file (module-level worker for parallel.map_into)"
+    seed, conditions, start, n = task
+    raw = _raw(seed)
+    events = _events(seed)
+    picks = np.arange(1, 4)
+    return load._read_conditions_into(out[start:start + n], raw, events,
+                                      conditions, -.1, .3, picks)
+
+
+
+class TestReadConditions(unittest.TestCase):
+    conditions = (3, 1)
+    n_times = 41  # -.1 to .3 s at 100 Hz
+
+    def setUp(self):
+        self.tasks = []
+        n_total = 0
+        for seed in xrange(4):
+            events = _events(seed)
+            n = int(sum(np.sum(events[:,2] == ID) for ID in self.conditions))
+            self.tasks.append((seed, self.conditions, n_total, n))
+            n_total += n
+        self.shape = (n_total, self.n_times, 3)
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _reference(self):
+        "each condition read separately, with naive epoch extraction"
+        out = []
+        ids = []
+        for seed, conditions, _, _ in self.tasks:
+            raw = _raw(seed)
+            events = _events(seed)
+            for ID in conditions:
+                for i in events[events[:,2] == ID, 0]:
+                    epoch = raw.x[1:4, i - 10:i + 31].T
+                    out.append(epoch - epoch[:11].mean(0))
+                    ids.append(ID)
+        return np.array(out), ids
+
+    def _check(self, data, results):
+        ref, ref_ids = self._reference()
+        assert_allclose(data, ref)
+        self.assertEqual(sum(results, []), ref_ids)
+
+    def test_serial(self):
+        data = np.empty(self.shape)
+        results = parallel.map_into(_read_into, self.tasks, data, n_workers=1)
+        self._check(data, results)
+
+    def test_memmap(self):
+        path = os.path.join(self.tempdir, 'data.dat')
+        data = np.memmap(path, np.float64, 'w+', shape=self.shape)
+        results = parallel.map_into(_read_into, self.tasks, data, n_workers=2)
+        self._check(data, results)
+        del data
+
+    def test_shared(self):
+        raw, data = parallel.shared_empty(self.shape)
+        results = parallel.map_into(_read_into, self.tasks, data, raw=raw,
+                                    n_workers=2)
+        self._check(data, results)
+
+
+def _projs(rng, ch_names):
+    "SSP projection items over subsets of ``ch_names`` (1 vector each)"
+    projs = []
+    for n, names in ((1, ch_names[:4]), (1, ch_names[1:])):
+        data = {'col_names': names, 'data': rng.randn(n, len(names))}
+        projs.append({'data': data, 'active': False})
+    return projs
+
+
+def _projector(projs, ch_names, bads=()):
+    "reference projector: orthonormal basis of the normalized vectors by QR"
+    vecs = []
+    for proj in projs:
+        col_names = proj['data']['col_names']
+        for row in proj['data']['data']:
+            vec = np.array([row[col_names.index(name)] if (name in col_names
+                            and name not in bads) else 0. 
+                            for name in ch_names])
+            vecs.append(vec / np.sqrt(np.sum(vec ** 2)))
+    Q, _ = np.linalg.qr(np.transpose(vecs))
+    return np.eye(len(ch_names)) - np.dot(Q, Q.T)
+
+
+class TestReadEpochs(_MneTestCase):
+    picks = np.array([4, 0, 2])
+    chunk_bytes = (1, 200, 1000, 5000, load._chunk_bytes)
+
+    def setUp(self):
+        _MneTestCase.setUp(self)
+        rng = np.random.RandomState(0)
+        self.raw = _raw(0, first_samp=100)
+        # unsorted, overlapping and repeated events
+        i_start = np.concatenate((np.arange(200, 400, 5),
+                                  rng.randint(100, 1900, 40), [500, 500]))
+        self.i_start = rng.permutation(i_start) + self.raw.first_samp
+
+    def _read(self, chunk_bytes, i_start=None, **kwargs):
+        if i_start is None:
+            i_start = self.i_start
+        decim = kwargs.get('decim', 1)
+        n_times = len(load._epoch_times(100. / decim, -.1, .3))
+        out = np.empty((len(i_start), n_times, len(self.picks)))
+        old = load._chunk_bytes
+        try:
+            load._chunk_bytes = chunk_bytes
+            self.raw.reads = []
+            load._read_epochs_into(out, self.raw, i_start, self.picks, -.1, .3,
+                                   **kwargs)
+        finally:
+            load._chunk_bytes = old
+        return out
+
+    def _reference(self, baseline=True, operator=None):
+        "naive extraction, one epoch at a time"
+        x = self.raw.x
+        if operator is not None:
+            x = np.dot(operator, x)
+        out = []
+        for i in self.i_start - self.raw.first_samp:
+            epoch = x[self.picks, i - 10:i + 31].T
+            if baseline:
+                epoch = epoch - epoch[:11].mean(0)
+            out.append(epoch)
+        return np.array(out)
+
+    def test_chunks(self):
+        ref = self._reference()
+        ref_no_bl = self._reference(baseline=False)
+        for chunk_bytes in self.chunk_bytes:
+            assert_allclose(self._read(chunk_bytes), ref)
+            assert_allclose(self._read(chunk_bytes, baseline=None), ref_no_bl)
+            assert_allclose(self._read(chunk_bytes, decim=1), ref)
+
+    def test_bounded_reads(self):
+        n_picks = len(self.picks)
+        n_samples = 41
+        for chunk_bytes in self.chunk_bytes:
+            self._read(chunk_bytes)
+            chunk_samples = max(n_samples, chunk_bytes // (8 * n_picks))
+            chunk_epochs = max(1, chunk_bytes // (8 * n_picks * n_samples))
+            self.assertTrue(max(self.raw.reads) <= chunk_samples)
+            self.assertTrue(len(self.raw.reads) * chunk_epochs
+                            >= len(self.i_start))
+        # one epoch per read
+        self._read(1)
+        self.assertEqual(len(self.raw.reads), len(self.i_start))
+        self.assertEqual(set(self.raw.reads), set([n_samples]))
+
+    def test_decim(self):
+        ref = self._read(load._chunk_bytes, decim=2)
+        self.assertEqual(ref.shape, (len(self.i_start), 21, len(self.picks)))
+        for chunk_bytes in self.chunk_bytes[:-1]:
+            assert_allclose(self._read(chunk_bytes, decim=2), ref)
+        
+        # reference: each epoch filtered with the raw data around it
+        for decim in (2, 3):
+            h = _data._decim_filter(decim)
+            half = len(h) // 2
+            samples = np.round(load._epoch_times(100. / decim, -.1, .3) 
+                               * 100).astype(int)
+            epochs = []
+            for i in self.i_start - self.raw.first_samp:
+                x = self.raw.x[self.picks]
+                epoch = [np.dot(x[:, i + s - half:i + s + half + 1], h[::-1])
+                         for s in samples]
+                epoch = np.array(epoch)
+                epochs.append(epoch - epoch[samples <= 0].mean(0))
+            assert_allclose(self._read(1000, decim=decim), epochs)
+
+    def test_projection(self):
+        rng = np.random.RandomState(1)
+        names = [ch['ch_name'] for ch in self.raw.info['chs']]
+        pick_names = [names[i] for i in self.picks]
+        projs = self.raw.info['projs'] = _projs(rng, names)
+        operator = np.eye(len(names))
+        operator[np.ix_(self.picks, self.picks)] = _projector(projs, 
+                                                              pick_names)
+        ref = self._reference(operator=operator)
+        for chunk_bytes in self.chunk_bytes:
+            assert_allclose(self._read(chunk_bytes), ref)
+        # only the picked channels are read
+        self.assertEqual(self.raw.read_picks[0], list(self.picks))
+        
+        # bad channels are excluded from the projection vectors
+        bads = self.raw.info['bads'] = [names[2]]
+        operator[np.ix_(self.picks, self.picks)] = _projector(projs, 
+                                                              pick_names, bads)
+        assert_allclose(self._read(200), self._reference(operator=operator))
+        
+        # projection items that do not apply to the picks
+        self.raw.info['projs'] = [{'data': {'col_names': ['MEG 003'], 
+                                            'data': np.ones((1, 1)), }}]
+        assert_allclose(self._read(200), self._reference())
+
+    def test_compensation(self):
+        rng = np.random.RandomState(2)
+        # channels 1 and 3 are reference channels at compensation grade 2
+        for ch in self.raw.info['chs']:
+            ch['kind'] = 1
+            ch['coil_type'] = (2 << 16) + 3012
+        comp = np.eye(5)
+        comp[:, [1, 3]] += rng.randn(5, 2)
+        self.mne.comp = comp
+        ref = self._reference(operator=comp)
+        for chunk_bytes in self.chunk_bytes:
+            assert_allclose(self._read(chunk_bytes), ref)
+        # the reference channels are read as well
+        self.assertEqual(self.raw.read_picks[0], [0, 1, 2, 3, 4])
+        
+        # compensation and projection
+        names = [ch['ch_name'] for ch in self.raw.info['chs']]
+        projs = self.raw.info['projs'] = _projs(rng, names)
+        proj = np.eye(5)
+        proj[np.ix_(self.picks, self.picks)] = _projector(
+                                    projs, [names[i] for i in self.picks])
+        ref = self._reference(operator=np.dot(proj, comp))
+        assert_allclose(self._read(1000), ref)
+        
+        # grade 0: no compensation
+        for ch in self.raw.info['chs']:
+            ch['coil_type'] = 3012
+        self.raw.info['projs'] = []
+        self.mne.comp = None
+        assert_allclose(self._read(1000), self._reference())
+
+    def test_out_of_bounds(self):
+        first_samp = self.raw.first_samp
+        for i in (first_samp + 5, first_samp + len(self.raw) - 10):
+            i_start = np.array([first_samp + 500, i])
+            self.assertRaises(IOError, self._read, load._chunk_bytes, i_start)
+        # wrong shape of out
+        out = np.empty((2, 40, 3))
+        self.assertRaises(ValueError, load._read_epochs_into, out, self.raw,
+                          [first_samp + 500] * 2, self.picks, -.1, .3)
+        
+        # _epochs_in_data
+        i_start = first_samp + np.array([9, 10, 500, 1969, 1970])
+        valid = load._epochs_in_data(self.raw, i_start, -.1, .3)
+        self.assertEqual(valid.tolist(), [False, True, True, True, False])
+        # decim=2 reads a filter margin of 20 samples on each side
+        valid = load._epochs_in_data(self.raw, i_start + 20, -.1, .3, 2)
+        self.assertEqual(valid.tolist(), [False, True, True, False, False])
+
+
+class TestFiff(_MneTestCase):
+    def test_drop(self):
+        "events whose epochs exceed the data are dropped, as by mne.Epochs"
+        raw = _raw(3, first_samp=100)
+        events = _events(3)
+        events[:,0] += raw.first_samp
+        events[:3,0] = raw.first_samp + np.arange(3)
+        events[-2:,0] = raw.first_samp + len(raw) - 5
+        self.mne.raws['raw.fif'] = raw
+        self.mne.events['raw-eve.fif'] = events
+        conditions = {1: 'a', 3: 'c'}
+        ds = load.fiff('raw.fif', 'raw-eve.fif', conditions, tstart=-.1,
+                       tstop=.3, dtype=np.float64)
+        
+        ref = []
+        ref_ids = []
+        for ID in conditions:
+            for i in events[events[:,2] == ID, 0] - raw.first_samp:
+                if i < 10 or i + 31 > len(raw):
+                    continue
+                epoch = raw.x[:, i - 10:i + 31].T
+                ref.append(epoch - epoch[:11].mean(0))
+                ref_ids.append(ID)
+        self.assertEqual(ds.N, len(ref))
+        self.assertTrue(ds.N < np.sum((events[:,2] == 1) | (events[:,2] == 3)))
+        assert_allclose(ds['MEG'].data, ref)
+        self.assertEqual(list(ds['condition'].as_labels()),
+                         [conditions[ID] for ID in ref_ids])
+
+    def test_dtype(self):
+        "data are read as data.defaults['dtype'] unless dtype is specified"
+        self.mne.raws['raw.fif'] = _raw(3)
+        self.mne.events['raw-eve.fif'] = _events(3)
+        conditions = {1: 'a'}
+        old = _data.defaults['dtype']
+        try:
+            for default in (np.float32, np.float64):
+                _data.defaults['dtype'] = default
+                ds = load.fiff('raw.fif', 'raw-eve.fif', conditions, 
+                               tstart=-.1, tstop=.3)
+                self.assertEqual(ds['MEG'].data.dtype, default)
+            ds_16 = load.fiff('raw.fif', 'raw-eve.fif', conditions, 
+                              tstart=-.1, tstop=.3, dtype=np.float16)
+            self.assertEqual(ds_16['MEG'].data.dtype, np.float16)
+        finally:
+            _data.defaults['dtype'] = old
+        # float32 data are rounded from the float64 computation
+        ds_32 = load.fiff('raw.fif', 'raw-eve.fif', conditions, tstart=-.1,
+                          tstop=.3, dtype=np.float32)
+        self.assertTrue(np.array_equal(ds_32['MEG'].data, 
+                                       ds['MEG'].data.astype(np.float32)))
+
+
+class TestEpochData(_MneTestCase):
+    def setUp(self):
+        _MneTestCase.setUp(self)
+        self.raw = _raw(6, first_samp=100)
+        self.mne.raws['raw.fif'] = self.raw
+        self.i_start = _events(6, n_events=12)[:,0] + self.raw.first_samp
+        self.picks = np.array([0, 2, 3])
+
+    def _data(self, cache_size=100, dtype=np.float64):
+        return load.fiff_epoch_data('raw.fif', self.i_start, self.picks, 
+                                    -.1, .3, cache_size=cache_size, 
+                                    dtype=dtype)
+
+    def _reference(self):
+        "naive extraction, one epoch at a time"
+        out = []
+        for i in self.i_start - self.raw.first_samp:
+            epoch = self.raw.x[self.picks, i - 10:i + 31].T
+            out.append(epoch - epoch[:11].mean(0))
+        return np.array(out)
+
+    def test_indexing(self):
+        ref = self._reference()
+        data = self._data()
+        self.assertEqual(data.shape, ref.shape)
+        self.assertEqual(len(data), 12)
+        bool_index = np.arange(12) % 3 == 0
+        for index in (3, -1, slice(2, 8), slice(None, None, -3), [5, 1, 5],
+                      np.array([0, 11]), bool_index, (4, 20), 
+                      (slice(1, 4), slice(None), 1), ([2, 7], slice(5, 9))):
+            assert_allclose(data[index], ref[index])
+        assert_allclose(np.asarray(data), ref)
+        self.assertEqual(np.asarray(data, np.float32).dtype, np.float32)
+        self.assertEqual(self._data(dtype=np.float32)[2].dtype, np.float32)
+        assert_allclose(self._data(dtype=np.float32)[:], ref, rtol=1e-5, 
+                        atol=1e-5)
+        
+        # lazy ndvar
+        ds = _data.dataset(_data.var(self.i_start, 'i_start'))
+        ds.info['source'] = 'raw.fif'
+        load.fiff_epochs(ds, tstart=-.1, tstop=.3, lazy=True, 
+                         dtype=np.float64)
+        Y = ds['MEG']
+        self.assertTrue(isinstance(Y.data, load.fiff_epoch_data))
+        self.raw.reads = []
+        assert_allclose(Y.data[[1, 3]], np.asarray(Y.data)[[1, 3]])
+
+    def test_lru(self):
+        ref = self._reference()
+        data = self._data(cache_size=3)
+        assert_allclose(data[[0, 1, 2]], ref[[0, 1, 2]])
+        self.assertEqual(list(data._cache), [0, 1, 2])
+        # a hit does not read and makes the epoch the most recently used
+        self.raw.reads = []
+        assert_allclose(data[0], ref[0])
+        self.assertEqual(self.raw.reads, [])
+        self.assertEqual(list(data._cache), [1, 2, 0])
+        # a miss evicts the least recently used epoch (hits are used before
+        # the missing epochs are read)
+        assert_allclose(data[[3, 2]], ref[[3, 2]])
+        self.assertEqual(len(self.raw.reads), 1)
+        self.assertEqual(list(data._cache), [0, 2, 3])
+        # reading more epochs than the cache holds keeps the last ones
+        assert_allclose(data[4:10], ref[4:10])
+        self.assertEqual(list(data._cache), [7, 8, 9])
+        # cached epochs are not changed through the output
+        out = data[8]
+        out[:] = 0
+        assert_allclose(data[8], ref[8])
+        
+        # no cache
+        data = self._data(cache_size=0)
+        assert_allclose(data[[1, 1, 2]], ref[[1, 1, 2]])
+        self.assertEqual(len(data._cache), 0)
+
+    def test_pickle(self):
+        data = self._data()
+        data[:4]
+        data_unpickled = pickle.loads(pickle.dumps(data))
+        self.assertEqual(len(data_unpickled._cache), 0)
+        self.assertTrue(data_unpickled._raw is self.raw)
+        assert_allclose(data_unpickled[:], self._reference())
+
+
+class TestFiffSubjects(_MneTestCase):
+    conditions = {1: 'a', 3: 'c'}
+
+    def setUp(self):
+        _MneTestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.subjects = []
+        for seed in xrange(3):
+            raw = _raw(seed, first_samp=100 * seed)
+            events = _events(seed)
+            events[:,0] += raw.first_samp
+            # events with epochs exceeding the data
+            events[0,0] = raw.first_samp + 3
+            events[-1,0] = raw.first_samp + len(raw) - 5
+            self._add_subject('S%i' % seed, raw, events)
+
+    def tearDown(self):
+        _MneTestCase.tearDown(self)
+        shutil.rmtree(self.tempdir)
+
+    def _add_subject(self, subject, raw, events):
+        raw_path = '%s-raw.fif' % subject
+        events_path = '%s-eve.fif' % subject
+        self.mne.raws[raw_path] = raw
+        self.mne.events[events_path] = events
+        self.subjects.append((subject, raw_path, events_path))
+
+    def _reference(self):
+        "each subject and condition read separately, one epoch at a time"
+        out = []
+        ids = []
+        subjects = []
+        for subject, raw_path, events_path in self.subjects:
+            raw = self.mne.raws[raw_path]
+            events = self.mne.events[events_path]
+            for ID in self.conditions:
+                for i in events[events[:,2] == ID, 0] - raw.first_samp:
+                    if i < 10 or i + 31 > len(raw):
+                        continue
+                    epoch = raw.x[:, i - 10:i + 31].T
+                    out.append(epoch - epoch[:11].mean(0))
+                    ids.append(self.conditions[ID])
+                    subjects.append(subject)
+        return np.array(out), ids, subjects
+
+    def _check(self, ds):
+        ref, ref_ids, ref_subjects = self._reference()
+        assert_allclose(ds['MEG'].data, ref)
+        self.assertEqual(list(ds['condition'].as_labels()), ref_ids)
+        self.assertEqual(list(ds['subject'].as_labels()), ref_subjects)
+        self.assertTrue(ds['subject'].random)
+        assert_allclose(ds['MEG'].time.x, np.arange(-10, 31) / 100.)
+
+    def test_subjects(self):
+        for n_workers in (1, 2):
+            ds = load.fiff_subjects(self.subjects, self.conditions, tstart=-.1,
+                                    tstop=.3, dtype=np.float64, 
+                                    n_workers=n_workers)
+            self._check(ds)
+        # memory-mapped
+        path = os.path.join(self.tempdir, 'meg.ndvar')
+        ds = load.fiff_subjects(self.subjects, self.conditions, tstart=-.1,
+                                tstop=.3, dtype=np.float64, memmap=path,
+                                n_workers=2)
+        self._check(ds)
+        self.assertTrue(isinstance(ds['MEG'].data, np.memmap))
+        del ds
+
+    def test_mismatch(self):
+        rng = np.random.RandomState(5)
+        events = _events(5)
+        mismatched = (_Raw(rng.randn(5, 2000), sfreq=200.),
+                      _Raw(rng.randn(4, 2000)),
+                      _Raw(rng.randn(5, 2000), ch_names=['MEG %03i' % i for i
+                                                         in (0, 1, 2, 4, 3)]),
+                      _Raw(rng.randn(6, 2000), ch_names=['MEG 000', 'MEG 001',
+                                                         'EEG 001', 'MEG 002',
+                                                         'MEG 003', 'MEG 004']))
+        subjects = self.subjects
+        for raw in mismatched:
+            self.subjects = subjects[:2]
+            self._add_subject('S5', raw, events)
+            self.assertRaises(ValueError, load.fiff_subjects, self.subjects,
+                              self.conditions, n_workers=1)
+
+
+class TestCache(_MneTestCase):
+    def setUp(self):
+        _MneTestCase.setUp(self)
+        self.tempdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tempdir, 'cache')
+        # the cache key uses the size and modification time of the raw file
+        self.raw_path = os.path.join(self.tempdir, 'raw.fif')
+        with open(self.raw_path, 'w') as fid:
+            fid.write('raw')
+        self.raw = _raw(4, first_samp=100)
+        self.mne.raws[self.raw_path] = self.raw
+        self.i_start = _events(4)[:,0] + self.raw.first_samp
+
+    def tearDown(self):
+        _MneTestCase.tearDown(self)
+        shutil.rmtree(self.tempdir)
+
+    def _load(self, cache=True, **kwargs):
+        "returns the epochs and the number of segments read from the raw file"
+        args = dict(tstart=-.1, tstop=.3, dtype=np.float64)
+        args.update(kwargs)
+        ds = _data.dataset(_data.var(self.i_start.copy(), 'i_start'))
+        ds.info['source'] = self.raw_path
+        self.raw.reads = []
+        load.fiff_epochs(ds, cache=cache and self.cache_dir, **args)
+        return ds[ds.default_DV], len(self.raw.reads)
+
+    def _n_files(self):
+        return len([fn for fn in os.listdir(self.cache_dir) 
+                    if fn.endswith('.ndvar')])
+
+    def _check_equal(self, Y, ref):
+        assert_allclose(Y.data, ref.data)
+        self.assertTrue(_data._dims_equal(Y.dims, ref.dims))
+        self.assertEqual(Y.sensor.net_name, ref.sensor.net_name)
+        self.assertEqual(Y.properties['samplingrate'], 
+                         ref.properties['samplingrate'])
+
+    def test_hit(self):
+        for kwargs in ({}, {'decim': 2}, {'baseline': None}):
+            ref, _ = self._load(False, **kwargs)
+            Y, n_reads = self._load(**kwargs)
+            self.assertTrue(n_reads > 0)
+            self._check_equal(Y, ref)
+            # cache hit: the same data without reading the raw file
+            n_files = self._n_files()
+            Y, n_reads = self._load(**kwargs)
+            self.assertEqual(n_reads, 0)
+            self.assertEqual(self._n_files(), n_files)
+            self.assertTrue(isinstance(Y.data, np.memmap))
+            self._check_equal(Y, ref)
+        # name and properties are not part of the cached data
+        Y, n_reads = self._load(name='MEG2', properties={'ylim': 1})
+        self.assertEqual(n_reads, 0)
+        self.assertEqual(Y.name, 'MEG2')
+        self.assertEqual(Y.properties['ylim'], 1)
+
+    def test_miss(self):
+        self._load()
+        n_files = 1
+        for kwargs in ({'tstart': -.05}, {'tstop': .2}, {'decim': 2}, 
+                       {'baseline': None}, {'baseline': (-.05, 0)}, 
+                       {'dtype': np.float32}, 
+                       {'sensorsname': 'other-sensors'}):
+            ref, _ = self._load(False, **kwargs)
+            Y, n_reads = self._load(**kwargs)
+            self.assertTrue(n_reads > 0)
+            n_files += 1
+            self.assertEqual(self._n_files(), n_files)
+            self._check_equal(Y, ref)
+        
+        # changed sensor locations
+        self.raw.info['chs'][0]['loc'][:3] += 1
+        ref, _ = self._load(False)
+        Y, n_reads = self._load()
+        self.assertTrue(n_reads > 0)
+        self._check_equal(Y, ref)
+        
+        # changed events
+        self.i_start[0] += 1
+        Y, n_reads = self._load()
+        self.assertTrue(n_reads > 0)
+        
+        # changed raw file
+        with open(self.raw_path, 'a') as fid:
+            fid.write('-changed')
+        Y, n_reads = self._load()
+        self.assertTrue(n_reads > 0)
+
+
+class TestFindStimEvents(unittest.TestCase):
+    chunk_bytes = (1, 8, 24, 100, 1000, load._chunk_bytes)
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        n_samples = 500
+        # event IDs with events of different lengths, adjacent events with
+        # different IDs and an event at the first sample
+        ids = np.zeros(n_samples, dtype=int)
+        i = 0
+        while i < n_samples:
+            ids[i:i + rng.randint(1, 6)] = rng.randint(0, 8)
+            i += rng.randint(1, 6)
+        ids[:3] = 5
+        self.ids = ids
+        # trigger lines: bit i of the ID on line i, with noise
+        lines = (ids[None,:] >> np.arange(3)[:,None]) & 1
+        lines = lines * 5. + rng.uniform(-.5, .5, lines.shape)
+        x = np.vstack((rng.randn(2, n_samples), ids[None,:] + .1, lines))
+        names = ['MEG 001', 'MEG 002', 'STI 014', 'STI 001', 'STI 002',
+                 'STI 003']
+        self.raw = _Raw(x, first_samp=1000, ch_names=names)
+
+    def _reference(self):
+        "events from the whole ID time course"
+        code = np.concatenate(([0], self.ids))
+        index = np.flatnonzero((code[1:] != code[:-1]) & (code[1:] != 0))
+        return np.column_stack((index + self.raw.first_samp,
+                                np.zeros_like(index), self.ids[index]))
+
+    def _find(self, chunk_bytes, stim):
+        old = load._chunk_bytes
+        try:
+            load._chunk_bytes = chunk_bytes
+            return load._find_stim_events(self.raw, stim)
+        finally:
+            load._chunk_bytes = old
+
+    def test_events(self):
+        ref = self._reference()
+        self.assertEqual(ref[0, 0], self.raw.first_samp)
+        for chunk_bytes in self.chunk_bytes:
+            for stim in ('STI 014', 2, ['STI 014']):
+                events = self._find(chunk_bytes, stim)
+                self.assertTrue(np.array_equal(events, ref))
+            for stim in ([3, 4, 5], ['STI 001', 'STI 002', 'STI 003']):
+                events = self._find(chunk_bytes, stim)
+                self.assertTrue(np.array_equal(events, ref))
+
+    def test_errors(self):
+        self.assertRaises(ValueError, load._find_stim_events, self.raw,
+                          'STI 101')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+'''
+Tests for :mod:`eelbrain.utils.parallel`, comparing the results with worker
+processes with a loop in the current process.
+
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from eelbrain.utils import parallel
+
+
+
+def _batch(data, context, rng, n):
+    "n random values offset by the data sum (module-level for map_batches)"
+    return data.sum() + context * rng.randn(n)
+
+
+def _fill(out, task):
+    "fill cases start:stop with value (module-level for map_into)"
+    start, stop, value = task
+    out[start:stop] = value * np.arange(start, stop)[:,None]
+    return os.getpid()
+
+
+
+class TestMapBatches(unittest.TestCase):
+    def setUp(self):
+        self.data = np.arange(12.).reshape((3, 4))
+        self.batches = [5, 5, 5, 3]
+
+    def _reference(self, seed):
+        "each batch with its own RandomState((seed, batch_index))"
+        out = []
+        for i, n in enumerate(self.batches):
+            rng = np.random.RandomState((seed, i))
+            out.append(self.data.sum() + 2. * rng.randn(n))
+        return np.concatenate(out)
+
+    def test_workers(self):
+        for seed in (0, 3):
+            ref = self._reference(seed)
+            for n_workers in (1, 2, 3, 8):
+                dist = parallel.map_batches(_batch, self.data, self.batches,
+                                            context=2., n_workers=n_workers,
+                                            seed=seed)
+                self.assertTrue(np.array_equal(dist, ref))
+
+    def test_defaults(self):
+        ref = self._reference(0)
+        old = parallel.defaults['n_workers']
+        try:
+            for n_workers in (1, 2, None):
+                parallel.defaults['n_workers'] = n_workers
+                dist = parallel.map_batches(_batch, self.data, self.batches,
+                                            context=2.)
+                self.assertTrue(np.array_equal(dist, ref))
+        finally:
+            parallel.defaults['n_workers'] = old
+
+    def test_get_n_workers(self):
+        self.assertEqual(parallel.get_n_workers(3), 3)
+        old = parallel.defaults['n_workers']
+        try:
+            parallel.defaults['n_workers'] = 2
+            self.assertEqual(parallel.get_n_workers(), 2)
+            parallel.defaults['n_workers'] = None
+            self.assertTrue(parallel.get_n_workers() >= 1)
+        finally:
+            parallel.defaults['n_workers'] = old
+
+
+class TestMapInto(unittest.TestCase):
+    shape = (20, 3)
+    tasks = [(0, 7, 1.), (7, 8, 2.), (8, 20, 3.)]
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _reference(self):
+        out = np.zeros(self.shape)
+        for start, stop, value in self.tasks:
+            out[start:stop] = value * np.arange(start, stop)[:,None]
+        return out
+
+    def test_serial(self):
+        out = np.zeros(self.shape)
+        pids = parallel.map_into(_fill, self.tasks, out, n_workers=1)
+        assert_allclose(out, self._reference())
+        self.assertEqual(pids, [os.getpid()] * len(self.tasks))
+
+    def test_memmap(self):
+        path = os.path.join(self.tempdir, 'out.dat')
+        out = np.memmap(path, np.float64, 'w+', shape=self.shape)
+        pids = parallel.map_into(_fill, self.tasks, out, n_workers=2)
+        assert_allclose(out, self._reference())
+        self.assertEqual(len(pids), len(self.tasks))
+        self.assertFalse(os.getpid() in pids)
+        del out
+
+    def test_shared(self):
+        raw, out = parallel.shared_empty(self.shape)
+        out[:] = 0
+        pids = parallel.map_into(_fill, self.tasks, out, raw=raw, n_workers=2)
+        assert_allclose(out, self._reference())
+        self.assertFalse(os.getpid() in pids)
+
+    def test_errors(self):
+        out = np.zeros(self.shape)
+        self.assertRaises(ValueError, parallel.map_into, _fill, self.tasks,
+                          out, n_workers=2)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
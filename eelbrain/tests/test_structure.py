@@ -0,0 +1,154 @@
+'''
+Tests for :class:`eelbrain.vessels.structure.celltable`, comparing the grouped
+cell data and statistics with a cell-by-cell reference.
+
+'''
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+import scipy.stats
+
+from eelbrain.utils import statfuncs
+from eelbrain.vessels import data as _data
+from eelbrain.vessels.structure import celltable
+
+
+
+def _cell_index(X, cell):
+    "boolean index of the cases in ``cell``"
+    if _data.isfactor(X):
+        return X.x == cell
+    else:
+        index = np.ones(X.N, dtype=bool)
+        for f, code in zip(X.factors, cell):
+            index &= (f.x == code)
+        return index
+
+def _cell_data(y, X, cell, match=None, match_func=np.mean):
+    "reference data for one cell, combined by match value if match is given"
+    index = _cell_index(X, cell)
+    if match is None:
+        return y[index], None
+    ids = np.unique(match.x[index])
+    data = [match_func(y[index & (match.x == i)], axis=0) for i in ids]
+    return np.array(data), ids
+
+
+class TestCelltable(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        n = 48
+        self.A = _data.factor(np.tile([0, 1, 2], 16), name='A')
+        self.B = _data.factor(np.repeat([0, 1], 24), name='B')
+        self.S = _data.factor(np.tile(np.repeat(np.arange(8), 3), 2),
+                              name='S', random=True)
+        # shuffle the order of the cases so that cells are not contiguous
+        order = rng.permutation(n)
+        self.A = self.A[order]
+        self.B = self.B[order]
+        self.S = self.S[order]
+        self.Y = _data.var(rng.randn(n), name='Y')
+        # unequal cell sizes
+        self.unequal = np.ones(n, dtype=bool)
+        self.unequal[np.flatnonzero(self.A.x == 0)[:5]] = False
+
+    def _check_data(self, Y, X, match=None, sub=None, match_func=np.mean):
+        ct = celltable(Y, X, match=match, sub=sub, match_func=match_func)
+        if sub is not None:
+            Y = Y[sub]
+            X = X[sub]
+            if match is not None:
+                match = match[sub]
+        y = Y.data if _data.isndvar(Y) else Y.x
+
+        self.assertEqual(ct.indexes, sorted(X.cells.keys()))
+        groups = []
+        for cell in ct.indexes:
+            data, ids = _cell_data(y, X, cell, match, match_func)
+            assert_allclose(ct.data[cell], data)
+            if match is not None:
+                self.assertTrue(np.all(ct.groups[cell] == ids))
+                groups.append(ids.tostring())
+
+        if match is not None:
+            within = np.array([[g1 == g2 for g2 in groups] for g1 in groups])
+            self.assertTrue(np.all(ct.within_matrix == within))
+            self.assertEqual(ct.all_within, np.all(within))
+        return ct
+
+    def test_data(self):
+        for X in (self.A, self.A % self.B):
+            for sub in (None, self.unequal):
+                self._check_data(self.Y, X, sub=sub)
+                self._check_data(self.Y, X, match=self.S, sub=sub)
+                self._check_data(self.Y, X, match=self.S, sub=sub,
+                                 match_func=np.median)
+
+    def test_ndvar(self):
+        rng = np.random.RandomState(1)
+        time = _data.var(np.arange(10) * .01, 'time')
+        Y = _data.ndvar((time,), rng.randn(48, 10), name='Y')
+        for sub in (None, self.unequal):
+            self._check_data(Y, self.A, sub=sub)
+            self._check_data(Y, self.A, match=self.S, sub=sub)
+
+    def test_get_statistic(self):
+        stats = [(np.mean, lambda x: np.mean(x)),
+                 (np.median, lambda x: np.median(x)),
+                 ('sem', lambda x: scipy.stats.sem(x)),
+                 ('2sem', lambda x: 2 * scipy.stats.sem(x)),
+                 ('std', lambda x: np.std(x, ddof=1)),
+                 ('2std', lambda x: 2 * np.std(x, ddof=1)),
+                 ('ci', lambda x: statfuncs.CIhw(x)),
+                 ('.99ci', lambda x: statfuncs.CIhw(x, p=.99))]
+
+        for X in (self.A, self.A % self.B):
+            for match in (None, self.S):
+                # equal cell sizes use the stacked computation, unequal cell
+                # sizes the loop
+                for sub in (None, self.unequal):
+                    ct = celltable(self.Y, X, match=match, sub=sub)
+                    for function, ref_func in stats:
+                        ref = [ref_func(ct.data[cell]) for cell in ct.indexes]
+
+                        values = ct.get_statistic(function, out=list)
+                        self.assertIsInstance(values, list)
+                        assert_allclose(values, ref)
+
+                        values = ct.get_statistic(function, out=np.array)
+                        assert_allclose(values, ref)
+
+                        values = ct.get_statistic(function, out=dict)
+                        self.assertEqual(sorted(values), ct.indexes)
+                        for cell, value in zip(ct.indexes, ref):
+                            assert_allclose(values[cell], value)
+
+        # multiplier and p through a
+        ct = celltable(self.Y, self.A)
+        ref = [3 * scipy.stats.sem(ct.data[cell]) for cell in ct.indexes]
+        assert_allclose(ct.get_statistic('sem', out=list, a=3), ref)
+        ref = [statfuncs.CIhw(ct.data[cell], p=.9) for cell in ct.indexes]
+        assert_allclose(ct.get_statistic('ci', out=list, a=.9), ref)
+
+    def test_get_statistic_ndvar(self):
+        rng = np.random.RandomState(2)
+        time = _data.var(np.arange(10) * .01, 'time')
+        Y = _data.ndvar((time,), rng.randn(48, 10), name='Y')
+        for sub in (None, self.unequal):
+            ct = celltable(Y, self.A, match=self.S, sub=sub)
+            for function, ref_func in ((np.mean, np.mean),
+                                       ('sem', scipy.stats.sem)):
+                ref = [ref_func(ct.data[cell], axis=0) for cell in ct.indexes]
+                values = ct.get_statistic(function, out=list)
+                assert_allclose(values, ref)
+
+    def test_errors(self):
+        ct = celltable(self.Y, self.A)
+        self.assertRaises(ValueError, ct.get_statistic, 'var')
+        self.assertRaises(ValueError, ct.get_statistic, np.mean, out=tuple)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
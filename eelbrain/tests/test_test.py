@@ -0,0 +1,137 @@
+'''
+Tests for the resampling in :mod:`eelbrain.analyze.test`, comparing the
+vectorized resampling indexes and bootstrap statistics with case-by-case
+references.
+
+'''
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+import scipy.stats
+
+from eelbrain.analyze import test
+from eelbrain.vessels import data as _data
+
+
+
+def _resample_index(N, unit, replacement, samples, rng):
+    """
+    reference: resampling indexes built case by case from the same random
+    numbers as :func:`test.resample_index`
+
+    """
+    codes = unit.x
+    units = sorted(set(codes))
+    unit_cases = [[i for i in xrange(N) if codes[i] == u] for u in units]
+    n_units = len(units)
+    size = len(unit_cases[0])
+    if replacement:
+        source = rng.randint(n_units, size=(samples, n_units))
+    else:
+        source = np.argsort(rng.rand(samples, n_units), axis=1)
+    within = np.argsort(rng.rand(samples, n_units, size), axis=2)
+    out = np.empty((samples, N), dtype=int)
+    for s in xrange(samples):
+        for u in xrange(n_units):
+            for k in xrange(size):
+                case = unit_cases[source[s, u]][within[s, u, k]]
+                out[s, unit_cases[u][k]] = case
+    return out
+
+
+class TestResampleIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # 6 units with 4 cases each, in shuffled order
+        self.unit = _data.factor(rng.permutation(np.repeat(np.arange(6), 4)),
+                                 name='unit', random=True)
+        self.N = 24
+
+    def test_unit(self):
+        for replacement in (True, False):
+            index = test.resample_index(self.N, self.unit, replacement, 50,
+                                        np.random.RandomState(1))
+            ref = _resample_index(self.N, self.unit, replacement, 50,
+                                  np.random.RandomState(1))
+            self.assertEqual(index.shape, (50, self.N))
+            self.assertTrue(np.array_equal(index, ref))
+
+            # the cases of each unit are replaced by all cases of one unit
+            codes = self.unit.x
+            for row in index:
+                sources = []
+                for u in xrange(6):
+                    source = codes[row[codes == u]]
+                    self.assertEqual(len(set(source)), 1)
+                    self.assertEqual(sorted(row[codes == u]),
+                                     np.flatnonzero(codes == source[0]).tolist())
+                    sources.append(source[0])
+                if not replacement:
+                    self.assertEqual(sorted(sources), range(6))
+
+    def test_no_unit(self):
+        index = test.resample_index(self.N, None, False, 100,
+                                    np.random.RandomState(2))
+        self.assertEqual(index.shape, (100, self.N))
+        for row in index:
+            self.assertEqual(sorted(row), range(self.N))
+
+        index = test.resample_index(self.N, None, True, 2000,
+                                    np.random.RandomState(2))
+        self.assertEqual(index.shape, (2000, self.N))
+        self.assertTrue(index.min() >= 0 and index.max() < self.N)
+        # each row is drawn independently with replacement
+        self.assertTrue(any(len(set(row)) < self.N for row in index))
+        counts = np.bincount(index.ravel(), minlength=self.N) / 2000.
+        assert_allclose(counts, 1, atol=.1)
+
+    def test_errors(self):
+        unit = _data.factor(np.repeat(np.arange(5), [4, 4, 4, 4, 3]),
+                            name='unit')
+        self.assertRaises(ValueError, test.resample_index, 19, unit)
+
+    def test_resample(self):
+        "_resample yields the data indexed by resample_index"
+        Y = _data.var(np.random.RandomState(3).randn(self.N), name='Y')
+        for unit in (None, self.unit):
+            np.random.seed(4)
+            index = test.resample_index(self.N, unit, True, 20)
+            np.random.seed(4)
+            resampled = [Yr.x.copy() for Yr in
+                         test._resample(Y, unit, samples=20)]
+            assert_allclose(resampled, Y.x[index])
+
+
+class TestBootstrapPairwise(unittest.TestCase):
+    def test_match(self):
+        rng = np.random.RandomState(5)
+        n_subjects = 8
+        X = _data.factor(np.tile(np.arange(3), n_subjects), name='X',
+                         labels={0: 'a', 1: 'b', 2: 'c'})
+        match = _data.factor(np.repeat(np.arange(n_subjects), 3),
+                             name='subject', random=True)
+        Y = _data.var(rng.randn(3 * n_subjects) + X.x * .3, name='Y')
+
+        np.random.seed(6)
+        bp = test.bootstrap_pairwise(Y, X, match=match, samples=200)
+        self.assertTrue(np.array_equal(bp.resampled[0], Y.x))
+
+        # paired t-tests for each sample
+        t = []
+        for y in bp.resampled:
+            groups = [y[X.x == i][np.argsort(match.x[X.x == i])]
+                      for i in xrange(3)]
+            t.append([scipy.stats.ttest_rel(groups[g1], groups[g2])[0]
+                      for g1, g2 in ((0, 1), (0, 2), (1, 2))])
+        t = np.array(t)
+        assert_allclose(bp.t, t[0])
+        assert_allclose(bp.t_resampled, np.abs(t[1:]).max(1))
+        p = [np.mean(bp.t_resampled > abs(t_i)) for t_i in t[0]]
+        assert_allclose(bp.test_boot(bp.t), p)
+        self.assertEqual(bp._comp_names, ['a - b', 'a - c', 'b - c'])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
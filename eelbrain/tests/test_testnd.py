@@ -0,0 +1,117 @@
+'''
+Tests for the rank-based tests in :mod:`eelbrain.analyze.testnd`, comparing
+the vectorized implementations with :mod:`scipy.stats` column by column.
+
+'''
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+import scipy.stats
+
+from eelbrain.vessels import data as _data
+from eelbrain.analyze import testnd
+
+
+
+class TestRankTests(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+    
+    def _ints(self, low, high, shape):
+        "data with many ties"
+        return self.rng.randint(low, high, size=shape).astype(float)
+    
+    def test_rankdata(self):
+        a = self._ints(0, 5, (12, 30))
+        ranks, ties = testnd._rankdata(a)
+        for i in xrange(a.shape[1]):
+            assert_allclose(ranks[:,i], scipy.stats.rankdata(a[:,i]))
+            _, counts = np.unique(a[:,i], return_counts=True)
+            assert_allclose(ties[i], np.sum(counts ** 3 - counts))
+        
+        # more than 2 dimensions
+        a = self._ints(0, 5, (12, 3, 4))
+        ranks, ties = testnd._rankdata(a)
+        ranks_2d, ties_2d = testnd._rankdata(a.reshape((12, 12)))
+        assert_allclose(ranks.reshape((12, 12)), ranks_2d)
+        assert_allclose(ties.ravel(), ties_2d)
+    
+    def test_wilcoxon(self):
+        diff = self._ints(-3, 4, (15, 40))
+        z, p = testnd._wilcoxon(diff)
+        for i in xrange(diff.shape[1]):
+            _, p_ref = scipy.stats.wilcoxon(diff[:,i], correction=False)
+            assert_allclose(p[i], p_ref)
+        # direction
+        z, _ = testnd._wilcoxon(self.rng.randn(15, 5) + 2)
+        self.assertTrue(np.all(z > 0))
+    
+    def test_mannwhitney(self):
+        x1 = self._ints(0, 6, (10, 20))
+        x2 = self._ints(1, 7, (13, 20))
+        z, p = testnd._mannwhitney(x1, x2)
+        for i in xrange(x1.shape[1]):
+            _, p_ref = scipy.stats.mannwhitneyu(x1[:,i], x2[:,i], 
+                                                use_continuity=False,
+                                                alternative='two-sided')
+            assert_allclose(p[i], p_ref)
+        z, _ = testnd._mannwhitney(x1 + 10, x2)
+        self.assertTrue(np.all(z > 0))
+    
+    def test_friedman(self):
+        data = [self._ints(0, 4, (10, 20)) for _ in xrange(3)]
+        chi2, p = testnd._friedman(data)
+        for i in xrange(20):
+            ref = scipy.stats.friedmanchisquare(*[d[:,i] for d in data])
+            assert_allclose((chi2[i], p[i]), ref)
+    
+    def test_kruskal(self):
+        data = [self._ints(0, 4, (n, 20)) for n in (10, 8, 7)]
+        H, p = testnd._kruskal(data)
+        for i in xrange(20):
+            ref = scipy.stats.kruskal(*[d[:,i] for d in data])
+            assert_allclose((H[i], p[i]), ref)
+
+
+
+class TestTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        time = _data.var(np.arange(10) / 100., 'time')
+        self.Ys = [_data.ndvar((time,), rng.randn(12, 10) + i * .5, 
+                               name='c%i' % i) for i in xrange(3)]
+        self.rng = rng
+    
+    def test_rank_tests(self):
+        "test() uses the rank test corresponding to the design"
+        Y0, Y1, Y2 = self.Ys
+        z, _ = testnd._wilcoxon(Y0.data - Y1.data)
+        stat, _ = testnd.test([Y0, Y1], parametric=False, match=True)
+        assert_allclose(stat.data[0], z)
+        
+        z, _ = testnd._mannwhitney(Y0.data, Y1.data)
+        stat, _ = testnd.test([Y0, Y1], parametric=False)
+        assert_allclose(stat.data[0], z)
+        
+        H, _ = testnd._kruskal([Y.data for Y in self.Ys])
+        stat, P = testnd.test(self.Ys, parametric=False)
+        assert_allclose(stat.data[0], H)
+        self.assertEqual(stat.properties['test'], 'Kruskal-Wallis')
+    
+    def test_match(self):
+        "cases are aligned by the match factors"
+        Y0, Y1 = self.Ys[:2]
+        order = self.rng.permutation(12)
+        Y1_shuffled = _data.ndvar(Y1.dims, Y1.data[order], name='c1')
+        match = [_data.factor(range(12), name='subject'), 
+                 _data.factor(order, name='subject')]
+        ref, _ = testnd.test([Y0, Y1], parametric=False, match=True)
+        stat, _ = testnd.test([Y0, Y1_shuffled], parametric=False, 
+                              match=match)
+        assert_allclose(stat.data, ref.data)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
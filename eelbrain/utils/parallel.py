@@ -0,0 +1,209 @@
+'''
+Process pool scheduler for permutation and bootstrap procedures.
+
+The data array is copied once into shared memory, from where the worker
+processes read it without any pickling. Work is divided into batches, each of
+which is processed with its own random number generator, initialized with
+``RandomState((seed, batch_index))``. Results are therefore reproducible and
+do not depend on the number of worker processes::
+
+    >>> def batch_func(data, context, rng, n):
+    ...     "returns one value for each of n permutations"
+    ...
+    >>> dist = map_batches(batch_func, data, [100] * 10, n_workers=4)
+
+``batch_func`` and ``context`` need to be picklable (i.e., ``batch_func``
+needs to be a module-level function).
+
+Tasks that fill parts of a large output array (e.g., loading data) can use
+:func:`map_into`: workers write directly into an array in shared memory
+(created with :func:`shared_empty`) or into a :class:`numpy.memmap`.
+
+
+Created on Oct 17, 2012
+
+@author: christian
+'''
+
+import ctypes
+import logging
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+
+# parallel execution is opt-in: by default, everything runs in the calling 
+# process
+defaults = dict(n_workers=1, # number of worker processes (None: one per CPU)
+                )
+
+
+# set in worker processes by _init_worker and _init_writer
+_worker_data = None
+_worker_context = None
+_worker_out = None
+
+
+
+def shared_copy(a):
+    """
+    Returns ``(raw, array)``: a copy of array ``a`` in shared memory, as
+    the RawArray and as numpy array viewing the RawArray.
+
+    """
+    a = np.asarray(a)
+    raw = RawArray(ctypes.c_char, max(1, a.nbytes))
+    shared = np.frombuffer(raw, dtype=a.dtype, count=a.size).reshape(a.shape)
+    shared[...] = a
+    return raw, shared
+
+
+def shared_empty(shape, dtype=np.float64):
+    """
+    Returns ``(raw, array)``: a new (uninitialized) array in shared memory,
+    as the RawArray and as numpy array viewing the RawArray.
+
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = RawArray(ctypes.c_char, max(1, size * dtype.itemsize))
+    array = np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+    return raw, array
+
+
+def _init_worker(raw, dtype, shape, context):
+    global _worker_data, _worker_context
+    size = int(np.prod(shape))
+    _worker_data = np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+    _worker_context = context
+
+
+def _run_batch(args):
+    func, seed, batch_index, n = args
+    rng = np.random.RandomState((seed, batch_index))
+    return func(_worker_data, _worker_context, rng, n)
+
+
+def get_n_workers(n_workers=None):
+    """
+    Number of worker processes for the ``n_workers`` argument (``None``: 
+    ``defaults['n_workers']``, where ``None`` means one per CPU)
+    
+    """
+    if n_workers is None:
+        n_workers = defaults['n_workers']
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    return n_workers
+
+
+def map_batches(func, data, batches, context=None, n_workers=None, seed=0):
+    """
+    Calls ``func(data, context, rng, n)`` for each batch and returns the
+    concatenated results (in batch order).
+
+    func : callable
+        Module-level function returning an array of length n.
+    data : array
+        Data shared with the worker processes.
+    batches : list of int
+        Number of samples in each batch.
+    context :
+        Additional (picklable) argument for ``func``; sent once to each
+        worker.
+    n_workers : None | int
+        Number of worker processes (default is ``defaults['n_workers']``).
+    seed : int
+        Seed for the random number generators.
+
+    """
+    n_workers = min(get_n_workers(n_workers), len(batches))
+
+    tasks = [(func, seed, i, n) for i, n in enumerate(batches)]
+    if n_workers <= 1:
+        results = []
+        for _, seed, i, n in tasks:
+            rng = np.random.RandomState((seed, i))
+            results.append(func(data, context, rng, n))
+    else:
+        logging.debug("map_batches: %i batches on %i workers"
+                      % (len(batches), n_workers))
+        raw, shared = shared_copy(data)
+        initargs = (raw, shared.dtype, shared.shape, context)
+        pool = multiprocessing.Pool(n_workers, _init_worker, initargs)
+        try:
+            results = pool.map(_run_batch, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return np.concatenate(results)
+
+
+def _init_writer(spec):
+    global _worker_out
+    kind = spec[0]
+    if kind == 'memmap':
+        _, filename, dtype, shape, offset = spec
+        _worker_out = np.memmap(filename, dtype=dtype, mode='r+', shape=shape,
+                                offset=offset)
+    else:
+        _, raw, dtype, shape = spec
+        size = int(np.prod(shape))
+        _worker_out = np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+def _run_task(args):
+    func, task = args
+    result = func(_worker_out, task)
+    if isinstance(_worker_out, np.memmap):
+        _worker_out.flush()
+    return result
+
+
+def map_into(func, tasks, out, raw=None, n_workers=None):
+    """
+    Calls ``func(out, task)`` for each task and returns the list of results.
+    ``func`` is expected to write its output into (a part of) ``out``.
+
+    func : callable
+        Module-level function.
+    tasks : list
+        Picklable task descriptions.
+    out : array
+        Output array; with several worker processes, ``out`` needs to be a
+        :class:`numpy.memmap` of a whole file (which each worker opens in
+        ``'r+'`` mode) or
+        an array in shared memory created with :func:`shared_empty` (in
+        which case the corresponding ``raw`` needs to be provided as well).
+    raw : None | RawArray
+        Shared memory of ``out``.
+    n_workers : None | int
+        Number of worker processes (default is ``defaults['n_workers']``).
+
+    """
+    n_workers = min(get_n_workers(n_workers), len(tasks))
+
+    if n_workers <= 1:
+        return [func(out, task) for task in tasks]
+
+    if isinstance(out, np.memmap):
+        out.flush()
+        spec = ('memmap', out.filename, out.dtype, out.shape, out.offset)
+    elif raw is not None:
+        spec = ('shared', raw, out.dtype, out.shape)
+    else:
+        err = ("With n_workers > 1, out needs to be a memmap or an array "
+               "created with shared_empty()")
+        raise ValueError(err)
+
+    logging.debug("map_into: %i tasks on %i workers" % (len(tasks), n_workers))
+    pool = multiprocessing.Pool(n_workers, _init_writer, (spec,))
+    try:
+        results = pool.map(_run_task, [(func, task) for task in tasks],
+                           chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
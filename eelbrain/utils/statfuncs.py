@@ -27,17 +27,19 @@ def CI(x, p=.95):
     return [M-c, M+c]
 
 
-def CIhw(x, p=.95):
+def CIhw(x, p=.95, axis=0):
     """
     :returns: half-width of the confidence interval based on the inverse t-test 
         (`<http://en.wikipedia.org/wiki/Confidence_interval#Statistical_hypothesis_testing>`_). 
     
     :arg array x: data
     :arg float p: p value for confidence interval
+    :arg int axis: axis of ``x`` containing the observations
     
     """
-    N = len(x)
+    x = np.asarray(x)
+    N = x.shape[axis]
     t = scipy.stats.t.isf((1 - p) / 2, N - 1)
-    c = (np.std(x, ddof=1) * t) / np.sqrt(N)
+    c = (np.std(x, axis=axis, ddof=1) * t) / np.sqrt(N)
     return c
 
@@ -22,6 +22,12 @@ Properties
 `ylim` : float
     for plotting: default limit for the y-axis  
 
+`dtype` : dtype
+    dtype of ndvars derived from the data (arithmetic, summaries). By 
+    default, floating point data keep their dtype (data loaded from files use 
+    ``data.defaults['dtype']``, i.e. float32); summaries are accumulated in 
+    float64.
+
 `summary_func` : func
     function used to summarize the data (normally `np.mean`). Needs to take 
     `axis` kwargs.
@@ -221,11 +221,14 @@ Memory required in mb::
 from __future__ import division
 
 import cPickle as pickle
+import hashlib
 import logging
 import operator
 import os
 
 import numpy as np
+import scipy.signal
+import scipy.sparse
 import scipy.stats
 
 from eelbrain import fmtxt
@@ -238,15 +241,151 @@ defaults = dict(fullrepr = False,  # whether to display full arrays/dicts in __r
                 repr_len = 5,      # length of repr
                 v_fmt = '%.2f',    # standard value formatting
                 p_fmt = '%.3f',    # p value formatting
+                dtype = np.float32, # dtype for data loaded from files
                )
 
 
+def _compute_dtype(properties, dtype):
+    """
+    dtype for data derived from data of ``dtype``: the ``'dtype'`` property 
+    if it is set, ``dtype`` for floating point data and float64 otherwise.
+    
+    """
+    out = properties.get('dtype', None)
+    if out is None:
+        if np.issubdtype(dtype, np.floating):
+            out = dtype
+        else:
+            out = np.float64
+    return np.dtype(out)
+
+
+def _code_dtype(min_code, max_code):
+    "smallest integer dtype that can store codes in [min_code, max_code]"
+    if min_code >= 0:
+        return np.min_scalar_type(max_code)
+    # np.promote_types(int8, uint8) would be int16
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if info.min <= min_code and max_code <= info.max:
+            return np.dtype(dtype)
+    raise ValueError("Codes out of range: %r, %r" % (min_code, max_code))
+
+
+# summary functions that can accumulate in float64 (``dtype`` kwarg)
+_accumulating_funcs = (np.mean, np.sum, np.var, np.std)
+
+
+def _decim_factor(sfreq, decim=None, new_sfreq=None):
+    """
+    Integer decimation factor for downsampling data sampled at ``sfreq``, 
+    specified either directly (``decim``) or as the new sampling rate 
+    (``new_sfreq``, which needs to be an integer fraction of ``sfreq``).
+    
+    """
+    if new_sfreq is not None:
+        if decim is not None:
+            raise ValueError("decim and sfreq can not both be specified")
+        ratio = float(sfreq) / new_sfreq
+        decim = int(round(ratio))
+        if decim < 1 or abs(ratio - decim) > 1e-6 * ratio:
+            err = ("sfreq=%s: the new sampling rate needs to be an integer "
+                   "fraction of the sampling rate (%s Hz)" % (new_sfreq, sfreq))
+            raise ValueError(err)
+    elif decim is None:
+        decim = 1
+    elif int(decim) != decim or decim < 1:
+        raise ValueError("decim=%r: needs to be a positive integer" % decim)
+    return int(decim)
+
+
+def _decim_filter(decim):
+    """
+    Zero-phase (symmetric) FIR anti-aliasing low-pass filter for downsampling
+    by ``decim`` (the design used by :func:`scipy.signal.decimate`, cutoff at
+    the new Nyquist frequency).
+    
+    """
+    if decim == 1:
+        return np.ones(1)
+    return scipy.signal.firwin(20 * decim + 1, 1. / decim, window='hamming')
+
+
+def _fir_decimate(x, h, decim, start, n, axis):
+    """
+    Filter ``x`` with the FIR filter ``h`` and downsample by ``decim`` along
+    ``axis``, computing only the ``n`` output samples. Output sample ``i`` is
+    centered on input sample ``start + i * decim + len(h) // 2``, i.e. ``x``
+    needs ``len(h) // 2`` samples of padding on each side. Accumulates in 
+    float64.
+    
+    """
+    shape = list(x.shape)
+    shape[axis] = n
+    out = np.zeros(shape)
+    index = [slice(None)] * x.ndim
+    length = (n - 1) * decim + 1
+    for j, w in enumerate(h):
+        index[axis] = slice(start + j, start + j + length, decim)
+        out += w * x[tuple(index)]
+    return out
+
+
+
 class DimensionMismatchError(Exception):
     def __init__(self, data, dims):
         msg = "Dimensions of %r do not match %r"%(data, dims)
         Exception.__init__(self, msg)
 
 
+def _dims_equal(dims1, dims2):
+    """
+    True if two tuples of dimensions describe the same points: same names 
+    and lengths, and the same values (e.g. time points) or sensors (names 
+    and locations)
+    
+    """
+    if len(dims1) != len(dims2):
+        return False
+    for dim1, dim2 in zip(dims1, dims2):
+        if dim1 is dim2:
+            continue
+        elif dim1.name != dim2.name or len(dim1) != len(dim2):
+            return False
+        elif hasattr(dim1, 'locs3d'):
+            if (list(dim1.names) != list(dim2.names) 
+                or not np.allclose(dim1.locs3d, dim2.locs3d)):
+                return False
+        elif not np.allclose(dim1.x, dim2.x):
+            return False
+    return True
+
+
+
+def _array_state(x):
+    """
+    Key identifying an array and its current content (for invalidating 
+    caches of values derived from arrays that can be modified in place).
+    
+    """
+    digest = hashlib.md5(np.ascontiguousarray(x)).hexdigest()
+    return (id(x), x.dtype.str, x.shape, digest)
+
+
+def _effect_state(e):
+    """
+    key identifying an effect and the current values it is built from (see
+    _array_state); for factors and vars these are the values in ``e.x``, 
+    not the derived codes
+    
+    """
+    if e._stype_ == 'interaction':
+        return (id(e),) + tuple(_effect_state(b) for b in e.base)
+    elif e._stype_ in ('factor', 'var'):
+        return (id(e), _array_state(e.x))
+    else:
+        return (id(e), _array_state(e.as_effects))
+
 
 def _effect_eye(n):
     """Returns effect coding for n categories.
@@ -616,16 +755,11 @@ class var(_regressor_):
     
     def compress(self, X, name=None, func=np.mean):
         """
-        X: factor or interaction; returns a compressed factor with one value
-        for each cell in X.
+        X: factor or interaction; returns a compressed var with one value
+        for each (non-empty) cell in X, in the order of the sorted cell codes.
         
         """
-        # find new x
-        x = []
-        for i in sorted(X.cells.keys()):
-            x_i = self.x[X==i]
-            x.append(func(x_i))
-        x = np.array(x)
+        x = _cell_groups(X).reduce(self.x, func)
         
         # package and ship
         if name is None:
@@ -736,24 +870,23 @@ class factor(_regressor_):
         "Number of data points"
 
         # get unique categories and sort them in order of first occurrence
-        categories, c_sort = np.unique(x, return_index=True)
+        categories, c_sort, c_index = np.unique(x, return_index=True, 
+                                                return_inverse=True)
         self.df = len(categories) - 1
         if sort==True:
-            categories = categories[np.argsort(c_sort)]
-
-        # prepare data containers
+            order = np.argsort(c_sort)
+            categories = categories[order]
+            c_rank = np.empty(len(order), dtype=np.intp)
+            c_rank[order] = np.arange(len(order))
+            c_index = c_rank[c_index]
+
+        # prepare data containers (codes use the smallest integer dtype; the
+        # dtype is upgraded when new cells require it)
         if retain_label_codes:
-            if min(labels.keys()) >= 0 and max(labels.keys()) < 256:
-                dtype = np.uint8
-            else:
-                dtype = np.int32
+            dtype = _code_dtype(min(labels.keys()), max(labels.keys()))
         else:
-            if len(np.unique(x)) < 256:
-                dtype = np.uint8
-            else:
-                dtype = np.int32
+            dtype = _code_dtype(0, max(0, len(categories) - 1))
         
-        self.x = np.empty(self.N, dtype=dtype)
         self.cells = {}
         """
         {value -> label} dictionary, mapping ``int`` values in x to ``str`` 
@@ -765,15 +898,15 @@ class factor(_regressor_):
         if retain_label_codes:
             assert all(cat in labels for cat in categories)
             # retain codes provided in labels
-            for i, cat in enumerate(categories):
-                self.x[x==cat] = cat
+            self.x = x.astype(dtype)
+            for cat in categories:
                 self.cells[cat] = labels[cat]
                 if cat in colors:
                     self.colors[cat] = colors[cat]
         else:
             # reassign codes
+            self.x = c_index.astype(dtype)
             for i, cat in enumerate(categories):
-                self.x[x==cat] = i
                 if cat in labels:
                     self.cells[i] = labels[cat]
                 else:
@@ -785,23 +918,86 @@ class factor(_regressor_):
         # convenience arg
         self.indexes = sorted(self.cells.keys())
         
-        # x_deviation_coded
-        x = self.x
-        categories = np.unique(x)
-        cats = categories[:-1]
-        contrast = categories[-1]
-        shape = (self.N, self.df)
-        codes = np.empty(shape, dtype=np.int8)
-        for i, cat in enumerate(cats):
-            codes[:,i] = x==cat
-        codes -= (x==contrast)[:,None]
-        self.x_deviation_coded = self.as_effects = codes
-    
-        # x_dummy_coded
-        codes = np.empty(shape, dtype=np.int8)
-        for i, cat in enumerate(cats):
-            codes[:,i] = x==cat
-        self.x_dummy_coded = self.as_dummy = codes
+        # effect and dummy codes and cell masks are created on demand
+        self._codes = {}
+        self._masks = {}
+        self._codes_state = None
+        self._cell_cache = None
+    
+    def _get_cell_arrays(self):
+        """
+        Returns ``(codes, labels, reverse)``: sorted array of codes, array of 
+        the corresponding labels, and {label -> code} dictionary. Cached 
+        until ``self.cells`` changes.
+        
+        """
+        cache = getattr(self, '_cell_cache', None)
+        if cache is None or cache[0] != self.cells:
+            cells = self.cells.copy()
+            codes = np.array(sorted(cells), dtype=self.x.dtype)
+            labels = np.array([cells[c] for c in codes.tolist()])
+            reverse = dict((v, k) for k, v in cells.iteritems())
+            cache = self._cell_cache = (cells, codes, labels, reverse)
+        return cache[1:]
+    
+    def _upgrade_codes(self, code):
+        "make sure self.x can store code"
+        info = np.iinfo(self.x.dtype)
+        if not info.min <= code <= info.max:
+            codes = self.cells.keys() + [code]
+            self.x = self.x.astype(_code_dtype(min(codes), max(codes)))
+    
+    def _validate_cache(self):
+        "clear the codes and masks derived from self.x if self.x changed"
+        state = _array_state(self.x)
+        if state != self._codes_state:
+            self._codes.clear()
+            self._masks.clear()
+            self._codes_state = state
+    
+    def _cell_masks(self):
+        """
+        Cached read-only boolean indexes of the cases in each cell, as 
+        ``{code: mask}`` dictionary, for internal use (``factor == cell`` 
+        returns a new array). The masks are recomputed when the values in 
+        ``self.x`` change.
+        
+        """
+        self._validate_cache()
+        if not self._masks:
+            for code in np.unique(self.x).tolist():
+                mask = self.x == code
+                mask.flags.writeable = False
+                self._masks[code] = mask
+        return self._masks
+    
+    def _get_codes(self, kind):
+        "cached code matrices (see as_effects and as_dummy)"
+        self._validate_cache()
+        if kind not in self._codes:
+            categories, index = np.unique(self.x, return_inverse=True)
+            n = len(categories)
+            if kind == 'effects':
+                table = _effect_eye(n)
+            elif kind == 'dummy':
+                table = np.eye(n, n - 1, dtype=int)
+            else:
+                raise ValueError("Unknown code type %r" % kind)
+            self._codes[kind] = table.astype(np.int8)[index]
+        return self._codes[kind]
+    
+    @property
+    def as_effects(self):
+        "deviation coded category membership, shape (N, df)"
+        return self._get_codes('effects')
+    
+    @property
+    def as_dummy(self):
+        "dummy coded category membership, shape (N, df)"
+        return self._get_codes('dummy')
+    
+    x_deviation_coded = as_effects
+    x_dummy_coded = as_dummy
     
     def __repr__(self):
         fmt = dict(n=self.name, r=str(self.random))
@@ -842,11 +1038,14 @@ class factor(_regressor_):
             return self.cells[out]
     
     def __iter__(self):
-        return (self.cells[i] for i in self.x)
+        return iter(self.as_labels().tolist())
     
     def __setitem__(self, index, values):
         values = self._interpret_y(values)
         self.x[index] = values
+        self.df = len(np.unique(self.x)) - 1
+        self._codes.clear()
+        self._masks.clear()
     
     def __call__(self, other):
         "create a nested effect"
@@ -880,15 +1079,13 @@ class factor(_regressor_):
         return out
     
     def _get_ID_for_new_cell(self, name):
-        "adds a new name to the cells dictionary"
-        if self.x.dtype is np.uint8:
-            for i in range(256):
-                if i not in self.cells:
-                    self.cells[i] = str(name)
-                    return i
-            self.x = np.array(self.x, dtype=np.uint16)
-        i = np.max(self.x) + 1
+        "adds a new name to the cells dictionary (returns the smallest free code)"
+        i = 0
+        while i in self.cells:
+            i += 1
+        self._upgrade_codes(i)
         self.cells[i] = str(name)
+        self.indexes = sorted(self.cells.keys())
         return i
         
     def _interpret_y(self, y):
@@ -898,8 +1095,7 @@ class factor(_regressor_):
         
         """
         if np.iterable(y):
-            rd = {v: k for k, v in self.cells.iteritems()}
-            # TODO: implement reversable_dict type
+            rd = self._get_cell_arrays()[2]
             if isstr(y):
                 try:
                     return rd[y]
@@ -913,6 +1109,7 @@ class factor(_regressor_):
                             v = rd[v]
                         except KeyError:
                             v = self._get_ID_for_new_cell(v)
+                            rd = self._get_cell_arrays()[2]
                     elif v not in self.cells:
                         raise ValueError("unknown cell code: %r" % v)
                     out.append(v)
@@ -920,7 +1117,7 @@ class factor(_regressor_):
         elif y in self.cells:
             return y
         else:
-            raise ValueError("unknown cell code: %r" % v)
+            raise ValueError("unknown cell code: %r" % y)
     
     @property
     def as_dummy_complete(self):
@@ -930,7 +1127,29 @@ class factor(_regressor_):
         return codes.astype(np.int8)
         
     def as_labels(self):
-        return np.array([self.cells[v] for v in self.x])
+        "array with the label of each case"
+        return self._code_labels(self.x)
+    
+    def _code_labels(self, x):
+        "array with the labels corresponding to the codes in x"
+        codes, labels, _ = self._get_cell_arrays()
+        if len(codes) and codes[0] == 0 and codes[-1] == len(codes) - 1:
+            return labels[x]
+        else:
+            return labels[np.searchsorted(codes, x)]
+    
+    def isany(self, *values):
+        """
+        Returns an index array that is True in all those locations that match 
+        one of the provided `values` (labels or codes)::
+        
+            >>> a = factor('aabbcc')
+            >>> a.isany('b', 'c')
+            array([False, False,  True,  True,  True,  True], dtype=bool)
+        
+        """
+        values = self._interpret_y(values)
+        return np.in1d(self.x, values)
         
     @property
     def beta_labels(self):
@@ -955,16 +1174,10 @@ class factor(_regressor_):
         Raises an error if there are cells that contain more than one value.
         
         """
-        # find new x
-        x = []
-        for i in sorted(X.cells.keys()):
-            x_i = np.unique(self.x[X==i])
-            if len(x_i) > 1:
-#                x.append(np.nan)
-                raise ValueError("non-unique cell")
-            else:
-                x.append(x_i[0])
-        x = np.array(x)
+        groups = _cell_groups(X)
+        if not groups.is_constant(self.x):
+            raise ValueError("non-unique cell")
+        x = self.x[groups.first]
         
         # package and ship
         if name is None:
@@ -1004,15 +1217,16 @@ class factor(_regressor_):
         
         """
         assert self.cells == other.cells
-        index = []
-        for v in other.x:
-            where = np.where(self.x == v)[0]
-            if len(where) == 1:
-                index.append(where[0])
-            else:
-                msg = "%r contains several cases of %r"
-                raise ValueError(msg % (self, v))
-        return np.array(index)
+        order = np.argsort(self.x, kind='mergesort')
+        x_sorted = self.x[order]
+        start = np.searchsorted(x_sorted, other.x, 'left')
+        stop = np.searchsorted(x_sorted, other.x, 'right')
+        invalid = (stop - start) != 1
+        if np.any(invalid):
+            v = other.x[np.flatnonzero(invalid)[0]]
+            msg = "%r contains several cases of %r"
+            raise ValueError(msg % (self, v))
+        return order[start]
     
     def print_categories(self):
         ":returns: a table containing information about categories"
@@ -1125,13 +1339,143 @@ class ndvar(object):
                 raise ValueError("Dimension %r length mismatch: %i in data, "
                                  "%i in dimension" % (dim, n_data, n_dim))
     
+    # arithmetic: the other operand can be an ndvar with the same dims (with 
+    # the same number of cases, or a single case which is applied to all 
+    # cases), a var (one value per case) or a scalar
     def __add__(self, other):
-        data = self.data + other.data
-        name = '+'.join((self.name, other.name))
+        return self._operate(np.add, '+', other)
+    
+    def __radd__(self, other):
+        return self._operate(np.add, '+', other)
+    
+    def __iadd__(self, other):
+        return self._operate(np.add, '+', other, out=self)
+    
+    def __sub__(self, other):
+        return self._operate(np.subtract, '-', other)
+    
+    def __rsub__(self, other):
+        return self._operate(np.subtract, '-', other, reflected=True)
+    
+    def __isub__(self, other):
+        return self._operate(np.subtract, '-', other, out=self)
+    
+    def __mul__(self, other):
+        return self._operate(np.multiply, '*', other)
+    
+    def __rmul__(self, other):
+        return self._operate(np.multiply, '*', other)
+    
+    def __imul__(self, other):
+        return self._operate(np.multiply, '*', other, out=self)
+    
+    def __div__(self, other):
+        return self._operate(np.true_divide, '/', other)
+    
+    def __rdiv__(self, other):
+        return self._operate(np.true_divide, '/', other, reflected=True)
+    
+    def __idiv__(self, other):
+        return self._operate(np.true_divide, '/', other, out=self)
+    
+    __truediv__ = __div__
+    __rtruediv__ = __rdiv__
+    __itruediv__ = __idiv__
+    
+    def __neg__(self):
+        data = np.negative(self.data, dtype=self._compute_dtype())
+        name = '-%s' % self.name
         return ndvar(self.dims, data, properties=self.properties, name=name)
-
+    
+    def _compute_dtype(self):
+        "dtype for results of computations on this ndvar (see data.defaults)"
+        return _compute_dtype(self.properties, self.data.dtype)
+    
+    def _operand(self, other):
+        "returns ``(x, name)``: other as array that broadcasts against self.data"
+        if isndvar(other):
+            if not _dims_equal(other.dims, self.dims):
+                raise DimensionMismatchError(other, self.dims)
+            n = len(other)
+            if n != 1 and n != len(self) and len(self) != 1:
+                err = ("ndvars with different number of cases: %r (%i) and %r "
+                       "(%i)" % (self.name, len(self), other.name, n))
+                raise ValueError(err)
+            return other.data, other.name
+        elif isvar(other):
+            if len(other) != len(self):
+                err = ("var %r has length %i, ndvar %r has %i cases" 
+                       % (other.name, len(other), self.name, len(self)))
+                raise ValueError(err)
+            x = other.x.reshape((-1,) + (1,) * self.ndim)
+            return x, other.name
+        elif np.isscalar(other):
+            return other, repr(other)
+        else:
+            raise ValueError("Invalid operand for ndvar: %r" % other)
+    
+    def _operate(self, func, symbol, other, out=None, reflected=False, 
+                 name=None):
+        """
+        apply ``func(self.data, other)`` (``func(other, self.data)`` if 
+        ``reflected``); if ``out`` is an ndvar, the result is written into 
+        ``out.data`` and ``out`` is returned. 
+        
+        """
+        x, other_name = self._operand(other)
+        if reflected:
+            args = (x, self.data)
+            names = (other_name, self.name)
+        else:
+            args = (self.data, x)
+            names = (self.name, other_name)
+        
+        if out is None:
+            # the dtype policy applies to both ndvar operands (vars and 
+            # scalars do not change the dtype)
+            dtype = self._compute_dtype()
+            if isndvar(other):
+                dtype = np.promote_types(dtype, other._compute_dtype())
+            data = func(*args, dtype=dtype)
+            if name is None:
+                name = symbol.join(names)
+            return ndvar(self.dims, data, properties=self.properties, name=name)
+        else:
+            if not isndvar(out):
+                raise TypeError("out needs to be ndvar, got %r" % out)
+            func(*args, out=out.data)
+            if name is not None:
+                out.name = name
+            return out
+    
+    def add(self, other, out=None, name=None):
+        """
+        Add ``other`` (ndvar, var or scalar) to the data. 
+        
+        out : None | ndvar
+            ndvar in which to store the result (can be ``self``); by default,
+            a new ndvar is created.
+        name : None | str
+            name for the result (default is ``'self.name+other.name'`` for 
+            new ndvars; the name of ``out`` is not changed).
+        
+        """
+        return self._operate(np.add, '+', other, out=out, name=name)
+    
+    def divide(self, other, out=None, name=None):
+        "Divide the data by ``other`` (see :meth:`add`)"
+        return self._operate(np.true_divide, '/', other, out=out, name=name)
+    
+    def multiply(self, other, out=None, name=None):
+        "Multiply the data by ``other`` (see :meth:`add`)"
+        return self._operate(np.multiply, '*', other, out=out, name=name)
+    
+    def subtract(self, other, out=None, name=None):
+        "Subtract ``other`` from the data (see :meth:`add`)"
+        return self._operate(np.subtract, '-', other, out=out, name=name)
+    
     def __getitem__(self, index):
-        if np.iterable(index):
+        if isinstance(index, slice) or np.iterable(index):
             data = self.data[index]
             if data.shape[1:] != self.data.shape[1:]:
                 raise NotImplementedError("Use subdata method")
@@ -1149,27 +1493,104 @@ class ndvar(object):
         args = dict(name=self.name, info=self.info, n_cases=self._len, dims=dims)
         return rep % args
     
-    def __sub__(self, other):
-        if hasattr(other, 'data'):
-            data = self.data - other.data
-            name = '-'.join((self.name, other.name))
-        elif np.isscalar(other):
-            data = self.data - other
-            name = '%s-%r' % (self.name, other)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # ndvars opened with load_ndvar() pickle a reference to the file
+        if self._is_memmap_file():
+            state['data'] = None
         else:
-            raise ValueError("can't subtract %r" % other)
-        return ndvar(self.dims, data, properties=self.properties, name=name)
+            state.pop('_memmap_file', None)
+        state.pop('_memmap_data', None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.data is None:
+            fn, mode = self._memmap_file
+            self.data = self._memmap_data = _open_ndvar_data(fn, mode)[1]
+    
+    def _is_memmap_file(self):
+        "whether self.data is the complete memmap opened from a file"
+        memmap_file = getattr(self, '_memmap_file', None)
+        return (memmap_file is not None 
+                and getattr(self, '_memmap_data', None) is self.data)
     
     def assert_dims(self, dims):
         dim_names = tuple(dim.name for dim in self.dims)
         if dim_names != dims:
             raise DimensionMismatchError(self, dims)
     
+    def compress(self, X, func=np.mean, name='{name}'):
+        """
+        Returns an ndvar with one case for each (non-empty) cell in X (a 
+        factor or interaction), summarizing the cases in each cell with 
+        ``func`` (default is the mean).
+        
+        """
+        data = _cell_groups(X).reduce(self.data, func)
+        data = data.astype(self._compute_dtype(), copy=False)
+        name = name.format(name=self.name)
+        func_name = getattr(func, '__name__', str(func))
+        info = os.linesep.join((self.info, 'compress(%s, %s)' % (X.name, func_name)))
+        return ndvar(self.dims, data, properties=self.properties, name=name, 
+                     info=info)
+    
     def copy(self):
         "returns a copy with a view on the object's data"
         data = self.data
         return self.__class__(self.dims, data, self.properties, self.name)
     
+    def decimate(self, decim=None, sfreq=None, name='{name}'):
+        """
+        Returns an ndvar downsampled along the time dimension by an integer 
+        factor. The data are low-pass filtered with a zero-phase 
+        anti-aliasing filter (mirroring the data at the epoch boundaries), 
+        and the retained time points are the multiples of the new sampling 
+        interval (as for data loaded with the ``decim`` argument of 
+        :func:`load.fiff_epochs`). 
+        
+        decim : int
+            decimation factor
+        sfreq : scalar
+            new sampling rate (instead of ``decim``; needs to be an integer 
+            fraction of the ``'samplingrate'`` property)
+        
+        """
+        try:
+            t_dim = self._dim_dict['time']
+        except KeyError:
+            raise KeyError("Segment does not contain 'time' dimension.")
+        t = self.dims[t_dim].x
+        samplingrate = self.properties.get('samplingrate', None)
+        if samplingrate is None:
+            samplingrate = 1. / (t[1] - t[0])
+        decim = _decim_factor(samplingrate, decim, sfreq)
+        
+        # time points on the new sampling grid
+        samples = np.round(t * samplingrate).astype(int)
+        start = (-samples[0]) % decim
+        n = (len(t) - 1 - start) // decim + 1
+        if n < 1:
+            raise ValueError("decim=%i: no time points left" % decim)
+        times = t[start + np.arange(n) * decim]
+        
+        h = _decim_filter(decim)
+        axis = t_dim + 1
+        padding = [(0, 0)] * self.data.ndim
+        padding[axis] = (len(h) // 2, len(h) // 2)
+        data = np.pad(np.asarray(self.data), padding, 'reflect')
+        data = _fir_decimate(data, h, decim, start, n, axis)
+        data = data.astype(self._compute_dtype(), copy=False)
+        
+        dims = list(self.dims)
+        dims[t_dim] = var(times, name='time')
+        properties = self.properties.copy()
+        properties['samplingrate'] = samplingrate / decim
+        name = name.format(name=self.name)
+        info = os.linesep.join((self.info, 'decimate(%i)' % decim))
+        return ndvar(tuple(dims), data, properties=properties, name=name, 
+                     info=info)
+    
     def deepcopy(self):
         "returns a copy with a deep copy of the object's data"
         data = self.data.copy()
@@ -1189,16 +1610,15 @@ class ndvar(object):
         if func is None:
             func = np.mean
         
-        data = func(self.data, axis=0)[None,...]
+        dtype = self._compute_dtype()
+        if func in _accumulating_funcs:
+            data = func(self.data, axis=0, dtype=np.float64)
+        else:
+            data = func(self.data, axis=0)
+        data = data.astype(dtype, copy=False)[None,...]
         name = name.format(func=func.__name__, name=self.name)
         info = os.linesep.join((self.info, 'summary: %s' % func.__name__))
-        
-        # update properties for summary
-        properties = self.properties.copy()
-        for key in self.properties:
-            if key.startswith('summary_') and (key != 'summary_func'):
-                properties[key[8:]] = properties.pop(key)
-        
+        properties = _summary_properties(self.properties)
         return ndvar(self.dims, data, properties=properties, name=name, info=info)
     
     def get_epoch(self, Id, name="{name}[{Id}]"):
@@ -1216,53 +1636,388 @@ class ndvar(object):
     def mean(self, name="mean({name})"):
         return self.get_summary(np.mean, name=name)
     
-    def subdata(self, time=None):
+    def save(self, fn):
         """
+        Save the ndvar as memory-mappable file pair: a header file ``fn`` 
+        (pickled dims, properties, dtype and shape) and a raw data file with 
+        the same name and extension ``.dat``. Use :func:`load_ndvar` to open 
+        the ndvar without reading the data into memory.
         
         """
-        try:
-            t_dim = self._dim_dict['time']
-            t_var = self.dims[t_dim]
-        except KeyError:
-            raise KeyError("Segment does not contain 'time' dimension.")
+        fn = _ndvar_header_fn(fn)
+        out = memmap_ndvar(fn, self.dims, len(self), self.data.dtype, 
+                           self.properties, self.name, self.info)
+        for start in xrange(0, len(self), _memmap_block):
+            stop = start + _memmap_block
+            out.data[start:stop] = self.data[start:stop]
+        out.data.flush()
+    
+    def subdata(self, time=None, sensor=None):
+        """
+        Returns an ndvar with a subset of the data. Wherever possible, the data
+        of the new ndvar is a view on the data of the present ndvar (an 
+        exception are non-contiguous sets of sensors). 
+        
+        time : None | scalar | (tmin, tmax)
+            A scalar selects the time point closest to ``time`` and removes 
+            the time dimension (the actual time is stored in the ``'t'`` 
+            property). A tuple selects the time window ``tmin <= t < tmax``
+            (either value can be None to leave the window open on that side).
+        sensor : None | int | str | list
+            A single sensor (index or name) removes the sensor dimension; a 
+            list of sensors (or a slice or boolean array) selects a subset of
+            the sensor_net.
         
-        has_cases = self._stype_ == 'ndvar'
+        """
         data = self.data
+        dims = list(self.dims)
         properties = self.properties.copy()
-#        dims = list(self.dims)
-        rm_dims = []
         
-        if np.isscalar(time):
-            if time in t_var.x:
-                i = np.where(t_var==time)[0][0]
+        # sensor dimension (indexed first so that the axis is still valid 
+        # after removing the time dimension)
+        if sensor is not None:
+            try:
+                s_dim = self._dim_dict['sensor']
+            except KeyError:
+                raise KeyError("Segment does not contain 'sensor' dimension.")
+            net = self.dims[s_dim]
+            index = [slice(None)] * data.ndim
+            if isinstance(sensor, basestring) or np.isscalar(sensor):
+                index[s_dim + 1] = self._sensor_index(net, sensor)
+                dims[s_dim] = None
             else:
-                i_next = np.where(t_var > time)[0][0]
-                t_next = t_var[i_next]
-                i_prev = np.where(t_var < time)[0][-1]
-                t_prev = t_var[i_prev]
-                if (t_next - time) < (time - t_prev):
-                    i = i_next
-                    time = t_next
+                if isinstance(sensor, slice):
+                    pass
+                elif isinstance(sensor, np.ndarray) and sensor.dtype == bool:
+                    if len(sensor) != len(net):
+                        err = ("Boolean sensor index with wrong length "
+                               "(%i, sensor_net has %i)" 
+                               % (len(sensor), len(net)))
+                        raise ValueError(err)
                 else:
-                    i = i_prev
-                    time = t_prev
-            
-            if has_cases:
-                data = data[:,i]
+                    sensor = [self._sensor_index(net, s) for s in sensor]
+                sensor = _simplify_index(sensor, len(net))
+                index[s_dim + 1] = sensor
+                dims[s_dim] = net.subnet(np.arange(len(net))[sensor])
+            data = data[tuple(index)]
+        
+        # time dimension
+        if time is not None:
+            try:
+                t_dim = self._dim_dict['time']
+            except KeyError:
+                raise KeyError("Segment does not contain 'time' dimension.")
+            t = self.dims[t_dim].x
+            index = [slice(None)] * data.ndim
+            if np.isscalar(time):
+                i = self._time_index(t, time)
+                time = t[i]
+                index[t_dim + 1] = i
+                dims[t_dim] = None
+                properties['t'] = time
             else:
-                data = data[i]
-            rm_dims.append(t_dim)
-            properties['t'] = time
+                tmin, tmax = time
+                if tmin is None:
+                    i0 = 0
+                else:
+                    i0 = np.searchsorted(t, tmin)
+                if tmax is None:
+                    i1 = len(t)
+                else:
+                    i1 = np.searchsorted(t, tmax)
+                index[t_dim + 1] = slice(i0, i1)
+                dims[t_dim] = var(t[i0:i1], name='time')
+            data = data[tuple(index)]
         
-        # cerate subdata object
-        dims = tuple([dim for i,dim in enumerate(self.dims) if i not in rm_dims])
+        # create subdata object
+        dims = tuple(dim for dim in dims if dim is not None)
         out = self.__class__(dims, data, properties, self.name)
         
         # copy special overlay attribute that statictics functions add to certain epochs
         if hasattr(self, 'overlay'):
-            out.overlay = self.overlay.subdata(time=time)
+            out.overlay = self.overlay.subdata(time=time, sensor=sensor)
         
         return out
+    
+    @staticmethod
+    def _time_index(t, time):
+        "index of the time point in t closest to time"
+        i = np.searchsorted(t, time)
+        if i == len(t):
+            return i - 1
+        elif i == 0 or t[i] == time:
+            return i
+        elif (t[i] - time) < (time - t[i - 1]):
+            return i
+        else:
+            return i - 1
+    
+    @staticmethod
+    def _sensor_index(net, sensor):
+        "index of sensor (index or name) in net"
+        if isinstance(sensor, basestring):
+            return net.names.index(sensor)
+        else:
+            return int(sensor)
+
+
+
+# number of cases copied at once when writing to memory-mapped files
+_memmap_block = 256
+
+
+def _ndvar_header_fn(fn):
+    if not os.path.splitext(fn)[1]:
+        fn += '.ndvar'
+    return fn
+
+
+def _ndvar_data_fn(fn):
+    return os.path.splitext(fn)[0] + '.dat'
+
+
+def _open_ndvar_data(fn, mode='r'):
+    "returns (header, data) for the ndvar header file ``fn``"
+    with open(fn, 'rb') as fid:
+        header = pickle.load(fid)
+    data_fn = _ndvar_data_fn(fn)
+    data = np.memmap(data_fn, dtype=header['dtype'], mode=mode, 
+                     shape=header['shape'])
+    return header, data
+
+
+def load_ndvar(fn, mode='r'):
+    """
+    Open an ndvar saved with :meth:`ndvar.save` (or created with 
+    :func:`memmap_ndvar`). The data are memory-mapped and are only read 
+    from disk when they are accessed (e.g., ``Y[index]`` reads only the 
+    indexed cases).
+    
+    fn : str
+        path of the header file
+    mode : 'r' | 'r+' | 'c'
+        :class:`numpy.memmap` mode (read-only, read/write, copy-on-write)
+    
+    """
+    fn = _ndvar_header_fn(fn)
+    header, data = _open_ndvar_data(fn, mode)
+    Y = ndvar(header['dims'], data, properties=header['properties'], 
+              name=header['name'], info=header['info'])
+    if mode in ('r', 'r+'):
+        Y._memmap_file = (os.path.abspath(fn), mode)
+        Y._memmap_data = data
+    return Y
+
+
+def memmap_ndvar(fn, dims, n_cases, dtype=None, properties=None, 
+                 name="???", info=""):
+    """
+    Create an ndvar backed by a new memory-mapped file (the data are 
+    initialized with zeros). The header is written immediately, so the ndvar 
+    can later be opened with :func:`load_ndvar`.
+    
+    fn : str
+        path of the header file (the data file uses the same name with 
+        extension ``.dat``)
+    dims : tuple
+        ndvar dimensions
+    n_cases : int
+        number of cases
+    dtype : None | dtype
+        data type (default ``defaults['dtype']``)
+    
+    """
+    fn = _ndvar_header_fn(fn)
+    if dtype is None:
+        dtype = defaults['dtype']
+    dtype = np.dtype(dtype)
+    shape = (n_cases,) + tuple(len(dim) for dim in dims)
+    if properties is None:
+        properties = {}
+    header = dict(dims=dims, properties=properties, dtype=dtype.str, 
+                  shape=shape, name=name, info=info)
+    with open(fn, 'wb') as fid:
+        pickle.dump(header, fid, pickle.HIGHEST_PROTOCOL)
+    
+    data = np.memmap(_ndvar_data_fn(fn), dtype=dtype, mode='w+', shape=shape)
+    Y = ndvar(dims, data, properties=properties, name=name, info=info)
+    Y._memmap_file = (os.path.abspath(fn), 'r+')
+    Y._memmap_data = data
+    return Y
+
+
+
+def _summary_properties(properties):
+    """
+    Returns a copy of ``properties`` for a summary ndvar: ``'summary_*'``
+    entries (except ``'summary_func'``) replace the corresponding entries.
+    
+    """
+    out = properties.copy()
+    for key in properties:
+        if key.startswith('summary_') and (key != 'summary_func'):
+            out[key[8:]] = out.pop(key)
+    return out
+
+
+
+class ndvar_summary(object):
+    """
+    Accumulates summary statistics (count, mean, variance, minimum and 
+    maximum) over the cases of ndvars that are added incrementally, so that 
+    a grand average can be computed without holding all cases in memory::
+    
+        >>> summary = ndvar_summary(Y.dims, Y.properties, 'MEG')
+        >>> for Y in epoch_chunks:
+        ...     summary.add(Y)
+        ...
+        >>> Y_mean = summary.get_summary()
+    
+    Means and variances are accumulated in float64 by merging the moments of 
+    each chunk (Chan et al.'s parallel version of Welford's algorithm). 
+    Summary ndvars have the dtype of the added data (or the ``'dtype'`` 
+    property).
+    
+    """
+    _stats = ('mean', 'var', 'std', 'min', 'max')
+    def __init__(self, dims, properties=None, name="???", info=""):
+        """
+        dims : tuple
+            dimensions of the ndvars that will be added (see :class:`ndvar`).
+        properties : dict
+            properties for the summary ndvars (``'summary_*'`` entries are
+            handled like in :meth:`ndvar.get_summary`).
+        
+        """
+        self.dims = dims
+        self.shape = tuple(len(dim) for dim in dims)
+        if properties is None:
+            self.properties = {}
+        else:
+            self.properties = properties.copy()
+        self.name = name
+        self.info = info
+        
+        self.n = 0
+        self._mean = np.zeros(self.shape)
+        self._m2 = np.zeros(self.shape)
+        self._min = None
+        self._max = None
+        self._dtype = np.dtype(np.float64)
+    
+    def __repr__(self):
+        return '<ndvar_summary %r: %i cases>' % (self.name, self.n)
+    
+    @classmethod
+    def from_ndvars(cls, ndvars, name=None):
+        """
+        Summary of all cases in ``ndvars`` (an iterable of ndvars with the 
+        same dimensions, e.g. a generator loading one subject at a time).
+        
+        """
+        summary = None
+        for Y in ndvars:
+            if summary is None:
+                if name is None:
+                    name = Y.name
+                summary = cls(Y.dims, Y.properties, name=name, info=Y.info)
+            summary.add(Y)
+        if summary is None:
+            raise ValueError("No ndvars to summarize")
+        return summary
+    
+    def add(self, data):
+        """
+        Add cases to the summary. ``data`` can be an ndvar or an array with 
+        cases on the first axis (a single case can be provided without the 
+        case axis).
+        
+        """
+        if isndvar(data):
+            dim_names = tuple(dim.name for dim in self.dims)
+            data.assert_dims(dim_names)
+            data = data.data
+        
+        data = np.asarray(data)
+        if data.shape == self.shape:
+            data = data[None]
+        elif data.shape[1:] != self.shape:
+            err = ("Data shape %s does not match dimensions %s" 
+                   % (data.shape[1:], self.shape))
+            raise ValueError(err)
+        
+        n_b = len(data)
+        if n_b == 0:
+            return
+        if self.n == 0:
+            self._dtype = data.dtype
+        mean_b = data.mean(axis=0, dtype=np.float64)
+        m2_b = np.sum((data - mean_b) ** 2, axis=0, dtype=np.float64)
+        
+        n_a = self.n
+        n = n_a + n_b
+        delta = mean_b - self._mean
+        self._mean += delta * (n_b / n)
+        self._m2 += m2_b + delta ** 2 * (n_a * n_b / n)
+        self.n = n
+        
+        min_b = data.min(axis=0)
+        max_b = data.max(axis=0)
+        if self._min is None:
+            self._min = min_b.copy()
+            self._max = max_b.copy()
+        else:
+            np.minimum(self._min, min_b, self._min)
+            np.maximum(self._max, max_b, self._max)
+    
+    def mean(self):
+        return self._mean.copy()
+    
+    def var(self, ddof=0):
+        if self.n - ddof <= 0:
+            raise ValueError("Not enough cases for variance with ddof=%i" % ddof)
+        return self._m2 / (self.n - ddof)
+    
+    def std(self, ddof=0):
+        return np.sqrt(self.var(ddof=ddof))
+    
+    def min(self):
+        if self._min is None:
+            raise ValueError("No cases added")
+        return self._min.copy()
+    
+    def max(self):
+        if self._max is None:
+            raise ValueError("No cases added")
+        return self._max.copy()
+    
+    def get_summary(self, func=None, name='{func}({name})'):
+        """
+        Returns an ndvar with a single case containing the summary statistic 
+        ``func`` (one of ``'mean'``, ``'var'``, ``'std'``, ``'min'`` and 
+        ``'max'``). By default, the ``'summary_func'`` property is used if its 
+        name corresponds to one of these statistics, and the mean otherwise.
+        
+        """
+        if func is None:
+            func = self.properties.get('summary_func', None)
+            # np.min and np.max are called amin and amax
+            func = getattr(func, '__name__', None)
+            func = {'amin': 'min', 'amax': 'max'}.get(func, func)
+            if func not in self._stats:
+                func = 'mean'
+        elif func not in self._stats:
+            raise ValueError("func needs to be one of %s" % str(self._stats))
+        if self.n == 0:
+            raise ValueError("No cases added")
+        
+        dtype = _compute_dtype(self.properties, self._dtype)
+        data = getattr(self, func)().astype(dtype, copy=False)[None,...]
+        name = name.format(func=func, name=self.name)
+        summary_info = 'summary: %s (%i cases)' % (func, self.n)
+        info = os.linesep.join((self.info, summary_info))
+        properties = _summary_properties(self.properties)
+        return ndvar(self.dims, data, properties=properties, name=name, info=info)
 
 
 
@@ -1312,10 +2067,16 @@ class dataset(dict):
         name : str
             name describing the dataset
         
+        columnar : bool
+            Subsets of the dataset (e.g., ``ds[index]``, 
+            :meth:`get_subsets_by`) are returned as :class:`dataset_view` 
+            objects, which index the variables only when they are accessed.
+        
         """ 
         self.name = named_items.pop('name', '???')
         self.info = named_items.pop('info', {})
         self.default_DV = named_items.pop('default_DV', None)
+        self.columnar = named_items.pop('columnar', False)
         dict.__init__(self)
         for item in items:
             name = item.name
@@ -1359,7 +2120,7 @@ class dataset(dict):
         rep_tmp = "<dataset %(name)r N=%(N)i: %(items)s"
         items = []
         for key in sorted(self):
-            v = self[key]
+            v = self._peek(key)
             if isinstance(v, var):
                 lbl = 'V'
             elif isinstance(v, factor):
@@ -1391,6 +2152,10 @@ class dataset(dict):
                     self.N = len(item)
                 dict.__setitem__(self, name, item)
     
+    def _peek(self, key):
+        "variable ``key`` (possibly of a parent dataset) for inspection"
+        return dict.__getitem__(self, key)
+    
     def __str__(self):
         txt = str(self.as_table(cases=10, fmt='%.5g', midrule=True))
         if self.N > 10:
@@ -1418,6 +2183,51 @@ class dataset(dict):
         else:
             self[item.name] = item
     
+    def aggregate(self, X, func=np.mean, name='{name}'):
+        """
+        Returns a dataset with one case for each (non-empty) cell in X. vars 
+        and ndvars are summarized with ``func`` (default is the mean); factors
+        are retained if they are constant within the cells of X, and dropped 
+        otherwise. 
+        
+        X : factor | interaction | str
+            The categorial variable defining the cells (e.g., 
+            ``ds['subject'] % ds['condition']``), or the name of a factor in 
+            the dataset.
+        func : callable
+            Function to summarize the cases in each cell (needs to take an 
+            ``axis`` argument). ``np.mean`` and ``np.sum`` are computed for 
+            all cells at once.
+        
+        """
+        if isinstance(X, basestring):
+            X = self[X]
+        groups = _cell_groups(X)
+        
+        items = []
+        for key, item in self.iteritems():
+            if isfactor(item):
+                if groups.is_constant(item.x):
+                    x = item.x[groups.first]
+                    items.append(factor(x, name=item.name, labels=item.cells, 
+                                        random=item.random))
+                else:
+                    logging.debug("aggregate: dropping %r" % key)
+                    continue
+            elif isvar(item):
+                x = groups.reduce(item.x, func)
+                items.append(var(x, name=item.name))
+            elif isndvar(item):
+                items.append(item.compress(groups, func))
+            else:
+                logging.debug("aggregate: dropping %r" % key)
+                continue
+        
+        name = name.format(name=self.name)
+        info = self.info.copy()
+        out = dataset(*items, name=name, info=info, default_DV=self.default_DV)
+        return out
+    
 #    def as_epoch(self, *args, **kwargs):
 #        "returns an epoch of the default dependent variable (default_DV)"
 #        return self[self.default_DV].as_epoch(*args, **kwargs)
@@ -1551,10 +2361,14 @@ class dataset(dict):
             default_DV = self.default_DV
         
         out = {}
-        for case in factor.cells.values():
+        masks = factor._cell_masks()
+        for code, case in factor.cells.iteritems():
             if case not in exclude:
                 setname = name.format(name=self.name, case=case)
-                index = factor == case
+                if code in masks:
+                    index = masks[code]
+                else:
+                    index = np.zeros(factor.N, dtype=bool)
                 out[case] = self.subset(index, setname, default_DV=default_DV)
         return out
     
@@ -1641,7 +2455,12 @@ class dataset(dict):
         means that advanced indexing always returns a copy of the data, whereas
         basic slicing (using slices) returns a view.
         
+        For columnar datasets, a :class:`dataset_view` is returned.
+        
         """
+        if self.columnar:
+            return dataset_view(self, index, name=name, default_DV=default_DV)
+        
         items = {k: v[index] for k, v in self.iteritems()}
         name = name.format(name=self.name)
         info = self.info.copy()
@@ -1658,6 +2477,146 @@ class dataset(dict):
 
 
 
+def _simplify_index(index, N):
+    """
+    Returns a slice if ``index`` selects a contiguous, ascending range of 
+    cases (so that variables can be indexed with views), and an int array 
+    otherwise.
+    
+    """
+    if isinstance(index, slice):
+        return index
+    
+    index = np.asarray(index)
+    if index.dtype == bool:
+        index = np.flatnonzero(index)
+    elif index.ndim == 0:
+        index = index[None]
+    index = np.where(index < 0, index + N, index)
+    if len(index) > 0 and np.all(np.diff(index) == 1):
+        return slice(int(index[0]), int(index[-1]) + 1)
+    return index
+
+
+class dataset_view(dataset):
+    """
+    A subset of the cases of a columnar dataset (see :meth:`dataset.subset`). 
+    The view stores only the parent dataset and an index; each variable is 
+    indexed when it is first accessed (contiguous subsets are indexed with a 
+    slice, so that arrays are views on the parent's data). 
+    
+    Variables assigned to the view are stored in the view only.
+    
+    """
+    def __init__(self, parent, index, name='{name}', default_DV=None):
+        dict.__init__(self)
+        self.name = name.format(name=parent.name)
+        self.info = parent.info.copy()
+        if default_DV is None:
+            default_DV = parent.default_DV
+        self.default_DV = default_DV
+        self.columnar = True
+        
+        if isinstance(parent, dataset_view):
+            # items that exist only in the parent view
+            for k in dict.iterkeys(parent):
+                if k not in parent._keys:
+                    dict.__setitem__(self, k, dict.__getitem__(parent, k)[index])
+            # index into the root dataset
+            index = np.arange(parent._parent.N)[parent._index][index]
+            keys = parent._keys
+            parent = parent._parent
+        else:
+            keys = set(parent.keys())
+        
+        self._parent = parent
+        self._keys = keys
+        self._index = _simplify_index(index, parent.N)
+        if isinstance(self._index, slice):
+            self.N = len(xrange(*self._index.indices(parent.N)))
+        else:
+            self.N = len(self._index)
+    
+    def __reduce__(self):
+        # pickle as normal dataset
+        state = dict(name=self.name, info=self.info, N=self.N, 
+                     default_DV=self.default_DV, columnar=False)
+        return (dataset, (), state, None, self.iteritems())
+    
+    def __contains__(self, key):
+        return (key in self._keys) or dict.__contains__(self, key)
+    
+    def __delitem__(self, key):
+        if key in self._keys:
+            self._keys = self._keys.difference((key,))
+            if dict.__contains__(self, key):
+                dict.__delitem__(self, key)
+        else:
+            dict.__delitem__(self, key)
+    
+    def __getitem__(self, name):
+        if isinstance(name, basestring):
+            if not dict.__contains__(self, name):
+                if name not in self._keys:
+                    raise KeyError(name)
+                item = self._parent[name][self._index]
+                dict.__setitem__(self, name, item)
+            return dict.__getitem__(self, name)
+        else:
+            return dataset.__getitem__(self, name)
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def __repr__(self):
+        return dataset.__repr__(self).replace('<dataset', '<dataset_view', 1)
+    
+    def _peek(self, key):
+        if dict.__contains__(self, key):
+            return dict.__getitem__(self, key)
+        else:
+            return self._parent[key]
+    
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        else:
+            return default
+    
+    def has_key(self, key):
+        return key in self
+    
+    def items(self):
+        return list(self.iteritems())
+    
+    def iteritems(self):
+        for k in self.keys():
+            yield k, self[k]
+    
+    def iterkeys(self):
+        return iter(self.keys())
+    
+    def itervalues(self):
+        for k in self.keys():
+            yield self[k]
+    
+    def keys(self):
+        return list(self._keys.union(dict.keys(self)))
+    
+    def materialize(self):
+        "returns a normal dataset containing all variables of the view"
+        items = dict(self.iteritems())
+        return dataset(name=self.name, info=self.info.copy(), 
+                       default_DV=self.default_DV, **items)
+    
+    def values(self):
+        return list(self.itervalues())
+
+
+
 #   Models ---
 
 class interaction(_regressor_):
@@ -1708,10 +2667,18 @@ class interaction(_regressor_):
         self.indexes = sorted(self.cells.keys())
         self.colors = {}
         
-        # effect coding
-        codelist = [f.as_effects for f in self.base]
-        codes = reduce(_effect_interaction, codelist)
-        self.as_effects = codes
+        self._as_effects = None
+        self._as_effects_state = None
+    
+    @property
+    def as_effects(self):
+        "effect codes (created on first access)"
+        state = _effect_state(self)
+        if state != self._as_effects_state:
+            codelist = [f.as_effects for f in self.base]
+            self._as_effects = reduce(_effect_interaction, codelist)
+            self._as_effects_state = state
+        return self._as_effects
     
     def __repr__(self):
         names = [f.name for f in self.base]
@@ -1738,11 +2705,7 @@ class interaction(_regressor_):
         return out
     
     def as_codes(self):
-        out = []
-        for i in xrange(self.N):
-            code = tuple(f.x[i] for f in self.factors)
-            out.append(code)
-        return out
+        return zip(*[f.x.tolist() for f in self.factors])
     
     def as_factor(self):
         name = self.name.replace(' ', '')
@@ -1750,15 +2713,144 @@ class interaction(_regressor_):
         return factor(x, name)
     
     def as_labels(self):
-        out = [self.cells[code] for code in self.as_codes()]
-        return out
+        codes, first = _combine_codes([f.x for f in self.factors])
+        cell_codes = zip(*[f.x[first].tolist() for f in self.factors])
+        labels = np.array([self.cells[code] for code in cell_codes], 
+                          dtype=object)
+        return labels[codes].tolist()
 
 
 
 def _effect_interaction(a, b):
-    k = a.shape[1]
-    out = [a[:,i,None] * b for i in range(k)]
-    return np.hstack(out)
+    N = len(a)
+    return (a[:,:,None] * b[:,None,:]).reshape((N, -1))
+
+
+def _sparse_effects(e):
+    """
+    Effect codes of ``e`` as ``scipy.sparse.csr_matrix`` (the sparse 
+    equivalent of ``e.as_effects``). Factor codes are constructed from the 
+    cell index of each case, interactions as row-wise products of the codes
+    of their base effects.
+    
+    """
+    if e._stype_ == 'factor':
+        _, index = np.unique(e.x, return_inverse=True)
+        df = index.max() if len(index) else 0
+        # cases in the last cell are coded -1 on all columns
+        is_last = index == df
+        last = np.flatnonzero(is_last)
+        other = np.flatnonzero(~is_last)
+        rows = np.concatenate((other, np.repeat(last, df)))
+        cols = np.concatenate((index[other], np.tile(np.arange(df), len(last))))
+        data = np.concatenate((np.ones(len(other), dtype=np.int8), 
+                               -np.ones(len(last) * df, dtype=np.int8)))
+        return scipy.sparse.csr_matrix((data, (rows, cols)), shape=(e.N, df))
+    elif e._stype_ == 'interaction':
+        return reduce(_sparse_interaction, map(_sparse_effects, e.base))
+    else:
+        return scipy.sparse.csr_matrix(e.as_effects)
+
+
+def _sparse_interaction(a, b):
+    "sparse equivalent of _effect_interaction"
+    a = a.tocoo()
+    b = scipy.sparse.csr_matrix(b)
+    b.sort_indices()
+    # pair each nonzero of a with the nonzeros of b in the same row
+    n_b = np.diff(b.indptr)[a.row]
+    n = n_b.sum()
+    offset = np.arange(n) - np.repeat(np.cumsum(n_b) - n_b, n_b)
+    b_index = np.repeat(b.indptr[a.row], n_b) + offset
+    rows = np.repeat(a.row, n_b)
+    cols = np.repeat(a.col, n_b) * b.shape[1] + b.indices[b_index]
+    data = np.repeat(a.data, n_b) * b.data[b_index]
+    shape = (a.shape[0], a.shape[1] * b.shape[1])
+    return scipy.sparse.csr_matrix((data, (rows, cols)), shape=shape)
+
+
+class _cell_groups(object):
+    """
+    Sort-based grouping of cases by the (non-empty) cells of a categorial 
+    variable, for reducing data in all cells at once. Cells are ordered 
+    by their codes.
+    
+    """
+    def __init__(self, X):
+        if isinstance(X, _cell_groups):
+            self.__dict__.update(X.__dict__)
+            return
+        elif isfactor(X):
+            arrays = [X.x]
+        elif isinteraction(X):
+            arrays = [f.x for f in X.factors]
+        elif isinstance(X, (list, tuple)):
+            # list of code arrays
+            arrays = X
+        else:
+            raise TypeError("Need factor or interaction (got %r)" % X)
+        
+        self.name = getattr(X, 'name', None)
+        codes, first = _combine_codes(arrays)
+        self.n = len(first)
+        self.first = first
+        self.counts = np.bincount(codes, minlength=self.n)
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+        if np.all(np.diff(codes) >= 0):
+            self.order = None
+        else:
+            self.order = np.argsort(codes, kind='mergesort')
+    
+    def sort(self, x):
+        "cases of x sorted by cell"
+        if self.order is None:
+            return np.asarray(x)
+        else:
+            return x[self.order]
+    
+    def reduce(self, x, func=np.mean):
+        "apply func to the cases in each cell (x: array with cases on axis 0)"
+        x = self.sort(x)
+        if func in (np.mean, np.sum):
+            out = np.add.reduceat(x, self.starts, axis=0, dtype=np.float64)
+            if func is np.mean:
+                counts = self.counts.reshape((-1,) + (1,) * (x.ndim - 1))
+                out /= counts
+        else:
+            out = [func(x[i:i+n], axis=0) for i, n in zip(self.starts, self.counts)]
+            out = np.array(out)
+        return out
+    
+    def is_constant(self, x):
+        "whether x has a single value in each cell"
+        x = self.sort(x)
+        x_min = np.minimum.reduceat(x, self.starts)
+        x_max = np.maximum.reduceat(x, self.starts)
+        return np.all(x_min == x_max)
+
+
+def _combine_codes(arrays):
+    """
+    Combines several arrays of codes into a single code array with one code 
+    for each combination of values (mixed-radix combination). 
+    
+    Returns
+    -------
+    codes : array of int
+        codes in range(n_cells), ordered lexicographically by the 
+        combination of values.
+    first : array of int
+        index of the first case of each cell.
+    
+    """
+    codes = np.zeros(len(arrays[0]), dtype=np.intp)
+    for x in arrays:
+        values, index = np.unique(x, return_inverse=True)
+        codes = codes * len(values) + index
+        # keep codes small
+        _, codes = np.unique(codes, return_inverse=True)
+    _, first = np.unique(codes, return_index=True)
+    return codes, first
 
 
 
@@ -1954,48 +3046,39 @@ class multifactor(factor):
         factors = clean_factors
         
         self.N = factors[0].N
+        self._factors = factors
+        self.random = False
+        self.visible = True
+        self.colors = {}
+        self._codes = {}
+        self._masks = {}
+        self._codes_state = None
         
-        #
         if len(factors) == 1:
             f = factors[0]
             self.x = f.x
             self.cells = f.cells.copy()
             self.name = f.name
         else:
-            x_full = np.hstack([f.x[:,None] for f in factors])
-            x_tup = [tuple(x) for x in x_full]
-            # categories            
-            if v:
-                print "x_tup:"
-                print x_tup
-            categories, c_sort = np.unique(x_tup, return_index=True)
-            if v:
-                print "categories:"
-                print categories
-                print c_sort
-            categories = categories[np.argsort(c_sort)]
-            if v:
-                print "categories:"
-                print categories
-            # data containers
-            categories = np.unique(x_tup)
-            if v:
-                print categories
-            x = np.zeros(self.N)
+            codes, first = _combine_codes([f.x for f in factors])
+            dtype = _code_dtype(0, max(0, len(first) - 1))
             labels = {}
-            for i, index in enumerate(categories):
-                x[np.all(x_full==index, axis=1)] = i
-                labels[i] = ', '.join([f.cells[j] for f,j in zip(factors, index)])
-            # create factor TODO: random
+            for i, index in enumerate(first):
+                labels[i] = ', '.join([f.cells[f.x[index]] for f in factors])
             if v:
-                print x
-            self.x = x
+                print labels
+            self.x = codes.astype(dtype)
             self.cells = labels
             self.name = ':'.join([f.name for f in factors])
+        
+        self.df = len(self.cells) - 1
+        self.indexes = sorted(self.cells.keys())
+    
     def __repr__(self):
-        factors = ', '.join(f.name for f in self.factors)
+        factors = ', '.join(f.name for f in self._factors)
         out = "multifactor(%s)" % factors
         return out
+    
     def iter_n_i(self):
         for i, n in self.cells.iteritems():
             yield n, self.x==i
@@ -2015,6 +3098,11 @@ class model(object):
     
     modify M.effects at own peril!
     
+    Design matrices (``.full``, ``.as_effects``, ``.full_sparse``) are 
+    computed once and cached; the cache is discarded when the list of 
+    effects or the values of any effect change. The properties return copies
+    which the caller can modify.
+    
     """
     _stype_ = "model"
     def __init__(self, *x):
@@ -2046,6 +3134,28 @@ class model(object):
         self.df = sum(e.df for e in self.effects)
         self.df_model = self.df
         self.df_error = self.df_total - self.df_model
+        
+        self._cache = {}
+        self._cache_state = None
+    
+    def _get_cached(self, key, func):
+        """
+        retrieve ``key`` from the cache or compute it with ``func()`` (cached
+        arrays are read-only; copy them before handing them out). The cache 
+        is validated against the values of the effects (not against their 
+        codes, which vars recompute on each access).
+        
+        """
+        state = tuple(_effect_state(e) for e in self.effects)
+        if state != self._cache_state:
+            self._cache = {}
+            self._cache_state = state
+        if key not in self._cache:
+            out = func()
+            if isinstance(out, np.ndarray):
+                out.flags.writeable = False
+            self._cache[key] = out
+        return self._cache[key]
     
     def sorted(self):
         """
@@ -2115,23 +3225,24 @@ class model(object):
     # coding
     @property
     def as_effects(self):
-        out = np.empty((self.N, self.df))
-        i = 0
-        for e in self.effects:
-            j = i+e.df
-            out[:,i:j] = e.as_effects
-            i = j
-        return out
-#        return np.hstack([e.as_effects for e in self.effects])
+        "effect coding of all effects (without intercept)"
+        return self._get_cached('full', self._make_full)[:,1:].copy()
     
     @property
     def full(self):
         "returns the full model including an intercept"
-        df = self.df
-        assert df < self.N, "Model overspecified"
+        return self._full.copy()
+    
+    @property
+    def _full(self):
+        "the cached (read-only) full model, for internal use without copying"
+        assert self.df < self.N, "Model overspecified"
+        return self._get_cached('full', self._make_full)
+    
+    def _make_full(self):
         out = np.empty((self.N, self.df+1))
         # intercept
-        out[:,0] = np.ones(self.N)
+        out[:,0] = 1
         # effects
         i = 1
         for e in self.effects:
@@ -2139,13 +3250,26 @@ class model(object):
             out[:,i:j] = e.as_effects
             i = j
         return out
-        # old:
-#        model = self.as_effects
-#        if not any([len(np.unique(x))==1 for x in model.T]):
-#            intercept = np.ones((self.N, 1), dtype=int)
-#            model = np.hstack((intercept, model))
-#        assert model.shape[1] <= self.N, "Model overspecified"
-#        return model
+    
+    @property
+    def full_sparse(self):
+        """
+        The full model as sparse matrix (``scipy.sparse.csc_matrix``); 
+        efficient for models with many mostly-zero columns such as 
+        interactions with random factors. Factor and interaction columns are 
+        built from the factors' codes without creating the dense codes. 
+        Currently only used by :meth:`orthogonal`; the fitters in 
+        :mod:`eelbrain.analyze.glm` work on the dense :attr:`full` model.
+        
+        """
+        assert self.df < self.N, "Model overspecified"
+        return self._get_cached('full_sparse', self._make_full_sparse).copy()
+    
+    def _make_full_sparse(self):
+        blocks = [scipy.sparse.csc_matrix(np.ones((self.N, 1)))]
+        for e in self.effects:
+            blocks.append(_sparse_effects(e))
+        return scipy.sparse.hstack(blocks, format='csc')
     
     # MARK: coding access
     @property
@@ -2160,23 +3284,23 @@ class model(object):
     def check(self, v=True):
         return self.lin_indep(v) + self.orthogonal(v)
     
+    def _effect_slices(self):
+        "slices of the columns of each effect in .as_effects"
+        return [slice(index.start - 1, index.stop - 1) for _, _, index, _ 
+                in self.iter_effects()]
+    
     def lin_indep(self, v=True):
         "Checks the model for linear independence of its factors"
         msg = []
         ne = len(self.effects)
-        codes = [e.as_effects for e in self.effects]
-#        allok = True
+        codes = self._get_cached('full', self._make_full)[:,1:]
+        slices = self._effect_slices()
         for i in range(ne):
             for j in range(i+1, ne):
-#                ok = True
                 e1 = self.effects[i]
                 e2 = self.effects[j]
-                X = np.hstack((codes[i], codes[j]))
-#                V0 = np.zeros(self.N)
-                #trash, trash, rank, trash = np.linalg.lstsq(X, V0)
+                X = np.hstack((codes[:,slices[i]], codes[:,slices[j]]))
                 if rank(X) < X.shape[1]:
-#                    ok = False
-#                    allok = False
                     if v:
                         errtxt = "Linear Dependence Warning: {0} and {1}"
                         msg.append(errtxt.format(e1.name, e2.name))
@@ -2186,21 +3310,15 @@ class model(object):
         "Checks the model for orthogonality of its factors"
         msg = []
         ne = len(self.effects)
-        codes = [e.as_effects for e in self.effects]
-#        allok = True
+        # all dot products between columns at once
+        X = self._get_cached('full_sparse', self._make_full_sparse)[:,1:]
+        XtX = (X.T * X).toarray()
+        slices = self._effect_slices()
         for i in range(ne):
             for j in range(i+1, ne):
-                ok = True
                 e1 = self.effects[i]
                 e2 = self.effects[j]
-                e1e = codes[i]
-                e2e = codes[j]
-                for i1 in range(e1.df):
-                    for i2 in range(e2.df):
-                        dotp = np.dot(e1e[:,i1], e2e[:,i2])
-                        if dotp != 0:
-                            ok = False
-#                            allok = False
+                ok = not np.any(XtX[slices[i], slices[j]])
                 if v and (not ok):
                     errtxt = "Not orthogonal: {0} and {1}"
                     msg.append(errtxt.format(e1.name, e2.name))
@@ -2209,11 +3327,13 @@ class model(object):
     ## OTHER STUFF
     @property
     def factors(self):
-        f = set() 
+        "factors in the model (in order of first occurrence)"
+        f = []
         for e in self.effects:
-            #print set(e.factors)
-            f = f.union(set(e.factors))
-        return list(f)
+            for factor in e.factors:
+                if not any(factor is f_ for f_ in f):
+                    f.append(factor)
+        return f
     
     # __combination_methods__
     def __add__(self, other):
@@ -2243,21 +3363,25 @@ class model(object):
         return model(*effects)
     
     # category access
+    def _get_cat_codes(self):
+        "(codes, first): category index for each case"
+        return _combine_codes(self._get_cached('full', self._make_full).T)
+    
     @property 
     def unique(self):
-        full = self.full
-        unique_indexes = np.unique([tuple(i) for i in full])
-        return unique_indexes
+        "unique rows of the full model (one for each category)"
+        _, first = self._get_cached('cat_codes', self._get_cat_codes)
+        return self._get_cached('full', self._make_full)[first]
     
     @property
     def n_cat(self):
-        return len(self.unique)
+        _, first = self._get_cached('cat_codes', self._get_cat_codes)
+        return len(first)
     
     def iter_cat(self):
-        full = self.full
-        for i in self.unique:
-            cat = np.all(full==i, axis=1)
-            yield cat
+        codes, first = self._get_cached('cat_codes', self._get_cat_codes)
+        for i in xrange(len(first)):
+            yield codes == i
     
 #    @property
 #    def cells(self):
@@ -2291,22 +3415,27 @@ class model(object):
 #            pass # FIXME: dshyg5erjbhaegr
 
 
-def _split_Y(Y, X, match=None, sub=None, datalabels=None):
+def split_Y(Y, X, match=None, sub=None, datalabels=None):
     """
-    returns 2  (factor, model of factors)
+    Splits Y into the cells defined by X (in a single grouped pass).
+    
     Y       dependent measurement
     X       factor model
     match   factor on which cases are matched for repeated measures comparisons
     sub     Bool Array of len==N specifying which cases to include
+    datalabels  factor providing labels for the data points (default: match)
     
     
     out
     ---
     data:   lists with those values in Y (ndarray, factorm var) which lie in 
-            each cell defined by X
-    data_labels: 
-    names: 
-    within: (bool)
+            each cell defined by X; with match, values are sorted by match and 
+            several values for the same match value are averaged
+    data_labels: list with the labels corresponding to data
+    names:  list with the cell names
+    within: (bool) whether all cells contain the same match values (i.e. a 
+            repeated measures comparison)
+    
     """
     # prepare input
     if type(Y) == nonbasic_effect:
@@ -2329,71 +3458,70 @@ def _split_Y(Y, X, match=None, sub=None, datalabels=None):
             match = match[sub]
         if datalabels:
             datalabels = datalabels[sub]
-    X = X.factors
+    mf = multifactor(X.factors)
     Y = Y.x
-    mf = multifactor(X)
     
-    # prepare data labels
+    # prepare data labels (labels are looked up for the codes in each group)
     if datalabels:
-        datalabels = datalabels.as_labels()
-        do_dlbls = True
+        datalabels = asfactor(datalabels)
     elif match:
-        datalabels = match.as_labels()
-        do_dlbls = True
+        datalabels = match
     else:
         datalabels = None
-        do_dlbls = False
-    data = []
-    data_labels = []
-    names = []
-    sorted_indexes = [] # for repeated measures
     
     ## Collect Data ######
-    for n, i in mf.iter_n_i(): # cells
-        cell_data = Y[i]
-        if do_dlbls: cell_labels = datalabels[i]
-        if match:
-            indexes = match.x[i] # vp ids in cell
-            i_sorted = sorted(np.unique(indexes))
-            sorted_indexes.append(i_sorted)
-            if len(i_sorted) == len(indexes):
-                indexes_argsort = np.argsort(indexes)
-                cell_data = cell_data[indexes_argsort]
-                if do_dlbls: cell_labels = cell_labels[indexes_argsort]
-            else:
-                d_list = []
-                l_list = []
-                for j in i_sorted:
-                    j_indexes = np.where(indexes==j)[0]
-                    d_list.append(np.mean(cell_data[j_indexes]))
-                    if do_dlbls: # get label
-                        label = cell_labels[j_indexes[0]]
-                        if len(j_indexes) > 1:
-                            if any([label != cell_labels[li] for li in j_indexes[1:]]):
-                                raise ValueError("cell label mismatch -- combining cells of different grouping blargh")
-                        l_list.append(label) # will not notice if labels differ between cases!
-                cell_data = np.array(d_list)
-                if do_dlbls: cell_labels = np.array(l_list)
-        if len(cell_data) > 0: # drop empty cells (in case of empty dict entries in factors)
-            data.append(cell_data)
-            names.append(n)
-            if do_dlbls: data_labels.append(cell_labels)
+    # groups: cells of mf, or cell x match combinations
+    if match:
+        groups = _cell_groups([mf.x, match.x])
+    else:
+        groups = _cell_groups([mf.x])
+    group_cells = mf.x[groups.first]
+    
+    if match:
+        if np.all(groups.counts == 1):
+            values = groups.sort(Y)
+        else:
+            values = groups.reduce(Y, np.mean)
+        match_ids = match.x[groups.first]
+        if datalabels is not None:
+            codes = groups.sort(datalabels.x)
+            label_codes = codes[groups.starts]
+            if np.any(codes != np.repeat(label_codes, groups.counts)):
+                err = ("cell label mismatch -- combining cells of different "
+                       "grouping blargh")
+                raise ValueError(err)
+        # boundaries between cells in the group arrays
+        bounds = np.flatnonzero(np.diff(group_cells)) + 1
+        cells = group_cells[np.r_[0, bounds]]
+    else:
+        values = groups.sort(Y)
+        if datalabels is not None:
+            label_codes = groups.sort(datalabels.x)
+        bounds = groups.starts[1:]
+        cells = group_cells
+    
+    data = np.split(values, bounds)
+    names = [mf.cells[cell] for cell in cells]
+    if datalabels is None:
+        data_labels = []
+    else:
+        labels = datalabels._code_labels(label_codes)
+        data_labels = np.split(labels, bounds)
+    
     # determine repeated measures status
     within = False
     if match:
-        icomp = sorted_indexes.pop(0)
-        if all([i==icomp for i in sorted_indexes]):
+        cell_ids = np.split(match_ids, bounds)
+        icomp = cell_ids[0]
+        if all(np.array_equal(ids, icomp) for ids in cell_ids[1:]):
             within = True
             logging.debug("SPLIT Y: repeated measures")
         else:
             logging.debug("SPLIT Y: independent measures")
-#    out = {'data': data,
-#           'data_labels': data_labels,
-#           'names': names,
-#           'within': within}
-#    return out
     return data, data_labels, names, within
 
+_split_Y = split_Y
+
 
 
 # Structured Collections ---
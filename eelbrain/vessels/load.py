@@ -14,13 +14,16 @@ Created on Feb 21, 2012
 __all__ = ['unavailable']
 unavailable = []
 
+from collections import OrderedDict
+import hashlib
 import os
 
 import numpy as np
 
 try:
     import mne
-    __all__.extend(('fiff_events', 'fiff_epochs'))
+    __all__.extend(('fiff_events', 'fiff_epochs', 'fiff_epoch_data', 
+                    'fiff_subjects'))
 except ImportError:
     unavailable.append('mne import failed')
 
@@ -28,9 +31,13 @@ import data as _data
 import colorspaces as _cs
 import sensors
 from eelbrain import ui
+from eelbrain.utils import parallel
 
 
 
+defaults = dict(cache_dir=None, # default for cache=True (None: directory
+                                # 'eelbrain-cache' next to the raw file)
+                )
 
 
 _default_fiff_properties = {'proj': 'ideal',
@@ -41,7 +48,541 @@ _default_fiff_properties = {'proj': 'ideal',
                             }
 
 
-def fiff_events(source_path=None, name=None):
+def _sfreq(info):
+    "sampling frequency from an mne info dict"
+    return float(np.ravel(info['sfreq'])[0])
+
+
+def _epoch_times(sfreq, tstart, tstop):
+    "time points of epochs from tstart to tstop (like mne.Epochs)"
+    start = int(round(tstart * sfreq))
+    stop = int(round(tstop * sfreq))
+    return np.arange(start, stop + 1) / sfreq
+
+
+def _sensor_net(raw, name):
+    "sensor_net with the MEG channels of an mne Raw object"
+    sensor_list = []
+    for ch in raw.info['chs']:
+        ch_name = ch['ch_name']
+        if ch_name.startswith('MEG'):
+            x, y, z = ch['loc'][:3]
+            sensor_list.append([x, y, z, ch_name])
+    return sensors.sensor_net(sensor_list, name=name)
+
+
+def _meg_picks(raw):
+    return mne.fiff.pick_types(raw.info, meg=True, eeg=False, stim=False, 
+                               eog=False, include=[], exclude=[])
+
+
+def _cache_dir(cache, source_path):
+    """
+    directory for cache files (see the ``cache`` argument of 
+    :func:`fiff_epochs`); None if the cache is not used
+    
+    """
+    if not cache:
+        return None
+    elif cache is True:
+        cache = defaults['cache_dir']
+        if cache is None:
+            cache = os.path.join(os.path.dirname(os.path.abspath(source_path)),
+                                 'eelbrain-cache')
+    if not os.path.exists(cache):
+        os.makedirs(cache)
+    return cache
+
+
+def _cache_key(source_path, *args):
+    """
+    md5 hash identifying the raw file (path, size and modification time) and
+    the parameters in ``args`` (arrays are hashed by their content)
+    
+    """
+    md5 = hashlib.md5()
+    stat = os.stat(source_path)
+    file_id = (os.path.abspath(source_path), stat.st_size, stat.st_mtime)
+    md5.update(repr(file_id))
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            md5.update(arg.dtype.str)
+            md5.update(repr(arg.shape))
+            md5.update(np.ascontiguousarray(arg).tostring())
+        else:
+            md5.update(repr(arg))
+    return md5.hexdigest()
+
+
+def _dims_key(dims):
+    """
+    values identifying the ndvar dimensions ``dims`` for :func:`_cache_key`
+    (the sensor net's name, sensor names and locations, the values of other
+    dimensions)
+    
+    """
+    key = []
+    for dim in dims:
+        if hasattr(dim, 'locs3d'):
+            key.extend((dim.name, dim.net_name, dim.names, dim.locs3d, 
+                        dim.default_transform_2d))
+        else:
+            key.extend((dim.name, np.asarray(dim.x)))
+    return key
+
+
+def _cached_epochs(cache_dir, source_path, raw, i_start, picks, tstart, tstop,
+                   baseline, decim, dims, dtype, properties, name):
+    """
+    Returns an ndvar with the epochs, memory-mapped from the cache file in
+    ``cache_dir``. If there is no cache file for the parameters, the epochs
+    are read from the raw file into a new cache file. The cache file stores
+    ``dims``, so they are part of the key.
+    
+    """
+    i_start = np.asarray(i_start, dtype=np.int64)
+    picks = np.asarray(picks, dtype=np.int64)
+    dtype = np.dtype(dtype)
+    key = _cache_key(source_path, i_start, picks, tstart, tstop, baseline, 
+                     decim, dtype.str, *_dims_key(dims))
+    fn = os.path.join(cache_dir, key + '.ndvar')
+    if not os.path.exists(fn):
+        # write to temporary files first, so that an interrupted read does 
+        # not leave an incomplete cache entry
+        tmp_fn = os.path.join(cache_dir, key + '-%i.ndvar' % os.getpid())
+        Y = _data.memmap_ndvar(tmp_fn, dims, len(i_start), dtype, 
+                               properties=properties, name=name)
+        _read_epochs_into(Y.data, raw, i_start, picks, tstart, tstop, baseline,
+                          decim)
+        Y.data.flush()
+        del Y
+        os.rename(_data._ndvar_data_fn(tmp_fn), _data._ndvar_data_fn(fn))
+        os.rename(tmp_fn, fn)
+    
+    Y = _data.load_ndvar(fn)
+    Y.name = name
+    Y.properties = properties.copy()
+    return Y
+
+
+def _baseline_index(times, baseline):
+    "boolean index of the baseline interval (None for no baseline)"
+    if baseline is None:
+        return None
+    bmin, bmax = baseline
+    index = np.ones(len(times), dtype=bool)
+    if bmin is not None:
+        index &= times >= bmin
+    if bmax is not None:
+        index &= times <= bmax
+    return index
+
+
+def _projector(info, ch_names):
+    """
+    SSP projection operator for the channels ``ch_names``, built from all 
+    projection items in ``info['projs']`` (which :class:`mne.Epochs` 
+    activates), with bad channels excluded from the projection vectors as in
+    :func:`mne.fiff.proj.make_projector`. Returns None if no projection 
+    vector applies to the channels.
+    
+    """
+    bads = set(info.get('bads') or ())
+    vecs = []
+    for proj in info.get('projs') or ():
+        col_names = list(proj['data']['col_names'])
+        sel = []
+        vecsel = []
+        for i, ch_name in enumerate(ch_names):
+            if ch_name in col_names and ch_name not in bads:
+                sel.append(i)
+                vecsel.append(col_names.index(ch_name))
+        if not sel:
+            continue
+        for row in np.atleast_2d(proj['data']['data']):
+            vec = np.zeros(len(ch_names))
+            vec[sel] = row[vecsel]
+            norm = np.sqrt(np.sum(vec ** 2))
+            if norm > 0:
+                vecs.append(vec / norm)
+    if not vecs:
+        return None
+    
+    # orthogonal basis of the projection subspace
+    U, S, _ = np.linalg.svd(np.transpose(vecs), full_matrices=False)
+    U = U[:, S > S[0] * 1e-2]
+    return np.eye(len(ch_names)) - np.dot(U, U.T)
+
+
+def _comp_grade(info):
+    "current CTF compensation grade of the MEG channels (0 for none)"
+    for ch in info['chs']:
+        if ch.get('kind') == 1: # FIFF.FIFFV_MEG_CH
+            return int(ch['coil_type']) >> 16
+    return 0
+
+
+def _read_operator(raw, picks):
+    """
+    Returns ``(read_picks, operator)``: the channels to read from ``raw`` 
+    and the matrix that maps them to the ``picks`` channels as 
+    :class:`mne.Epochs` returns them, i.e. compensated to grade 0 and with 
+    the SSP projections applied (``operator`` is None if the data are used 
+    as they are read).
+    
+    """
+    picks = np.asarray(picks, dtype=int)
+    read_picks = picks
+    operator = None
+    
+    grade = _comp_grade(raw.info)
+    if grade != 0:
+        comp = mne.fiff.compensator.make_compensator(raw.info, grade, 0)
+        comp = comp[picks]
+        read_picks = np.union1d(picks, np.flatnonzero(np.any(comp != 0, 0)))
+        operator = comp[:, read_picks]
+    
+    ch_names = [raw.info['chs'][i]['ch_name'] for i in picks]
+    proj = _projector(raw.info, ch_names)
+    if proj is not None:
+        if operator is None:
+            operator = proj
+        else:
+            operator = np.dot(proj, operator)
+    
+    return read_picks, operator
+
+
+def _epoch_samples(raw, i_start, tstart, tstop, decim=1):
+    """
+    Returns ``(starts, n_samples)``: the first sample read for each epoch 
+    (relative to the start of the raw data) and the number of samples read 
+    per epoch, including the margin for the anti-aliasing filter (see 
+    :func:`_read_epochs_into`).
+    
+    """
+    sfreq = _sfreq(raw.info)
+    n_times = len(_epoch_times(sfreq / decim, tstart, tstop))
+    pad = len(_data._decim_filter(decim)) // 2
+    offset = int(round(tstart * sfreq / decim)) * decim - pad
+    n_samples = (n_times - 1) * decim + 1 + 2 * pad
+    starts = np.asarray(i_start, dtype=int) + offset - raw.first_samp
+    return starts, n_samples
+
+
+def _epochs_in_data(raw, i_start, tstart, tstop, decim=1):
+    "boolean index of the epochs that lie within the raw data"
+    starts, n_samples = _epoch_samples(raw, i_start, tstart, tstop, decim)
+    return (starts >= 0) & (starts + n_samples <= len(raw))
+
+
+# maximum size of the raw data segment read at once (bytes)
+_chunk_bytes = 2**26
+
+
+def _read_epochs_into(out, raw, i_start, picks, tstart, tstop, 
+                      baseline=(None, 0), decim=1):
+    """
+    Reads epochs from a raw file into ``out``, an array (or memmap) of shape
+    ``(n_epochs, n_times, n_sensors)``.
+    
+    The raw data are read in segments of up to ``_chunk_bytes``; the epochs 
+    that fall into a segment (up to ``_chunk_bytes`` of extracted epochs) 
+    are extracted at once, baseline corrected (in float64) and written to 
+    ``out``. Apart from ``out``, at most one segment and the epochs 
+    extracted from it are held in memory (unless a single epoch exceeds 
+    ``_chunk_bytes``).
+    
+    As with :class:`mne.Epochs`, the data are compensated to grade 0 (CTF 
+    compensation) and the SSP projections in ``raw.info['projs']`` are 
+    applied (see :func:`_read_operator`); epochs are not rejected. Epochs 
+    that exceed the raw data raise an IOError (see :func:`_epochs_in_data`).
+    
+    raw : mne.fiff.Raw
+        the raw file
+    i_start : array of int
+        sample index of the events (as returned by :func:`mne.find_events`)
+    picks : array of int
+        channels to read
+    tstart, tstop : scalar
+        epoch time window relative to the events (in seconds)
+    baseline : None | tuple
+        time interval for baseline correction (``None`` to skip baseline 
+        correction)
+    decim : int
+        Decimation factor. Epochs are read with a margin of half the length 
+        of the anti-aliasing filter (:func:`data._decim_filter`) on each 
+        side, filtered and downsampled to the time points of 
+        ``_epoch_times(sfreq / decim, tstart, tstop)`` before baseline 
+        correction.
+    
+    """
+    i_start = np.asarray(i_start, dtype=int)
+    sfreq = _sfreq(raw.info)
+    times = _epoch_times(sfreq / decim, tstart, tstop)
+    n_times = len(times)
+    if out.shape != (len(i_start), n_times, len(picks)):
+        err = ("out has shape %s, need %s" 
+               % (out.shape, (len(i_start), n_times, len(picks))))
+        raise ValueError(err)
+    b_index = _baseline_index(times, baseline)
+    h = _data._decim_filter(decim)
+    read_picks, operator = _read_operator(raw, picks)
+    
+    # epochs in order of their position in the raw file
+    order = np.argsort(i_start, kind='mergesort')
+    starts, n_samples = _epoch_samples(raw, i_start[order], tstart, tstop, 
+                                       decim)
+    stops = starts + n_samples
+    invalid = np.flatnonzero((starts < 0) | (stops > len(raw)))
+    if len(invalid):
+        msg = ("Epoch %i exceeds the data: does your epoch definition "
+               "result in an epoch that overlaps the end of your data "
+               "file?" % order[invalid[0]])
+        raise IOError(msg)
+    
+    n_picks = max(1, len(read_picks))
+    chunk_samples = max(n_samples, _chunk_bytes // (8 * n_picks))
+    chunk_epochs = max(1, _chunk_bytes // (8 * n_picks * n_samples))
+    time_index = np.arange(n_samples)
+    i = 0
+    while i < len(starts):
+        # epochs that end within the chunk (at least one); with overlapping
+        # epochs, the number of epochs is limited as well
+        seg_start = starts[i]
+        j = np.searchsorted(stops, seg_start + chunk_samples, 'right')
+        j = min(max(j, i + 1), i + chunk_epochs)
+        seg_stop = stops[j - 1]
+        segment, _ = raw[read_picks, seg_start:seg_stop]
+        if operator is not None:
+            segment = np.dot(operator, segment)
+        
+        # (sensor, epoch, time) -> (epoch, time, sensor)
+        index = (starts[i:j] - seg_start)[:,None] + time_index
+        epochs = segment[:, index].transpose((1, 2, 0))
+        if decim > 1:
+            epochs = _data._fir_decimate(epochs, h, decim, 0, n_times, 1)
+        if b_index is not None:
+            epochs -= epochs[:, b_index].mean(1)[:,None]
+        
+        dest = order[i:j]
+        if np.all(np.diff(dest) == 1):
+            out[dest[0]:dest[-1] + 1] = epochs
+        else:
+            out[dest] = epochs
+        i = j
+
+
+def _read_conditions_into(out, raw, events, conditions, tstart, tstop, picks,
+                          decim=1):
+    """
+    Reads the epochs for each condition ID in ``conditions`` (in iteration 
+    order) into consecutive cases of ``out`` (shape ``(n_epochs, n_times, 
+    n_sensors)``). Returns the list of condition IDs of the epochs read.
+    
+    """
+    ids = []
+    i_start = []
+    for ID in conditions:
+        c_start = events[events[:,2] == ID, 0]
+        i_start.append(c_start)
+        ids.extend([ID] * len(c_start))
+    i_start = np.concatenate(i_start)
+    _read_epochs_into(out[:len(ids)], raw, i_start, picks, tstart, tstop, 
+                      decim=decim)
+    return ids
+
+
+
+class fiff_epoch_data(object):
+    """
+    Array-like object that reads epochs from a raw fiff file on demand. It 
+    can be used as ``data`` of an :class:`ndvar` with shape ``(n_epochs, 
+    n_times, n_sensors)``; indexing reads only the requested epochs, and 
+    recently read epochs are kept in a least recently used (LRU) cache. 
+    Converting to an array (e.g., ``np.asarray(data)``) reads all epochs.
+    
+    """
+    def __init__(self, source_path, i_start, picks, tstart=-.2, tstop=.6, 
+                 baseline=(None, 0), cache_size=100, raw=None, dtype=None,
+                 decim=1):
+        """
+        source_path : str
+            path of the raw fiff file
+        i_start : array of int
+            sample index of the events (as returned by 
+            :func:`mne.find_events`)
+        picks : array of int
+            channels to read
+        tstart, tstop : scalar
+            epoch time window relative to the events (in seconds)
+        baseline : None | tuple
+            time interval for baseline correction (``None`` for the epoch 
+            boundary; ``baseline=None`` to skip baseline correction)
+        cache_size : int
+            maximum number of epochs to keep in the cache
+        raw : None | mne.fiff.Raw
+            the opened raw file (if it is already open)
+        dtype : None | dtype
+            data type of the epochs (default ``data.defaults['dtype']``)
+        decim : int
+            decimation factor (see :func:`fiff_epochs`)
+        
+        """
+        if raw is None:
+            raw = mne.fiff.Raw(source_path)
+        self._raw = raw
+        self.source_path = source_path
+        self.i_start = np.asarray(i_start, dtype=int)
+        self.picks = np.asarray(picks, dtype=int)
+        self.tstart = tstart
+        self.tstop = tstop
+        self.baseline = baseline
+        self.decim = decim
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        
+        self.times = _epoch_times(_sfreq(raw.info) / decim, tstart, tstop)
+        
+        if dtype is None:
+            dtype = _data.defaults['dtype']
+        self.dtype = np.dtype(dtype)
+        self.shape = (len(self.i_start), len(self.times), len(self.picks))
+        self.ndim = 3
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_raw']
+        state['_cache'] = OrderedDict()
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._raw = mne.fiff.Raw(self.source_path)
+    
+    def __repr__(self):
+        args = (os.path.basename(self.source_path), self.shape)
+        return "<fiff_epoch_data %r: shape %s>" % args
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __array__(self, dtype=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype)
+        return data
+    
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            case_index = index[0]
+            sub_index = index[1:]
+        else:
+            case_index = index
+            sub_index = ()
+        
+        epochs = np.arange(self.shape[0])[case_index]
+        if np.ndim(epochs) == 0:
+            out = self._get_epochs(epochs[None])[0]
+        else:
+            out = self._get_epochs(epochs)
+            sub_index = (slice(None),) + sub_index
+        
+        if sub_index:
+            out = out[sub_index]
+        return out
+    
+    def _get_epochs(self, epochs):
+        """
+        data for several epochs as (epoch, time, sensor) array; epochs that 
+        are not in the cache are read together
+        
+        """
+        out = np.empty((len(epochs),) + self.shape[1:], dtype=self.dtype)
+        missing = []
+        for k, i in enumerate(epochs):
+            if i in self._cache:
+                data = self._cache.pop(i)
+                self._cache[i] = data
+                out[k] = data
+            else:
+                missing.append(k)
+        
+        if missing:
+            i_missing = epochs[missing]
+            data = np.empty((len(missing),) + self.shape[1:], dtype=self.dtype)
+            _read_epochs_into(data, self._raw, self.i_start[i_missing], 
+                              self.picks, self.tstart, self.tstop, 
+                              self.baseline, self.decim)
+            out[missing] = data
+            for i, epoch in zip(i_missing, data)[-self.cache_size:]:
+                self._cache.pop(i, None)
+                self._cache[i] = epoch.copy()
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return out
+
+
+
+def _stim_picks(raw, stim):
+    "channel indexes for stim (channel name or index, or a list of those)"
+    if isinstance(stim, (basestring, int)):
+        stim = [stim]
+    names = [ch['ch_name'] for ch in raw.info['chs']]
+    picks = []
+    for ch in stim:
+        if isinstance(ch, basestring):
+            if ch not in names:
+                raise ValueError("Raw file contains no channel named %r" % ch)
+            picks.append(names.index(ch))
+        else:
+            picks.append(int(ch))
+    return np.array(picks, dtype=int)
+
+
+def _find_stim_events(raw, stim, threshold=1.):
+    """
+    Finds events on stim channels and returns them as ``(n_events, 3)`` 
+    array like :func:`mne.find_events` (sample index, 0, event ID).
+    
+    The raw data are read in segments of up to ``_chunk_bytes``. A single 
+    channel contains the event IDs; for several channels (trigger lines), 
+    each line is thresholded and line ``i`` contributes bit ``i`` (i.e., the
+    first line is the least significant bit). An event is any sample at 
+    which the event ID changes to a value other than 0. 
+    
+    """
+    picks = _stim_picks(raw, stim)
+    weights = 2 ** np.arange(len(picks))
+    chunk_samples = max(2, _chunk_bytes // (8 * len(picks)))
+    
+    i_start = []
+    ids = []
+    last = 0 # event ID at the end of the previous segment
+    for start in xrange(0, len(raw), chunk_samples):
+        segment, _ = raw[picks, start:start + chunk_samples]
+        if len(picks) == 1:
+            code = np.round(segment[0]).astype(np.int64)
+        else:
+            code = np.dot(weights, segment > threshold)
+        
+        # onsets: changes to a nonzero ID
+        onset = np.empty(len(code), dtype=bool)
+        onset[0] = code[0] != last
+        onset[1:] = code[1:] != code[:-1]
+        onset &= code != 0
+        index = np.flatnonzero(onset)
+        i_start.append(index + start)
+        ids.append(code[index])
+        last = code[-1]
+    
+    i_start = np.concatenate(i_start) + raw.first_samp
+    ids = np.concatenate(ids)
+    return np.column_stack((i_start, np.zeros_like(i_start), ids))
+
+
+def fiff_events(source_path=None, name=None, cache=False, stim=None, 
+                threshold=1.):
     """
     Returns a dataset containing events from a raw fiff file. Use
     :func:`fiff_epochs` to load MEG data corresponding to those events.
@@ -52,6 +593,23 @@ def fiff_events(source_path=None, name=None):
     
     name : str
         A name for the dataset.
+    
+    cache : bool | str
+        Store the events in a cache file (see :func:`fiff_epochs`); the 
+        raw file is not opened when the events are found in the cache.
+    
+    stim : None | str | int | list
+        Find events on these stim channels (name or index) instead of using
+        :func:`mne.find_events`. A single channel contains the event IDs; 
+        for several channels (trigger lines such as the 
+        ``'161:162:163:164:165:166:167:168'`` stim lines of 
+        :func:`mne_link.kit2fiff`), the first channel is the least 
+        significant bit of the event ID. The data are read in segments, and
+        an event is any change of the event ID to a nonzero value.
+    
+    threshold : scalar
+        With several stim channels, values above ``threshold`` count as 
+        "on".
     """
     if source_path is None:
         source_path = ui.ask_file("Pick a Fiff File", "Pick a Fiff File",
@@ -60,8 +618,20 @@ def fiff_events(source_path=None, name=None):
     if name is None:
         name = os.path.basename(source_path)
     
-    raw = mne.fiff.Raw(source_path)
-    events = mne.find_events(raw)
+    cache_dir = _cache_dir(cache, source_path)
+    if cache_dir:
+        key = _cache_key(source_path, 'events', stim, threshold)
+        fn = os.path.join(cache_dir, key + '-events.npy')
+        if os.path.exists(fn):
+            events = np.load(fn)
+        else:
+            events = _read_events(source_path, stim, threshold)
+            tmp_fn = os.path.join(cache_dir, key + '-%i.npy' % os.getpid())
+            np.save(tmp_fn, events)
+            os.rename(tmp_fn, fn)
+    else:
+        events = _read_events(source_path, stim, threshold)
+    
     if any(events[:,1] != 0):
         raise NotImplementedError("Events starting with ID other than 0")
         # this was the case in the raw-eve file, which contained all event 
@@ -73,68 +643,110 @@ def fiff_events(source_path=None, name=None):
     return _data.dataset(event, istart, name=name, info=info)
 
 
+def _read_events(source_path, stim, threshold):
+    "events array for :func:`fiff_events`"
+    raw = mne.fiff.Raw(source_path)
+    if stim is None:
+        return mne.find_events(raw)
+    else:
+        return _find_stim_events(raw, stim, threshold)
+
+
 def fiff_epochs(dataset, i_start='i_start', 
                 tstart=-.2, tstop=.6, baseline=(None,  0),
-                properties=None, name="MEG", sensorsname='fiff-sensors'):
+                properties=None, name="MEG", sensorsname='fiff-sensors',
+                lazy=False, cache_size=100, dtype=None, cache=False,
+                decim=None, sfreq=None):
     """
     Uses the events in ``dataset[i_start]`` to extract epochs from the raw 
     file
     
+    The epochs are read directly from the raw data. As with 
+    :class:`mne.Epochs`, the data are compensated to grade 0 and the SSP 
+    projections stored in the raw file are applied; unlike 
+    :class:`mne.Epochs`, no epochs are rejected. Epochs that exceed the 
+    raw data raise an IOError.
+    
     i_start : str
         name of the variable containing the index of the events to be
         imported
+    
+    lazy : bool
+        Do not read the data now; the ndvar's data is a 
+        :class:`fiff_epoch_data` object which reads epochs from the raw file 
+        only when they are accessed (e.g., for reviewing a few epochs at a 
+        time).
+    
+    cache_size : int
+        With ``lazy=True``, the number of recently read epochs that are kept 
+        in memory.
+    
+    dtype : None | dtype
+        Data type for the MEG data (default ``data.defaults['dtype']``, 
+        float32).
+    
+    cache : bool | str
+        Keep the epochs in a cache file, from which they are memory-mapped 
+        (read-only) when the same epochs are requested again. Cache files 
+        are identified by the raw file (path, size and modification time), 
+        the event positions, ``tstart``, ``tstop``, ``baseline``, the 
+        channels, the decimation factor, ``dtype`` and the dimensions 
+        (including the sensor net with ``sensorsname``). ``True`` uses 
+        ``defaults['cache_dir']`` (by default, a directory called 
+        ``'eelbrain-cache'`` next to the raw file); a str specifies the cache
+        directory.
+    
+    decim : None | int
+        Downsample the data by this factor while reading (after filtering 
+        with a zero-phase anti-aliasing low-pass filter at the new Nyquist 
+        frequency). The ``'samplingrate'`` property and the time axis refer
+        to the downsampled data.
+    
+    sfreq : None | scalar
+        Downsample to this sampling rate (instead of ``decim``; needs to be 
+        an integer fraction of the sampling rate of the raw file).
          
     """
-    events = np.empty((dataset.N, 3), dtype=np.int32)
-    events[:,0] = dataset[i_start].x
-    events[:,1] = 0
-    events[:,2] = 1
+    if dtype is None:
+        dtype = _data.defaults['dtype']
+    if lazy and cache:
+        raise ValueError("lazy and cache can not be combined")
+
+    i_start = dataset[i_start].x
     
     source_path = dataset.info['source']
     raw = mne.fiff.Raw(source_path)
+    sensor_net = _sensor_net(raw, sensorsname)
+    picks = _meg_picks(raw)
+    decim = _data._decim_factor(_sfreq(raw.info), decim, sfreq)
+    samplingrate = _sfreq(raw.info) / decim
     
-    # parse sensor net
-    sensor_list = []
-    for ch in raw.info['chs']:
-        ch_name = ch['ch_name']
-        if ch_name.startswith('MEG'):
-            x, y, z = ch['loc'][:3]
-            sensor_list.append([x, y, z, ch_name])
-    sensor_net = sensors.sensor_net(sensor_list, name=sensorsname)
-    
-    picks = mne.fiff.pick_types(raw.info, meg=True, eeg=False, stim=False, 
-                                eog=False, include=[], exclude=[])
-    
-    epochs = mne.Epochs(raw, events, 1, tstart, tstop, picks=picks, 
-                        baseline=baseline)
-    
-    # determine data container properties
-    epoch_shape = (len(picks), len(epochs.times))
-    data_shape = (len(events), len(epochs.times), len(picks))
-    # mne.fiff.raw.read_raw_segment uses float32
-    data = np.empty(data_shape, dtype='float32') 
-
-    # read the data
-    for i, epoch in enumerate(epochs):
-        if epoch.shape == epoch_shape:
-            data[i] = epoch.T
-        else:
-            msg = ("Epoch %i shape mismatch: does your epoch definition "
-                   "result in an epoch that overlaps the end of your data "
-                   "file?" % i)
-            raise IOError(msg)
-    
-    # read data properties
-    props = {'samplingrate': epochs.info['sfreq'][0]}
+    # data properties
+    props = {'samplingrate': samplingrate}
     props.update(_default_fiff_properties)
     if properties:
         props.update(properties)
     
-    T = epochs.times
+    T = _epoch_times(samplingrate, tstart, tstop)
     timevar = _data.var(T, 'time')
     dims = (timevar, sensor_net)
     
-    dataset.add(_data.ndvar(dims, data, properties=props, name=name))
+    cache_dir = _cache_dir(cache, source_path)
+    if lazy:
+        data = fiff_epoch_data(source_path, i_start, picks, tstart, tstop,
+                               baseline, cache_size=cache_size, raw=raw, 
+                               dtype=dtype, decim=decim)
+        Y = _data.ndvar(dims, data, properties=props, name=name)
+    elif cache_dir:
+        Y = _cached_epochs(cache_dir, source_path, raw, i_start, picks, tstart,
+                           tstop, baseline, decim, dims, dtype, props, name)
+    else:
+        data = np.empty((len(i_start), len(T), len(picks)), dtype=dtype)
+        _read_epochs_into(data, raw, i_start, picks, tstart, tstop, baseline,
+                          decim)
+        Y = _data.ndvar(dims, data, properties=props, name=name)
+    
+    dataset.add(Y)
     dataset.default_DV = name
 
         
@@ -144,8 +756,8 @@ def fiff_epochs(dataset, i_start='i_start',
 def fiff_event_file(path, labels={}):
     events = mne.read_events(path).reshape((-1,6))
     name = os.path.basename(path)
-    assert all(events[:,1] == events[:,5])
-    assert all(events[:,2] == events[:,4])
+    assert np.all(events[:,1] == events[:,5])
+    assert np.all(events[:,2] == events[:,4])
     istart = _data.var(events[:,0], name='i_start')
     istop = _data.var(events[:,3], name='i_stop')
     event = _data.var(events[:,2], name='eventID')
@@ -158,44 +770,55 @@ def fiff_event_file(path, labels={}):
 
 def add_fiff_to_events(path, dataset, i_start='i_start', 
                        tstart=-.2, tstop=.6, properties=None, 
-                       name="MEG", sensorsname='fiff-sensors'):
+                       name="MEG", sensorsname='fiff-sensors', dtype=None,
+                       cache=False, decim=None, sfreq=None):
     """
-    Adds MEG data form a new file to a dataset containing events. 
+    Adds MEG data form a new file to a dataset containing events. Epochs are
+    read directly from the raw data (see :func:`fiff_epochs`).
     
-    """
-    events = np.empty((dataset.N, 3), dtype=np.uint32)
-    events[:,0] = dataset[i_start].x
-    events[:,1] = 0
-    events[:,2] = 1
+    dtype : None | dtype
+        Data type for the MEG data (default ``data.defaults['dtype']``).
     
-    raw = mne.fiff.Raw(path)
+    cache : bool | str
+        Keep the epochs in a cache file (see :func:`fiff_epochs`).
     
-    # parse sensor net
-    sensor_list = []
-    for ch in raw.info['chs']:
-        ch_name = ch['ch_name']
-        if ch_name.startswith('MEG'):
-            x, y, z = ch['loc'][:3]
-            sensor_list.append([x, y, z, ch_name])
-    sensor_net = sensors.sensor_net(sensor_list, name=sensorsname)
+    decim, sfreq : None | scalar
+        Downsample the data while reading (see :func:`fiff_epochs`).
     
-    picks = mne.fiff.pick_types(raw.info, meg=True, eeg=False, stim=False, 
-                                eog=False, include=[], exclude=[])
+    """
+    if dtype is None:
+        dtype = _data.defaults['dtype']
+
+    i_start = dataset[i_start].x
     
-    # read the data
-    epochs = mne.Epochs(raw, events, 1, tstart, tstop, picks=picks)
-    data = np.array([e.T for e in epochs.get_data()])
+    raw = mne.fiff.Raw(path)
+    sensor_net = _sensor_net(raw, sensorsname)
+    picks = _meg_picks(raw)
+    decim = _data._decim_factor(_sfreq(raw.info), decim, sfreq)
+    samplingrate = _sfreq(raw.info) / decim
     
-    props = {'samplingrate': epochs.info['sfreq'][0]}
+    props = {'samplingrate': samplingrate}
     props.update(_default_fiff_properties)
     if properties:
         props.update(properties)
     
-    T = epochs.times
+    T = _epoch_times(samplingrate, tstart, tstop)
     timevar = _data.var(T, 'time')
     dims = (timevar, sensor_net)
     
-    dataset.add(_data.ndvar(dims, data, properties=props, name=name))
+    # read the data
+    baseline = (None, 0)
+    cache_dir = _cache_dir(cache, path)
+    if cache_dir:
+        Y = _cached_epochs(cache_dir, path, raw, i_start, picks, tstart, tstop,
+                           baseline, decim, dims, dtype, props, name)
+    else:
+        data = np.empty((len(i_start), len(T), len(picks)), dtype=dtype)
+        _read_epochs_into(data, raw, i_start, picks, tstart, tstop, baseline,
+                          decim)
+        Y = _data.ndvar(dims, data, properties=props, name=name)
+    
+    dataset.add(Y)
     dataset.default_DV = name
 
 
@@ -203,10 +826,12 @@ def add_fiff_to_events(path, dataset, i_start='i_start',
 
 def fiff(raw, events, conditions, varname='condition', dataname='MEG',
          tstart=-.2, tstop=.6, properties=None, name=None, c_colors={},
-         sensorsname='fiff-sensors'):
+         sensorsname='fiff-sensors', dtype=None, decim=None, sfreq=None):
     """
     Loads data directly when two files (raw and events) are provided 
-    separately.
+    separately. Epochs are read directly from the raw data (see 
+    :func:`fiff_epochs`). Like :class:`mne.Epochs`, events whose epochs 
+    exceed the raw data are dropped.
     
     conditions : dict
         ID->name dictionary of conditions that should be imported
@@ -218,46 +843,31 @@ def fiff(raw, events, conditions, varname='condition', dataname='MEG',
         path to the raw file
     varname : str
         variable name that will contain the condition value 
+    dtype : None | dtype
+        Data type for the MEG data (default ``data.defaults['dtype']``).
+    decim, sfreq : None | scalar
+        Downsample the data while reading (see :func:`fiff_epochs`).
     
     """
+    if dtype is None:
+        dtype = _data.defaults['dtype']
     if name is None:
         name = os.path.basename(raw)
     
     raw = mne.fiff.Raw(raw)
-    
-    # parse sensor net
-    sensor_list = []
-    for ch in raw.info['chs']:
-        ch_name = ch['ch_name']
-        if ch_name.startswith('MEG'):
-            x, y, z = ch['loc'][:3]
-            sensor_list.append([x, y, z, ch_name])
-    sensor_net = sensors.sensor_net(sensor_list, name=sensorsname)
-    
+    sensor_net = _sensor_net(raw, sensorsname)
     events = mne.read_events(events)
-    picks = mne.fiff.pick_types(raw.info, meg=True, eeg=False, stim=False, 
-                                eog=False, include=[], exclude=[])
-    
-    data = []
-    c_x = []
-    
-    # read the data
-    for ID in conditions:
-        epochs = mne.Epochs(raw, events, ID, tstart, tstop, picks=picks)
-        samplingrate = epochs.info['sfreq'][0]
-        
-        # data
-        c_data = epochs.get_data()        # n_ep, n_ch, n_t 
-        
-        for epoch in c_data:
-            data.append(epoch.T)
-#        data.append(c_data.T)
-
-        T = epochs.times
-        
-        # conditions variable
-        n_ep = len(c_data)
-        c_x.extend([ID] * n_ep)
+    picks = _meg_picks(raw)
+    decim = _data._decim_factor(_sfreq(raw.info), decim, sfreq)
+    samplingrate = _sfreq(raw.info) / decim
+    T = _epoch_times(samplingrate, tstart, tstop)
+    events = events[_epochs_in_data(raw, events[:,0], tstart, tstop, decim)]
+    
+    # read the data into a preallocated array
+    n_events = sum(np.sum(events[:,2] == ID) for ID in conditions)
+    data = np.empty((n_events, len(T), len(picks)), dtype=dtype)
+    c_x = _read_conditions_into(data, raw, events, conditions, tstart, tstop,
+                                picks, decim)
     
     # construct the dataset
     c_factor = _data.factor(c_x, name=varname, labels=conditions, 
@@ -268,9 +878,6 @@ def fiff(raw, events, conditions, varname='condition', dataname='MEG',
     if properties is not None:
         props.update(properties)
     
-    data = np.array(data)
-#    data = np.concatenate(data, axis=0)
-    
     timevar = _data.var(T, 'time')
     dims = (timevar, sensor_net)
     
@@ -278,3 +885,132 @@ def fiff(raw, events, conditions, varname='condition', dataname='MEG',
     
     dataset = _data.dataset(Y, c_factor, name=name, default_DV=dataname)
     return dataset
+
+
+
+def _read_subject_into(out, task):
+    "read one subject for fiff_subjects (for parallel.map_into)"
+    raw_path, events, conditions, tstart, tstop, picks, decim, start, n = task
+    raw = mne.fiff.Raw(raw_path)
+    return _read_conditions_into(out[start:start + n], raw, events, 
+                                 conditions, tstart, tstop, picks, decim)
+
+
+def fiff_subjects(subjects, conditions, varname='condition', 
+                  subjectname='subject', dataname='MEG', tstart=-.2, tstop=.6,
+                  properties=None, name=None, c_colors={}, 
+                  sensorsname='fiff-sensors', dtype=None, memmap=None, 
+                  n_workers=None, decim=None, sfreq=None):
+    """
+    Loads data for several subjects (like :func:`fiff`) into a single 
+    dataset. The epochs of each subject are written directly into the 
+    subject's part of one preallocated array. Subjects are read in 
+    parallel by ``n_workers`` processes.
+    
+    subjects : list
+        ``(subject_name, raw_path, events_path)`` tuple for each subject. All
+        raw files need to have the same sensors and sampling rate (a 
+        ValueError is raised otherwise). Like in :func:`fiff`, events whose 
+        epochs exceed the raw data are dropped.
+    conditions : dict
+        ID->name dictionary of conditions that should be imported
+    subjectname : str
+        name of the subject factor (a random factor)
+    dtype : None | dtype
+        Data type for the MEG data (default ``data.defaults['dtype']``).
+    memmap : None | str
+        Store the data in a memory-mapped file pair with this name instead 
+        of in memory (see :func:`data.memmap_ndvar`).
+    n_workers : None | int
+        Number of processes (default is 
+        ``eelbrain.utils.parallel.defaults['n_workers']``).
+    decim, sfreq : None | scalar
+        Downsample the data while reading (see :func:`fiff_epochs`).
+    
+    other parameters: see :func:`fiff`.
+    
+    """
+    if dtype is None:
+        dtype = _data.defaults['dtype']
+    if name is None:
+        name = ', '.join(str(s[0]) for s in subjects)
+    if n_workers is None:
+        n_workers = parallel.defaults['n_workers']
+    
+    # data properties from the first subject
+    raw = mne.fiff.Raw(subjects[0][1])
+    sensor_net = _sensor_net(raw, sensorsname)
+    raw_sfreq = _sfreq(raw.info)
+    picks = _meg_picks(raw)
+    ch_names = [raw.info['chs'][i]['ch_name'] for i in picks]
+    decim = _data._decim_factor(raw_sfreq, decim, sfreq)
+    samplingrate = raw_sfreq / decim
+    T = _epoch_times(samplingrate, tstart, tstop)
+    n_sensors = len(picks)
+    del raw
+    
+    # check the raw files and count the epochs of each subject
+    tasks = []
+    n_total = 0
+    for subject, raw_path, events_path in subjects:
+        raw = mne.fiff.Raw(raw_path)
+        if _sfreq(raw.info) != raw_sfreq:
+            err = ("Subject %r: sampling rate %s Hz differs from the first "
+                   "subject's (%s Hz)" % (subject, _sfreq(raw.info), 
+                                          raw_sfreq))
+            raise ValueError(err)
+        s_picks = _meg_picks(raw)
+        s_ch_names = [raw.info['chs'][i]['ch_name'] for i in s_picks]
+        if not (np.array_equal(s_picks, picks) and s_ch_names == ch_names):
+            err = ("Subject %r: MEG channels differ from the first subject's"
+                   % subject)
+            raise ValueError(err)
+        
+        events = mne.read_events(events_path)
+        events = events[_epochs_in_data(raw, events[:,0], tstart, tstop, 
+                                        decim)]
+        n = int(sum(np.sum(events[:,2] == ID) for ID in conditions))
+        tasks.append((raw_path, events, conditions, tstart, tstop, picks,
+                      decim, n_total, n))
+        n_total += n
+        del raw
+    
+    props = {'samplingrate': samplingrate}
+    props.update(_default_fiff_properties)
+    if properties is not None:
+        props.update(properties)
+    dims = (_data.var(T, 'time'), sensor_net)
+    
+    # allocate the data
+    shared = None
+    if memmap:
+        Y = _data.memmap_ndvar(memmap, dims, n_total, dtype, properties=props,
+                               name=dataname)
+        data = Y.data
+    elif n_workers == 1 or len(subjects) == 1:
+        data = np.empty((n_total, len(T), n_sensors), dtype=dtype)
+    else:
+        shared, data = parallel.shared_empty((n_total, len(T), n_sensors), 
+                                             dtype)
+    
+    # read
+    ids = parallel.map_into(_read_subject_into, tasks, data, raw=shared, 
+                            n_workers=n_workers)
+    
+    if memmap:
+        data.flush()
+    else:
+        Y = _data.ndvar(dims, data, properties=props, name=dataname)
+    
+    # construct the dataset
+    c_x = np.concatenate([np.asarray(c_x, dtype=int) for c_x in ids])
+    c_factor = _data.factor(c_x, name=varname, labels=conditions, 
+                            colors=c_colors, retain_label_codes=True)
+    s_x = np.repeat(np.arange(len(subjects)), [task[-1] for task in tasks])
+    s_labels = dict((i, str(s[0])) for i, s in enumerate(subjects))
+    s_factor = _data.factor(s_x, name=subjectname, labels=s_labels, 
+                            random=True, retain_label_codes=True)
+    
+    dataset = _data.dataset(Y, c_factor, s_factor, name=name, 
+                            default_DV=dataname)
+    return dataset
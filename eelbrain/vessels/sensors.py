@@ -89,7 +89,8 @@ class sensor_net(object):
         # transformed locations
         self._transformed = {}
         self._triangulations = {}
-        
+        self._connectivity = {}
+
         # groups
         if groups:
             self.groups = groups
@@ -104,10 +105,31 @@ class sensor_net(object):
     
     def __repr__(self):
         return "sensor_net([<n=%i>], name=%r)" % (self.n, self.net_name)
-        
+
     def __len__(self):
         return self.n
-    
+
+    def connectivity(self, proj='default'):
+        """
+        Returns the sensor neighborhood as an ``(n_edges, 2)`` array of
+        sensor index pairs (``i < j``). Two sensors are neighbors if they share
+        an edge in the Delaunay triangulation of the 2d sensor map.
+
+        ``proj``:
+            projection used for the 2d sensor map (see :meth:`getLocs2d`)
+
+        """
+        if proj == 'default':
+            proj = self.default_transform_2d
+
+        if proj not in self._connectivity:
+            locs = self.getLocs2d(proj)
+            tri = delaunay.Triangulation(locs[:,0], locs[:,1])
+            edges = np.sort(tri.edge_db, axis=1)
+            self._connectivity[proj] = edges
+
+        return self._connectivity[proj]
+
 #    def get_improj(self, Y, proj='default', resolution=100, im_frame=0.02):
 #        loc2d = self.getLocs2d(proj=proj)
 #        emin = -im_frame
@@ -288,13 +310,12 @@ class sensor_net(object):
         returns a new Sensor Net with a subset of sensors (specified as indexes)
         
         """
-        if len(sensors) > 1:
-            new_sensors = []
-            for i in sensors:
-                new_sensors.append(tuple(self.locs3d[i]) + (self.names[i],))
-            return sensor_net(sensors)
-        else:
-            return None
+        new_sensors = []
+        for i in sensors:
+            new_sensors.append(tuple(self.locs3d[i]) + (self.names[i],))
+        return sensor_net(new_sensors, name=self.net_name, 
+                          transform_2d=self.default_transform_2d)
+    
     def subnet_ROIs(self, ROIs, loc='first'):
         """
         returns new sensor_net object based on senros in ROIs
@@ -14,7 +14,13 @@ import eelbrain.utils.statfuncs as _statfuncs
 
 
 
-class celltable:
+# statistics that can be computed for several cells at once (with ``axis``)
+_axis_functions = (np.mean, np.median, np.std, np.var, scipy.stats.sem, 
+                   _statfuncs.CIhw)
+
+
+
+class celltable(object):
     """
     Attributes
     ----------
@@ -36,6 +42,9 @@ class celltable:
         otherwise (i.e. whether a dependent measures test is appropri-
         ate or not)
     
+    within_matrix
+        ``within`` as boolean array (in the order of ``indexes``)
+    
     all_within
         True if np.all(self.within)
         
@@ -44,7 +53,7 @@ class celltable:
         """
         divides Y into cells defined by X
         
-        Y       dependent measurement
+        Y       dependent measurement (var or ndvar)
         X       factor or interaction
         match   factor on which cases are matched (i.e. subject for a repeated 
                 measures comparisons). If several data points with the same 
@@ -53,25 +62,30 @@ class celltable:
                 {Xcell -> [match values of data points], ...} mapping corres-
                 ponding to self.data
         sub     Bool Array of length N specifying which cases to include
-        match_func:  see match
+        match_func:  see match (needs to take an ``axis`` argument)
         
         
         e.g.
         >>> c = S.celltable(Y, A%B, match=subject)
         
         """
-        if _data.isfactor(Y):
+        if _data.isfactor(Y) or _data.isndvar(Y):
             if sub is not None:
                 Y = Y[sub]
         else:
             Y = _data.asvar(Y, sub)
         
+        if _data.isndvar(Y):
+            y = Y.data
+        else:
+            y = Y.x
+        
         X = _data.ascategorial(X, sub)
-        assert X.N == Y.N
+        assert X.N == len(y)
         
         if match:
             match = _data.asfactor(match, sub)
-            assert match.N == Y.N
+            assert match.N == len(y)
             self.groups = {}
         
         # save args
@@ -82,51 +96,73 @@ class celltable:
 
         # extract cells and cell data
         self.data = {}
-        self.data_indexes = {}
         self.cells = X.cells
         self.indexes = sorted(X.cells.keys())
-        for cell in self.indexes:
-            sub = X==cell
-            self.data_indexes[cell] = sub
-            newdata = Y.x[sub]
+        
+        # group cases by cell (cells are ordered like self.indexes)
+        if _data.isfactor(X):
+            x_codes = [X.x]
+        else:
+            x_codes = [f.x for f in X.factors]
+        if match:
+            groups = _data._cell_groups(x_codes + [match.x])
+            cell_data = groups.reduce(y, match_func)
+            group_ids = match.x[groups.first]
+        else:
+            groups = _data._cell_groups(x_codes)
+            cell_data = groups.sort(y)
+        
+        # cell keys for the groups
+        if _data.isfactor(X):
+            group_cells = X.x[groups.first].tolist()
+        else:
+            group_cells = zip(*[c[groups.first].tolist() for c in x_codes])
+        
+        # split the data by cell
+        if match:
+            bounds = np.arange(groups.n + 1)
+        else:
+            bounds = np.concatenate((groups.starts, [len(y)]))
+        i_cell = 0
+        for i, cell in enumerate(group_cells):
+            if (i > 0) and (cell == group_cells[i - 1]):
+                continue
+            # groups belonging to this cell
+            j = i + 1
+            while j < len(group_cells) and group_cells[j] == cell:
+                j += 1
+            self.data[cell] = cell_data[bounds[i]:bounds[j]]
             if match:
-                # get match ids
-                group = match.x[sub]
-                occurring_ids = np.unique(group)
-                
-                # sort
-                if len(occurring_ids) < len(group):
-                    newdata = np.array([match_func(newdata[group==ID]) 
-                                        for ID in occurring_ids])
-                    group = occurring_ids
-                else:
-                    sort_arg = np.argsort(group)
-                    group = group[sort_arg]
-                    newdata = newdata[sort_arg]
-                
-                self.groups[cell] = group
-            self.data[cell] = newdata
+                self.groups[cell] = group_ids[i:j]
+        
+        # empty cells
+        for cell in self.indexes:
+            if cell not in self.data:
+                self.data[cell] = y[:0]
+                if match:
+                    self.groups[cell] = match.x[:0]
         
         if match:
             # determine which cells compare values for dependent values on 
-            # match_variable
-#            n_cells = len(self.indexes)
-#            self.within = np.empty((n_cells, n_cells), dtype=bool)
+            # match_variable: cells with identical groups
+            signatures = {}
+            ids = np.array([signatures.setdefault(self.groups[cell].tostring(), 
+                                                  len(signatures))
+                            for cell in self.indexes])
+            self.within_matrix = ids[:,None] == ids[None,:]
             self.within = {}
-            for cell1 in self.indexes:
-                for cell2 in self.indexes:
-                    if cell1==cell2:
-                        self.within[cell1,cell2] = True
-                    else:
-                        v = self.groups[cell1] == self.groups[cell2]
-                        if v is not False:
-                            v = all(v)
-                        self.within[cell1,cell2] = v
-                        self.within[cell2,cell1] = v
-            self.all_within = np.all(self.within.values())
+            for i, cell1 in enumerate(self.indexes):
+                for j, cell2 in enumerate(self.indexes):
+                    self.within[cell1, cell2] = self.within_matrix[i, j]
+            self.all_within = np.all(self.within_matrix)
         else:
             self.within = self.all_within = False
     
+    @property
+    def data_indexes(self):
+        "dict(index -> boolean array of the cases in the cell)"
+        return dict((cell, self.X == cell) for cell in self.indexes)
+    
     def __repr__(self):
         args = [self.Y.name, self.X.name]
         rpr = "celltable(%s)"
@@ -148,19 +184,24 @@ class celltable:
         :returns: function applied to all data cells.
         
         :arg function: can be string, '[X]sem', '[X]std', or '[X]ci' with X being 
-            float, e.g. '2sem'
+            float, e.g. '2sem' or '.99ci'
         :arg out: can be dict or list.
         :arg a: multiplier (if not provided in ``function`` string)
         
         :arg kwargs: are submitted to the statistic function 
         
+        If all cells contain the same number of cases, statistics that take an
+        ``axis`` argument (``np.mean``, ``np.std``, sem, ci, ...) are computed
+        for all cells at once. 
+        
         """
         if isinstance(function, basestring):
             if function.endswith('ci'):
                 if len(function) > 2:
-                    a = float(function[:-2])
-                elif a == 1:
-                    a = .95
+                    kwargs['p'] = float(function[:-2])
+                elif a != 1:
+                    kwargs['p'] = a
+                a = 1
                 function = _statfuncs.CIhw
             elif function.endswith('sem'):
                 if len(function) > 3:
@@ -175,13 +216,20 @@ class celltable:
             else:
                 raise ValueError('unrecognized statistic: %s'%function)
         
-        if out in [list, np.array]:
-            as_list = [a * function(self.data[i], **kwargs) for i in self.indexes]
-            if out is list:
-                return as_list
-            else:
-                return np.array(as_list)
-        elif out is dict:
-            return dict((i, a * function(self.data[i], **kwargs)) for i in self.indexes)
-        else:
+        if out not in [list, np.array, dict]:
             raise ValueError("out not in [list, dict]")
+        
+        cell_data = [self.data[i] for i in self.indexes]
+        n = set(len(data) for data in cell_data)
+        if (function in _axis_functions) and (len(n) == 1) and (n.pop() > 0):
+            stacked = np.array(cell_data)
+            values = a * function(stacked, axis=1, **kwargs)
+        else:
+            values = [a * function(data, **kwargs) for data in cell_data]
+        
+        if out is np.array:
+            return np.asarray(values)
+        elif out is list:
+            return list(values)
+        else:
+            return dict(zip(self.indexes, values))